@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run every benchmark, and save or compare their results.
+
+Each benchmark script is run in its own interpreter with `--json`, and the
+results are combined into one JSON document, along with the gifshare and
+Python versions they were measured with. Saving a results file for each
+release, and comparing the next release's results with it, shows up
+regressions:
+
+    python benchmarks/run.py --output results-0.0.4.json
+    python benchmarks/run.py --compare results-0.0.4.json
+
+When comparing, every number in both results is matched up by its path
+(e.g. `s3/upload/1MB/4/mb_per_s`), and any which is worse by more than the
+threshold is reported. Names ending in `_per_s` are better when higher;
+times (`_ms`, `_us`, `seconds`) are better when lower. Other numbers are
+ignored. The exit status is 1 if anything regressed.
+
+Usage:
+
+    python benchmarks/run.py [--quick] [--only NAME,...] [--output FILE]
+        [--compare FILE] [--threshold PERCENT]
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gifshare import __version__  # noqa: E402
+
+BENCHMARKS = [
+    ('startup', ['--repeat', '5'], ['--repeat', '1']),
+    ('sniff', [], ['--files', '1000']),
+    ('s3', [], [
+        '--sizes', '64KB,1MB,17MB', '--concurrency', '1,4', '--files', '4',
+        '--keys', '1000', '--index-keys', '10000,100000']),
+]
+HIGHER_IS_BETTER = ('_per_s',)
+LOWER_IS_BETTER = ('_ms', '_us', 'seconds')
+
+
+def run_benchmark(name, argv):
+    """
+    Run the benchmark script `name` with `argv`, returning its results.
+    """
+    output = subprocess.check_output(
+        [sys.executable, join(ROOT, 'benchmarks', name + '.py'), '--json'] +
+        argv)
+    return json.loads(output.decode('utf-8'))
+
+
+def flatten(value, path=''):
+    """
+    Yield a (path, number) pair for every number in the results `value`.
+
+    Each item in a list of results is named after its string and
+    integer fields (such as its size and concurrency), so that the same
+    measurement has the same path in different runs.
+    """
+    if isinstance(value, dict):
+        for name, item in sorted(value.items()):
+            for pair in flatten(item, '{}/{}'.format(path, name)):
+                yield pair
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            label = str(i)
+            if isinstance(item, dict):
+                label = '/'.join(
+                    str(field) for name, field in sorted(item.items())
+                    if not isinstance(field, (float, bool, list, dict)) and
+                    not name.endswith(LOWER_IS_BETTER + HIGHER_IS_BETTER))
+            for pair in flatten(item, '{}/{}'.format(path, label)):
+                yield pair
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path.lstrip('/'), value
+
+
+def regressions(baseline, current, threshold):
+    """
+    Return a list of (path, baseline, current, percent) for each
+    measurement in `current` which is more than `threshold` percent worse
+    than in `baseline`.
+    """
+    before = dict(flatten(baseline['benchmarks']))
+    worse = []
+    for path, value in flatten(current['benchmarks']):
+        old = before.get(path)
+        if not old:
+            continue
+        change = (value - old) * 100.0 / old
+        if path.endswith(HIGHER_IS_BETTER):
+            change = -change
+        elif not path.endswith(LOWER_IS_BETTER):
+            continue
+        if change > threshold:
+            worse.append((path, old, value, change))
+    return worse
+
+
+def main(argv=sys.argv[1:]):
+    """
+    Run the benchmarks, then save, print or compare the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Run smaller benchmarks, e.g. in CI.')
+    parser.add_argument(
+        '--only', type=lambda value: value.split(','),
+        help='The comma-separated benchmarks to run.')
+    parser.add_argument(
+        '--output', '-o',
+        help='Save the results to this file, instead of printing them.')
+    parser.add_argument(
+        '--compare',
+        help='Compare the results with those saved in this file.')
+    parser.add_argument(
+        '--threshold', type=float, default=10.0,
+        help='How much worse (in percent) counts as a regression.')
+    arguments = parser.parse_args(argv)
+
+    results = {
+        'gifshare': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'benchmarks': {},
+    }
+    for name, full, quick in BENCHMARKS:
+        if arguments.only and name not in arguments.only:
+            continue
+        print('Running {} ...'.format(name), file=sys.stderr)
+        results['benchmarks'][name] = run_benchmark(
+            name, quick if arguments.quick else full)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    elif not arguments.compare:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        worse = regressions(baseline, results, arguments.threshold)
+        for path, old, new, change in worse:
+            print('{}: {} -> {} ({:.0f}% worse)'.format(path, old, new, change))
+        print('{} regressions against gifshare {}'.format(
+            len(worse), baseline.get('gifshare')))
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
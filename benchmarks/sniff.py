@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure the per-file cost of detecting image types over a large batch.
+
+A directory of images (copies of the test fixtures, plus WebP and AVIF
+headers) is created, and `correct_ext` is timed over every file with the
+pure-Python signature detector. If python-magic is installed, libmagic is
+timed over the same files for comparison.
+
+Usage:
+
+    python benchmarks/sniff.py [--files N] [--json]
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+from os.path import abspath, dirname, join
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gifshare.core import correct_ext  # noqa: E402
+from gifshare.sniff import magic_ext  # noqa: E402
+
+FIXTURES = join(ROOT, 'tests', 'fixtures')
+SYNTHETIC = {
+    'webp': b'RIFF\x24\x00\x00\x00WEBPVP8 ' + b'\0' * 1024,
+    'avif': b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00avifmif1miaf' +
+            b'\0' * 1024,
+}
+
+
+def make_batch(directory, count):
+    """
+    Fill `directory` with `count` images of mixed types, returning their
+    paths.
+    """
+    images = []
+    for ext in ('gif', 'jpeg', 'png'):
+        with open(join(FIXTURES, 'test_image.' + ext), 'rb') as fixture:
+            images.append(fixture.read())
+    images.extend(SYNTHETIC.values())
+
+    paths = []
+    for i in range(count):
+        path = join(directory, 'image{:06d}'.format(i))
+        with open(path, 'wb') as image:
+            image.write(images[i % len(images)])
+        paths.append(path)
+    return paths
+
+
+def time_per_file(detect, paths):
+    """
+    Return the mean time in microseconds taken by `detect` for each of
+    `paths`.
+    """
+    start = default_timer()
+    for path in paths:
+        detect(path)
+    return (default_timer() - start) / len(paths) * 1e6
+
+
+def main(argv=sys.argv[1:]):
+    """
+    Run the benchmark and print the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--files', '-n', type=int, default=10000,
+        help='The number of files to detect.')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='Print machine-readable results.')
+    arguments = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='gifshare-sniff-')
+    try:
+        paths = make_batch(directory, arguments.files)
+        results = {'signature_us': time_per_file(correct_ext, paths)}
+        try:
+            import magic  # noqa: F401
+        except ImportError:
+            results['libmagic_us'] = None
+        else:
+            results['libmagic_us'] = time_per_file(magic_ext, paths)
+    finally:
+        shutil.rmtree(directory)
+
+    if arguments.json:
+        print(json.dumps(dict(
+            results, benchmark='sniff', files=arguments.files), indent=2))
+        return
+
+    print('{} files'.format(arguments.files))
+    for name, micros in sorted(results.items()):
+        print('{:<14} {}'.format(
+            name, 'n/a' if micros is None else '{:.1f}'.format(micros)))
+
+
+if __name__ == '__main__':
+    main()
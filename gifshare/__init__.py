@@ -8,7 +8,48 @@ gifshare - A command-line tool to upload images to S3.
 
 from __future__ import print_function, absolute_import, unicode_literals
 
-from .core import VERSION, GifShare, download_file, load_config
-from .s3 import Bucket
+import importlib
+import sys
+
+from .core import VERSION
+
+# Public names, and the submodule each is imported from. They're loaded on
+# first access, so that importing gifshare (or running the command-line tool)
+# doesn't pay for importing boto and friends until they're needed.
+_EXPORTS = {
+    'GifShare': 'core',
+    'download_file': 'download',
+    'load_config': 'core',
+    'Bucket': 's3',
+    'LocalDirectory': 'local',
+    'open_storage': 'storage',
+    'main': 'cli',
+}
+
+__all__ = ['VERSION', '__version__'] + sorted(_EXPORTS)
 
 __VERSION__ = __version__ = version = VERSION
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        module = importlib.import_module('.' + _EXPORTS[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+if sys.version_info < (3, 7):
+    # Module-level __getattr__ isn't supported, so import everything now.
+    from .core import GifShare, load_config
+    from .download import download_file
+    from .s3 import Bucket
+    from .local import LocalDirectory
+    from .storage import open_storage
+    from .cli import main
@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio counterparts of GifShare and Bucket, for using gifshare from an
+asyncio application without blocking the event loop.
+
+AsyncBucket talks to S3 with aiobotocore, and AsyncGifShare downloads images
+with aiohttp. Each keeps a pool of connections, and limits the number of
+requests in flight. Install them with `pip install gifshare[aio]`. This
+module requires Python 3.6 or later:
+
+    async with AsyncBucket(load_config()) as bucket:
+        async with AsyncGifShare(bucket) as gifshare:
+            print(await gifshare.upload_url('http://example.com/cat.gif'))
+"""
+
+import asyncio
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+import base64
+import hashlib
+import logging
+from os.path import basename, splitext
+
+from .core import (
+    CONTENT_TYPE_MAP, DEFAULT_CONCURRENCY, SNIFF_SIZE, URL_RE,
+    UploadResult, config_option, correct_ext, get_name_from_url, load_config,
+    map_file, parse_size)
+from .download import (
+    check_response, check_size, check_status, chunk_size_for)
+from .exceptions import FileAlreadyExists, MissingFile
+from .index import KeyIndex, DEFAULT_INDEX_PATH, DEFAULT_INDEX_TTL
+from .search import matcher
+from .s3 import (
+    DEFAULT_MULTIPART_CHUNKSIZE, DEFAULT_MULTIPART_THRESHOLD,
+    EXISTENCE_CHECKS, MAX_PARTS, MIN_PART_SIZE)
+
+
+LOG = logging.getLogger('gifshare.aio')
+
+# asyncio.get_running_loop arrived in Python 3.7:
+_running_loop = getattr(
+    asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+ListedKey = namedtuple('ListedKey', ['name', 'size', 'etag', 'last_modified'])
+
+
+def _status(error):
+    """
+    Return the HTTP status of a botocore ClientError.
+    """
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+
+@contextmanager
+def precondition(url):
+    """
+    Convert a failed conditional write to `url` into a FileAlreadyExists
+    exception.
+    """
+    from botocore.exceptions import ClientError
+
+    try:
+        yield
+    except ClientError as error:
+        if _status(error) == 412:
+            raise FileAlreadyExists("File at {} already exists!".format(url))
+        raise
+
+
+async def peek(chunks, size):
+    """
+    Read at least `size` bytes from the start of the async iterable `chunks`
+    (unless it is shorter than that).
+
+    Returns a tuple of the leading bytes, and an async iterator over all the
+    chunks, including those that have been read.
+    """
+    chunks = chunks.__aiter__()
+    head = []
+    length = 0
+    async for chunk in chunks:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+
+    async def chained():
+        for chunk in head:
+            yield chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return b''.join(head), chained()
+
+
+async def _in_thread(function, *args):
+    """
+    Run `function` (anything which might block: an index query or update,
+    or reading or hashing a file) in the default executor.
+    """
+    return await _running_loop().run_in_executor(
+        None, function, *args)
+
+
+def _md5(data):
+    """
+    Return the MD5 digest of `data`.
+    """
+    return hashlib.md5(data).digest()
+
+
+class AsyncBucket(object):
+    """
+    An asyncio counterpart of `gifshare.s3.Bucket`, configured in the same
+    way. The following items are also read from the config, so that
+    S3-compatible stores (or a local stand-in) can be used:
+
+    * endpoint_url - the URL of the S3 API
+    * region - the bucket's AWS region
+
+    An AsyncBucket must be used as an async context manager, which opens and
+    closes its connection pool. Up to `concurrency` requests are made at
+    once, across all the operations sharing the bucket.
+    """
+
+    def __init__(self, config=None, concurrency=DEFAULT_CONCURRENCY):
+        if config is None:
+            config = load_config()
+        self._key_id = config.get('default', 'aws_access_id')
+        self._access_key = config.get('default', 'aws_secret_access_key')
+        self._bucket_name = config.get('default', 'bucket')
+        self._web_root = config.get('default', 'web_root')
+        self._endpoint_url = config_option(config, 'endpoint_url')
+        self._region = config_option(config, 'region')
+        self._multipart_threshold = config_option(
+            config, 'multipart_threshold', DEFAULT_MULTIPART_THRESHOLD,
+            parse_size)
+        self._multipart_chunksize = max(MIN_PART_SIZE, config_option(
+            config, 'multipart_chunksize', DEFAULT_MULTIPART_CHUNKSIZE,
+            parse_size))
+        self._existence_check = config_option(
+            config, 'existence_check', 'conditional').lower()
+        if self._existence_check not in EXISTENCE_CHECKS:
+            raise ValueError(
+                "existence_check must be one of: {}".format(
+                    ', '.join(EXISTENCE_CHECKS)))
+
+        self.index = None
+        index_path = config_option(config, 'index', DEFAULT_INDEX_PATH)
+        if index_path and index_path.lower() != 'off':
+            self.index = KeyIndex(
+                index_path, self._bucket_name,
+                config_option(config, 'index_ttl', DEFAULT_INDEX_TTL, int))
+
+        self._concurrency = max(1, concurrency)
+        self._client_context = None
+        self._client = None
+        self._slots = None
+
+    async def __aenter__(self):
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+
+        self._client_context = get_session().create_client(
+            's3',
+            region_name=self._region,
+            endpoint_url=self._endpoint_url,
+            aws_access_key_id=self._key_id,
+            aws_secret_access_key=self._access_key,
+            config=AioConfig(max_pool_connections=self._concurrency))
+        self._client = await self._client_context.__aenter__()
+        self._slots = asyncio.Semaphore(self._concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        client_context, self._client_context = self._client_context, None
+        self._client = None
+        await client_context.__aexit__(*exc_info)
+
+    async def _call(self, operation, **params):
+        """
+        Make a single S3 request once there is a free slot, returning the
+        response.
+        """
+        async with self._slots:
+            return await getattr(self._client, operation)(
+                Bucket=self._bucket_name, **params)
+
+    def url_for(self, name):
+        """
+        Return the URL for `name`, without checking that it exists.
+        """
+        return self._web_root + name
+
+    async def _list_keys(self):
+        """
+        Yield a ListedKey for every key in the bucket, a page at a time.
+        """
+        paginator = self._client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self._bucket_name):
+            for item in page.get('Contents', []):
+                yield ListedKey(
+                    item['Key'], item['Size'], item['ETag'],
+                    item['LastModified'].isoformat())
+
+    async def refresh_index(self, force=True):
+        """
+        Refresh the local key index from S3. Unless `force` is `True`, the
+        index is only refreshed if it is stale. Does nothing if the index is
+        disabled.
+        """
+        if self.index is not None and (force or self.index.is_stale()):
+            keys = [key async for key in self._list_keys()]
+            await _in_thread(self.index.refresh, keys)
+
+    async def _known(self, name):
+        """
+        Return `True` if the index knows that `name` exists, `False` if it
+        is fresh and knows that it doesn't, or `None` if the index is
+        stale or unavailable.
+        """
+        if self.index is None:
+            return None
+        return await _in_thread(self._lookup, name)
+
+    def _lookup(self, name):
+        """
+        Look `name` up in the index, as `_known` does, blocking.
+        """
+        if self.index.is_stale():
+            return None
+        return name in self.index
+
+    async def exists(self, name):
+        """
+        Return `True` if `name` exists in the bucket.
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            await self._call('head_object', Key=name)
+        except ClientError as error:
+            if _status(error) == 404:
+                return False
+            raise
+        return True
+
+    async def _check_upload(self, filename, force, multipart=False):
+        """
+        Check whether an upload of `filename` may go ahead, raising
+        FileAlreadyExists if it would overwrite an existing file (unless
+        `force` is `True`).
+
+        Returns extra parameters to send with the upload, as
+        `Bucket._check_upload` does.
+        """
+        if force:
+            return {}
+        url = self.url_for(filename)
+        if await self._known(filename):
+            raise FileAlreadyExists("File at {} already exists!".format(url))
+        if self._existence_check == 'head' or multipart:
+            if await self.exists(filename):
+                raise FileAlreadyExists(
+                    "File at {} already exists!".format(url))
+        if self._existence_check == 'conditional':
+            return {'IfNoneMatch': '*'}
+        return {}
+
+    async def _record_upload(self, filename, size, etag):
+        """
+        Add a newly uploaded file to the local index.
+        """
+        if self.index is not None:
+            await _in_thread(self.index.add, filename, size, etag)
+
+    async def list(self):
+        """
+        Yield the image URLs stored in this bucket.
+        """
+        if self.index is not None:
+            await self.refresh_index(force=False)
+            for name in await _in_thread(self.index.names):
+                yield self.url_for(name)
+        else:
+            async for key in self._list_keys():
+                yield self.url_for(key.name)
+
+    async def grep(self, pattern, ignore_case=False, regex=False):
+        """
+        Yield URLs where the filename matches `pattern`.
+
+        If `regex` is `True`, `pattern` is a regular expression. If
+        `ignore_case` is `True`, case is ignored.
+        """
+        if self.index is not None:
+            await self.refresh_index(force=False)
+            names = await _in_thread(
+                self.index.grep, pattern, ignore_case, regex)
+            for name in names:
+                yield self.url_for(name)
+        else:
+            matches = matcher(pattern, ignore_case, regex)
+            async for key in self._list_keys():
+                if matches(key.name):
+                    yield self.url_for(key.name)
+
+    async def get_url(self, name):
+        """
+        Generate a URL for `name` stored in the bucket.
+
+        If the index knows the file exists, no request is made.
+        """
+        if await self._known(name) or await self.exists(name):
+            return self.url_for(name)
+        raise MissingFile("The image '%s' does not exist" % name)
+
+    async def _put(self, filename, content_type, data, force):
+        """
+        Upload `data` in a single request.
+        """
+        params = await self._check_upload(filename, force)
+        digest = await _in_thread(_md5, data)
+        LOG.debug("Uploading image ...")
+        with precondition(self.url_for(filename)):
+            response = await self._call(
+                'put_object', Key=filename, Body=data,
+                ContentType=content_type,
+                ContentMD5=base64.b64encode(digest).decode('ascii'),
+                **params)
+        await self._record_upload(filename, len(data), response['ETag'])
+        return self.url_for(filename)
+
+    async def _upload_parts(self, filename, content_type, parts, params):
+        """
+        Upload the `bytes` parts from the async iterable `parts` as a
+        multipart upload, sending parts while later ones are still being
+        read.
+
+        At most `concurrency` parts are held in memory at once. If any part
+        fails, the upload is aborted so that the uploaded parts do not
+        continue to use storage. Returns the ETag and size of the completed
+        upload.
+        """
+        upload = await self._call(
+            'create_multipart_upload', Key=filename, ContentType=content_type)
+        upload_id = upload['UploadId']
+
+        async def upload_part(number, data):
+            response = await self._call(
+                'upload_part', Key=filename, UploadId=upload_id,
+                PartNumber=number, Body=data)
+            return {'ETag': response['ETag'], 'PartNumber': number}
+
+        tasks = []
+        size = 0
+        try:
+            in_flight = set()
+            number = 0
+            async for data in parts:
+                number += 1
+                size += len(data)
+                task = asyncio.ensure_future(upload_part(number, data))
+                tasks.append(task)
+                in_flight.add(task)
+                if len(in_flight) >= self._concurrency:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for finished in done:
+                        finished.result()
+            completed_parts = await asyncio.gather(*tasks)
+            with precondition(self.url_for(filename)):
+                completed = await self._call(
+                    'complete_multipart_upload', Key=filename,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': completed_parts}, **params)
+            return completed['ETag'], size
+        except BaseException:
+            LOG.debug("Aborting multipart upload %s", upload_id)
+            for task in tasks:
+                task.cancel()
+            await self._call(
+                'abort_multipart_upload', Key=filename, UploadId=upload_id)
+            raise
+
+    async def upload_stream(self, filename, content_type, chunks, force=False):
+        """
+        Upload image data to the S3 bucket as it arrives.
+
+        `chunks` is an async iterable of `bytes` chunks. As with
+        `Bucket.upload_stream`, data smaller than multipart_threshold is sent
+        in a single request, and anything larger as a multipart upload.
+
+        If `force` is `True`, any existing image at `filename` will be
+        overwritten.
+        """
+        chunks = chunks.__aiter__()
+        pending = bytearray()
+        async for chunk in chunks:
+            pending.extend(chunk)
+            if len(pending) >= self._multipart_threshold:
+                break
+        else:
+            return await self._put(
+                filename, content_type, bytes(pending), force)
+
+        params = await self._check_upload(filename, force, multipart=True)
+        part_size = self._multipart_chunksize
+
+        async def parts():
+            buf = pending
+            sent = False
+            async for chunk in chunks:
+                buf.extend(chunk)
+                while len(buf) >= part_size:
+                    yield bytes(buf[:part_size])
+                    del buf[:part_size]
+                    sent = True
+            while len(buf) >= part_size:
+                yield bytes(buf[:part_size])
+                del buf[:part_size]
+                sent = True
+            if buf or not sent:
+                yield bytes(buf)
+
+        etag, size = await self._upload_parts(
+            filename, content_type, parts(), params)
+        await self._record_upload(filename, size, etag)
+        return self.url_for(filename)
+
+    async def upload_file(self, filename, content_type, path, force=False):
+        """
+        Upload a file from the filesystem to the S3 bucket, as
+        `Bucket.upload_file` does.
+        """
+        with ExitStack() as stack:
+            # Opening and mapping the file may block:
+            data = await _in_thread(stack.enter_context, map_file(path))
+            size = len(data)
+            if size < self._multipart_threshold:
+                # Reading the mapping reads the file, so it's done in a
+                # thread:
+                return await self._put(
+                    filename, content_type, await _in_thread(bytes, data),
+                    force)
+
+            params = await self._check_upload(
+                filename, force, multipart=True)
+            part_size = self._multipart_chunksize
+            while size > part_size * MAX_PARTS:
+                part_size *= 2
+
+            async def parts():
+                for offset in range(0, size, part_size):
+                    yield await _in_thread(
+                        data.__getitem__, slice(offset, offset + part_size))
+
+            etag, _ = await self._upload_parts(
+                filename, content_type, parts(), params)
+        await self._record_upload(filename, size, etag)
+        return self.url_for(filename)
+
+
+class AsyncGifShare(object):
+    """
+    An asyncio counterpart of `gifshare.core.GifShare`, storing images in an
+    AsyncBucket.
+
+    Images are downloaded with an aiohttp `session`, or a session of its own
+    with up to `concurrency` connections, which is closed when the
+    AsyncGifShare is used as an async context manager (or `close` is
+    called). Downloads of more than `max_size` bytes are abandoned.
+    """
+
+    def __init__(self, bucket, session=None, concurrency=DEFAULT_CONCURRENCY,
+                 max_size=None):
+        self._bucket = bucket
+        self._max_size = max_size
+        self._session = session
+        self._owns_session = False
+        self._concurrency = max(1, concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the HTTP session, if it was created by this AsyncGifShare.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _http(self):
+        """
+        Return the aiohttp session, creating it if necessary.
+        """
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._concurrency))
+            self._owns_session = True
+        return self._session
+
+    async def iter_download(self, url):
+        """
+        Download an image from the provided `url`, yielding the file contents
+        as a series of `bytes` chunks as they arrive.
+        """
+        LOG.debug("Downloading image ...")
+        async with self._http().get(url) as response:
+            check_status(url, response.status, response.reason)
+            check_response(
+                url, response.content_type, response.content_length,
+                self._max_size)
+            chunk_size = chunk_size_for(response.content_length or 0)
+            size = 0
+            async for chunk in response.content.iter_chunked(chunk_size):
+                size += len(chunk)
+                check_size(url, size, self._max_size)
+                yield chunk
+
+    async def upload_url(self, url, name=None, force=False):
+        """
+        Stream the image at `url` into the bucket, as
+        `GifShare.upload_url` does.
+        """
+        LOG.debug("Uploading URL '%s'", url)
+        download = self.iter_download(url)
+        try:
+            head, chunks = await peek(download, SNIFF_SIZE)
+            ext = correct_ext(head, True)
+        except BaseException:
+            await download.aclose()
+            raise
+        filename = (name or get_name_from_url(url)) + '.' + ext
+        return await self._bucket.upload_stream(
+            filename, CONTENT_TYPE_MAP[ext], chunks, force)
+
+    async def upload_file(self, path, name=None, force=False):
+        """
+        Upload a file from the filesystem, as `GifShare.upload_file` does.
+        """
+        LOG.debug("Uploading file '%s'", path)
+        ext = await _in_thread(correct_ext, path)
+        filename = (name or splitext(basename(path))[0]) + '.' + ext
+        return await self._bucket.upload_file(
+            filename, CONTENT_TYPE_MAP[ext], path, force)
+
+    async def upload(self, source, name=None, force=False):
+        """
+        Upload `source`, which may be either a URL or the path to a local file.
+        """
+        if URL_RE.match(source):
+            return await self.upload_url(source, name, force=force)
+        return await self.upload_file(source, name, force=force)
+
+    async def upload_many(self, sources, force=False):
+        """
+        Upload each of `sources` (URLs or local paths), running up to
+        `concurrency` uploads at once.
+
+        Yields an `UploadResult` for each source as its upload completes, as
+        `GifShare.upload_many` does.
+        """
+        slots = asyncio.Semaphore(self._concurrency)
+
+        async def upload_one(source):
+            async with slots:
+                try:
+                    return UploadResult(
+                        source, await self.upload(source, force=force), None)
+                except Exception as error:  # pylint: disable=broad-except
+                    LOG.debug("Failed to upload '%s'", source, exc_info=True)
+                    return UploadResult(source, None, error)
+
+        await self._bucket.refresh_index(force=False)
+        for result in asyncio.as_completed(
+                [upload_one(source) for source in sources]):
+            yield await result
+
+    async def get_url(self, name):
+        """
+        Obtain a URL for name stored in the bucket.
+        """
+        return await self._bucket.get_url(name)
+
+    async def grep(self, pattern, ignore_case=False, regex=False):
+        """
+        Yield all URLs matching `pattern`.
+        """
+        async for url in self._bucket.grep(
+                pattern, ignore_case=ignore_case, regex=regex):
+            yield url
@@ -2,73 +2,186 @@
 
 """
 Command-line interface functionality for gifshare.
+
+Modules which are slow to import (boto in particular) are imported by the
+commands which need them, so that quick commands start quickly.
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
 
 import argparse
+from collections import OrderedDict
+import json
 import logging
 from os.path import isfile
-import random
-import re
 import sys
+from timeit import default_timer
 
-from .s3 import Bucket
-from .core import GifShare, load_config, VERSION
+from .core import (
+    GifShare, load_config, config_option, find_sources, parse_size,
+    reservoir_sample, URL_RE, VERSION, DEFAULT_CONCURRENCY,
+    DEFAULT_CONNECTIONS, DEDUP_MODES)
 from .exceptions import UserException
+from .storage import open_storage
+from . import daemon, session, timing
 
 
 LOG = logging.getLogger('gifshare.cli')
 
-URL_RE = re.compile(r'^http.*')
 FOOTER = """
 Copyright (c) 2014 by Mark Smith.
 MIT Licensed, see LICENSE.txt for more details.
 """
 
 
+def dedup_mode(arguments, config):
+    """
+    Return the deduplication mode selected on the command-line, or in the
+    configuration.
+    """
+    return arguments.dedup or config_option(config, 'dedup')
+
+
+def download_connections(arguments, config):
+    """
+    Return the number of connections to download each image over, selected
+    on the command-line, or in the configuration.
+    """
+    return arguments.connections or config_option(
+        config, 'download_connections', DEFAULT_CONNECTIONS, int)
+
+
+def max_download_size(arguments, config):
+    """
+    Return the largest image that may be downloaded, in bytes, selected on
+    the command-line or in the configuration, or `None` for no limit.
+    """
+    return arguments.max_size or config_option(
+        config, 'max_download_size', None, parse_size)
+
+
 def command_upload(arguments, config):
     """
     Extract the provided argparse arguments and upload a file or URL.
     """
     path = arguments.path
+    dedup = dedup_mode(arguments, config)
     if not URL_RE.match(path):
         if isfile(path):
-            print(GifShare(Bucket(config)).upload_file(
-                path, arguments.key, force=arguments.force))
+            print(GifShare(open_storage(config), dedup=dedup).upload_file(
+                path, arguments.key, force=arguments.force,
+                resume=arguments.resume))
         else:
             raise IOError(
                 '{} does not exist or is not a file!'.format(path))
     else:
-        print(GifShare(Bucket(config)).upload_url(
-            path, arguments.key, force=arguments.force))
+        gifshare = GifShare(
+            open_storage(config), dedup=dedup,
+            connections=download_connections(arguments, config),
+            max_size=max_download_size(arguments, config))
+        print(gifshare.upload_url(path, arguments.key, force=arguments.force))
+
+
+def command_batch(arguments, config):
+    """
+    Extract the provided argparse arguments and upload many files or URLs
+    concurrently, printing each URL as its upload completes.
+    """
+    sources = find_sources(arguments.paths)
+    gifshare = GifShare(
+        open_storage(config, progress=False), progress=False,
+        dedup=dedup_mode(arguments, config),
+        connections=download_connections(arguments, config),
+        max_size=max_download_size(arguments, config))
+    failures = []
+    for result in gifshare.upload_many(
+            sources, force=arguments.force, concurrency=arguments.jobs):
+        if result.error is None:
+            print(result.url)
+        else:
+            failures.append(result)
+            print('{}: {}'.format(result.source, result.error),
+                  file=sys.stderr)
 
+    print('Uploaded {} of {} images.'.format(
+        len(sources) - len(failures), len(sources)), file=sys.stderr)
+    if failures:
+        raise UserException(
+            '{} of {} uploads failed.'.format(len(failures), len(sources)))
 
-def command_list(arguments, config):
+
+def command_list(arguments, config, bucket=None):
     """
     Extract the provided argparse arguments and list the files stored remotely.
     """
-    bucket = Bucket(config)
-    if not arguments.random:
-        for item in bucket.list():
-            print(item)
-    else:
-        print(random.choice(list(bucket.list())))
+    bucket = bucket or open_storage(config)
+    if arguments.refresh:
+        bucket.refresh_index()
+    urls = bucket.list()
+    if arguments.random:
+        urls = reservoir_sample(urls, arguments.count)
+    for url in urls:
+        print(url)
 
 
-def command_delete(arguments, config):
+def delete_selection(arguments, bucket):
     """
-    Extract the provided argparse arguments and delete a remote file.
+    Return the names of the files selected for deletion by the provided
+    argparse arguments, in order and without duplicates.
     """
-    bucket = Bucket(config)
-    bucket.delete_file(arguments.path)
+    names = []
+    for path in arguments.paths:
+        if path == '-':
+            names.extend(line.strip() for line in sys.stdin if line.strip())
+        else:
+            names.append(path)
+    if arguments.grep is not None:
+        names.extend(bucket.names_matching(
+            arguments.grep,
+            ignore_case=arguments.ignore_case,
+            regex=arguments.regex))
+    return list(OrderedDict.fromkeys(names))
+
 
+def command_delete(arguments, config, bucket=None):
+    """
+    Extract the provided argparse arguments and delete remote files.
 
-def command_expand(arguments, config):
+    A single named file is checked and deleted on its own. Anything more is
+    deleted in batches.
+    """
+    if not arguments.paths and arguments.grep is None:
+        raise UserException(
+            'Name the files to delete, or select them with --grep.')
+    bucket = bucket or open_storage(config)
+    names = delete_selection(arguments, bucket)
+    if arguments.dry_run:
+        for name in names:
+            print(name)
+        return
+    if arguments.paths != ['-'] and len(arguments.paths) == 1 and \
+            arguments.grep is None:
+        bucket.delete_file(names[0])
+        return
+
+    failures = []
+    for result in bucket.delete_files(names, concurrency=arguments.jobs):
+        if result.error is not None:
+            failures.append(result)
+            print('{}: {}'.format(result.name, result.error),
+                  file=sys.stderr)
+    print('Deleted {} of {} images.'.format(
+        len(names) - len(failures), len(names)), file=sys.stderr)
+    if failures:
+        raise UserException('{} of {} deletes failed.'.format(
+            len(failures), len(names)))
+
+
+def command_expand(arguments, config, bucket=None):
     """
     Extract the provided argparse arguments and expand the name to a URL.
     """
-    bucket = Bucket(config)
+    bucket = bucket or open_storage(config)
     print(bucket.get_url(arguments.path))
 
 
@@ -77,122 +190,423 @@ def command_show(arguments, config):
     Open the user's browser to display the image at the remote path specified
     in arguments.path.
     """
-    GifShare(Bucket(config)).show(arguments.path)
+    GifShare(open_storage(config)).show(arguments.path)
 
 
-def command_grep(arguments, config):
+def command_grep(arguments, config, bucket=None):
     """
     List matching remote images.
     """
-    for url in GifShare(Bucket(config)).grep(arguments.pattern):
+    bucket = bucket or open_storage(config)
+    if arguments.refresh:
+        bucket.refresh_index()
+    for url in GifShare(bucket).grep(
+            arguments.pattern,
+            ignore_case=arguments.ignore_case,
+            regex=arguments.regex):
         print(url)
 
 
+def command_watch(arguments, config):
+    """
+    Extract the provided argparse arguments and upload images as they
+    arrive in a directory, printing each URL as its upload completes.
+    """
+    from .watch import (
+        FolderWatch, WatchState, DEFAULT_SETTLE, DEFAULT_STATE_PATH)
+
+    gifshare = GifShare(
+        open_storage(config, progress=False), progress=False,
+        dedup=dedup_mode(arguments, config))
+    watch = FolderWatch(
+        gifshare, arguments.directory,
+        WatchState(config_option(config, 'watch_state', DEFAULT_STATE_PATH)),
+        settle=arguments.settle or config_option(
+            config, 'watch_settle', DEFAULT_SETTLE, float),
+        concurrency=arguments.jobs, force=arguments.force)
+    try:
+        for result in watch.run():
+            if result.error is None:
+                print(result.url)
+            else:
+                print('{}: {}'.format(result.source, result.error),
+                      file=sys.stderr)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def command_cleanup(arguments, config):
+    """
+    Extract the provided argparse arguments and cancel stale multipart
+    uploads.
+    """
+    cancelled = open_storage(config).cleanup_uploads(arguments.max_age)
+    for name in cancelled:
+        print(name)
+    print("Cancelled {} incomplete uploads.".format(len(cancelled)),
+          file=sys.stderr)
+
+
+def command_daemon(arguments, config):
+    """
+    Run the gifshare daemon in the foreground.
+    """
+    daemon.serve(arguments.socket or daemon.socket_path(config), config)
+
+
+def build_parser():
+    """
+    Build the parser for gifshare's command-line arguments.
+    """
+    a_parser = argparse.ArgumentParser(
+        description="""
+        gifshare - A command-line tool to upload images to S3.
+        """,
+        epilog=FOOTER)
+    a_parser.add_argument(
+        '--version',
+        action='version',
+        version='%(prog)s ' + VERSION)
+
+    a_parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='print out more stuff')
+
+    a_parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help="don't use a running gifshare daemon")
+
+    a_parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='print how long each phase of the command took')
+
+    a_parser.add_argument(
+        '--stats-json',
+        metavar='FILE',
+        help='write the timing of each phase of the command to FILE')
+
+    subparsers = a_parser.add_subparsers(dest='command')
+
+    upload_parser = subparsers.add_parser(
+        "upload",
+        help="Upload an image to your bucket."
+    )
+    upload_parser.set_defaults(target=command_upload)
+
+    upload_parser.add_argument(
+        '--force', '-f',
+        action='store_true',
+        default=False,
+        help='Overwrite any existing files if necessary.')
+
+    upload_parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Continue an interrupted upload of the same file.')
+
+    upload_parser.add_argument(
+        '--connections', '-c',
+        type=int,
+        help='The number of connections to download each image over, if '
+             'the server supports it.')
+
+    upload_parser.add_argument(
+        '--max-size',
+        type=parse_size,
+        help="Don't download images larger than this (e.g. 20MB).")
+
+    upload_parser.add_argument(
+        '--dedup',
+        choices=DEDUP_MODES,
+        help='If the image is already in the bucket, link to it or copy '
+             'it instead of uploading it again.')
+
+    upload_parser.add_argument(
+        'path',
+        help='The path to a file to upload')
+
+    upload_parser.add_argument(
+        'key',
+        nargs='?',
+        help='A nice filename for the gif.')
+
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Upload many images to your bucket concurrently."
+    )
+    batch_parser.set_defaults(target=command_batch)
+
+    batch_parser.add_argument(
+        '--force', '-f',
+        action='store_true',
+        default=False,
+        help='Overwrite any existing files if necessary.')
+
+    batch_parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The number of uploads to run at once.')
+
+    batch_parser.add_argument(
+        '--connections', '-c',
+        type=int,
+        help='The number of connections to download each image over, if '
+             'the server supports it.')
+
+    batch_parser.add_argument(
+        '--max-size',
+        type=parse_size,
+        help="Don't download images larger than this (e.g. 20MB).")
+
+    batch_parser.add_argument(
+        '--dedup',
+        choices=DEDUP_MODES,
+        help='If an image is already in the bucket, link to it or copy '
+             'it instead of uploading it again.')
+
+    batch_parser.add_argument(
+        'paths',
+        nargs='+',
+        help='Files, directories, glob patterns or URLs to upload.')
+
+    list_parser = subparsers.add_parser(
+        "list",
+        help="List images stored in your bucket."
+    )
+    list_parser.add_argument(
+        '-r', '--random',
+        action='store_true',
+        help='Display a random image URL.'
+    )
+    list_parser.add_argument(
+        '-n', '--count',
+        type=int,
+        default=1,
+        help='With --random, the number of image URLs to display.'
+    )
+    list_parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Refresh the local index of images from S3 first.'
+    )
+    list_parser.set_defaults(target=command_list)
+
+    delete_parser = subparsers.add_parser(
+        "delete",
+        help="Delete files in your bucket."
+    )
+    delete_parser.add_argument(
+        "paths",
+        nargs='*',
+        metavar='path',
+        help="The path to a file to delete, or - to read paths from stdin"
+    )
+    delete_parser.add_argument(
+        '--grep',
+        metavar='PATTERN',
+        help='Delete every file matching PATTERN.'
+    )
+    delete_parser.add_argument(
+        '-i', '--ignore-case',
+        action='store_true',
+        help='Ignore case when matching.'
+    )
+    delete_parser.add_argument(
+        '-E', '--regex',
+        action='store_true',
+        help='Treat the pattern as a regular expression.'
+    )
+    delete_parser.add_argument(
+        '-n', '--dry-run',
+        action='store_true',
+        help='List the files which would be deleted, without deleting them.'
+    )
+    delete_parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The number of delete requests to send at once.'
+    )
+    delete_parser.set_defaults(target=command_delete)
+
+    expand_parser = subparsers.add_parser(
+        "expand",
+        help="Convert a filename to a URL"
+    )
+    expand_parser.add_argument(
+        'path',
+        help="The name of the uploaded file."
+    )
+    expand_parser.set_defaults(target=command_expand)
+
+    show_parser = subparsers.add_parser(
+        "show",
+        help="Display a remote image in the browser."
+    )
+    show_parser.add_argument(
+        'path',
+        help="The name of the uploaded file."
+    )
+    show_parser.set_defaults(target=command_show)
+
+    grep_parser = subparsers.add_parser(
+        "grep",
+        help="List matching uploaded files."
+    )
+    grep_parser.add_argument(
+        'pattern',
+        help="Part of the filename."
+    )
+    grep_parser.add_argument(
+        '-i', '--ignore-case',
+        action='store_true',
+        help='Ignore case when matching.'
+    )
+    grep_parser.add_argument(
+        '-E', '--regex',
+        action='store_true',
+        help='Treat the pattern as a regular expression.'
+    )
+    grep_parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Refresh the local index of images from S3 first.'
+    )
+    grep_parser.set_defaults(target=command_grep)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Upload images as they arrive in a directory."
+    )
+    watch_parser.add_argument(
+        '--force', '-f',
+        action='store_true',
+        default=False,
+        help='Overwrite any existing files if necessary.')
+    watch_parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help='The number of uploads to run at once.')
+    watch_parser.add_argument(
+        '--settle',
+        type=float,
+        help="Wait until a file hasn't changed for this many seconds "
+             "before uploading it (default: 2).")
+    watch_parser.add_argument(
+        '--dedup',
+        choices=DEDUP_MODES,
+        help='If an image is already in the bucket, link to it or copy '
+             'it instead of uploading it again.')
+    watch_parser.add_argument(
+        'directory',
+        help='The directory to watch.')
+    watch_parser.set_defaults(target=command_watch)
+
+    cleanup_parser = subparsers.add_parser(
+        "cleanup",
+        help="Cancel stale, incomplete uploads."
+    )
+    cleanup_parser.add_argument(
+        '--max-age',
+        type=int,
+        help="Cancel uploads started more than this many seconds ago. "
+             "Defaults to the stale_upload_age setting (a week)."
+    )
+    cleanup_parser.set_defaults(target=command_cleanup)
+
+    daemon_parser = subparsers.add_parser(
+        "daemon",
+        help="Run a background process to answer commands quickly."
+    )
+    daemon_parser.add_argument(
+        '--socket',
+        help="The path of the socket to listen on."
+    )
+    daemon_parser.set_defaults(target=command_daemon)
+
+    return a_parser
+
+
+def log_connection_stats():
+    """
+    Log how many HTTP requests were made to each host, and how many of them
+    reused an open connection.
+    """
+    for stats in session.connection_stats():
+        LOG.debug(
+            "%s: %d requests over %d connections (%d reused)",
+            stats.host, stats.requests, stats.connections,
+            max(0, stats.requests - stats.connections))
+
+
+def write_profile(arguments, recorder, seconds):
+    """
+    Print the phases timed by `recorder` if --profile was given, and write
+    them to the --stats-json file if one was given.
+    """
+    if arguments.profile:
+        print(recorder.report(), file=sys.stderr)
+        print('total: {:.1f} ms'.format(seconds * 1000), file=sys.stderr)
+    if arguments.stats_json:
+        with open(arguments.stats_json, 'w') as stats_file:
+            json.dump({
+                'command': arguments.command,
+                'seconds': seconds,
+                'phases': recorder.summary(),
+                'connections': [
+                    dict(stats._asdict())
+                    for stats in session.connection_stats()],
+            }, stats_file, indent=2, sort_keys=True)
+
+
 def main(argv=sys.argv[1:]):
     """
     The entry-point for command-line execution.
 
     This function parses the command-line argument and then passes this and the
     loaded configuration off to a sub-command's `command_` function.
+
+    Commands that a running daemon can answer are sent to it instead.
     """
     try:
-        a_parser = argparse.ArgumentParser(
-            description="""
-            gifshare - A command-line tool to upload images to S3.
-            """,
-            epilog=FOOTER)
-        a_parser.add_argument(
-            '--version',
-            action='version',
-            version='%(prog)s ' + VERSION)
-
-        a_parser.add_argument(
-            '-v', '--verbose',
-            action='store_true',
-            help='print out more stuff')
-
-        subparsers = a_parser.add_subparsers()
-
-        upload_parser = subparsers.add_parser(
-            "upload",
-            help="Upload an image to your bucket."
-        )
-        upload_parser.set_defaults(target=command_upload)
-
-        upload_parser.add_argument(
-            '--force', '-f',
-            action='store_true',
-            default=False,
-            help='Overwrite any existing files if necessary.')
-
-        upload_parser.add_argument(
-            'path',
-            help='The path to a file to upload')
-
-        upload_parser.add_argument(
-            'key',
-            nargs='?',
-            help='A nice filename for the gif.')
-
-        list_parser = subparsers.add_parser(
-            "list",
-            help="List images stored in your bucket."
-        )
-        list_parser.add_argument(
-            '-r', '--random',
-            action='store_true',
-            help='Display a single random image URL.'
-        )
-        list_parser.set_defaults(target=command_list)
-
-        delete_parser = subparsers.add_parser(
-            "delete",
-            help="Delete a file in your bucket."
-        )
-        delete_parser.add_argument(
-            "path",
-            help="The path to a file to delete"
-        )
-        delete_parser.set_defaults(target=command_delete)
-
-        expand_parser = subparsers.add_parser(
-            "expand",
-            help="Convert a filename to a URL"
-        )
-        expand_parser.add_argument(
-            'path',
-            help="The name of the uploaded file."
-        )
-        expand_parser.set_defaults(target=command_expand)
-
-        show_parser = subparsers.add_parser(
-            "show",
-            help="Display a remote image in the browser."
-        )
-        show_parser.add_argument(
-            'path',
-            help="The name of the uploaded file."
-        )
-        show_parser.set_defaults(target=command_show)
-
-        grep_parser = subparsers.add_parser(
-            "grep",
-            help="List matching uploaded files."
-        )
-        grep_parser.add_argument(
-            'pattern',
-            help="Part of the filename."
-        )
-        grep_parser.set_defaults(target=command_grep)
-
-        arguments = a_parser.parse_args(argv)
+        arguments = build_parser().parse_args(argv)
         config = load_config()
 
         logging.basicConfig()
         LOG.setLevel(
             level=logging.DEBUG if arguments.verbose else logging.WARN)
 
-        arguments.target(arguments, config)
+        # Profiled commands are always run here, where they can be timed:
+        profiling = arguments.profile or arguments.stats_json
+        if daemon.can_handle(arguments) and not arguments.no_daemon and \
+                not profiling:
+            response = daemon.request(
+                daemon.socket_path(config), argv, config)
+            if response is not None:
+                sys.stdout.write(response['stdout'])
+                sys.stderr.write(response['stderr'])
+                return response['status']
+
+        session.configure(config)
+        recorder = timing.Recorder() if profiling else None
+        if recorder is not None:
+            timing.add_hook(recorder)
+        start = default_timer()
+        try:
+            arguments.target(arguments, config)
+        finally:
+            if recorder is not None:
+                timing.remove_hook(recorder)
+                write_profile(arguments, recorder, default_timer() - start)
+        if arguments.verbose:
+            log_connection_stats()
         return 0
     except UserException as user_exception:
         print(user_exception, file=sys.stderr)
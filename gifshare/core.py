@@ -6,27 +6,39 @@ Core gifshare functionality.
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+from collections import namedtuple
+from contextlib import contextmanager
+import glob
+import itertools
 import logging
-from os.path import expanduser, basename, splitext
+import math
+import mmap
+import os
+from os.path import expanduser, basename, isdir, isfile, join, splitext
+import random
 import re
-import webbrowser
 
 from six.moves import configparser
-from six import StringIO
-import magic
-import progressbar
-import requests
 
+from .download import DEFAULT_CONNECTIONS, iter_download
 from .exceptions import UnknownFileType
+from .sniff import EXTENSIONS, HEADER_SIZE, image_type, magic_ext, read_head
+from .timing import span, timed_iter
 
 
 LOG = logging.getLogger('gifshare.core')
 
 VERSION = '0.0.4'
+URL_RE = re.compile(r'^http.*')
+DEFAULT_CONCURRENCY = 4
+SNIFF_SIZE = 4096
+DEDUP_MODES = ('link', 'copy')
 CONTENT_TYPE_MAP = {
     u'gif': u'image/gif',
     u'jpeg': u'image/jpeg',
     u'png': u'image/png',
+    u'webp': u'image/webp',
+    u'avif': u'image/avif',
 }
 
 
@@ -42,28 +54,106 @@ def load_config():
     return config
 
 
-def download_file(url):
+def parse_size(value):
     """
-    Download an image from the provided `url` and return the file contents as
-    a `str`.
+    Convert a size such as '8MB', '512k' or '1048576' into a number of bytes.
     """
-    LOG.debug("Downloading image ...")
-    response = requests.get(url, stream=True)
-    length = int(response.headers['content-length'])
-    LOG.debug('Content length: %d', length)
-    content = StringIO()
-    i = 0
-    widgets = [
-        'Downloading image ', progressbar.Bar(), progressbar.Percentage()]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=length).start()
-    for chunk in response.iter_content(64):
-        i += len(chunk)
-        LOG.debug('Update: %d', i)
-        content.write(chunk)
-        pbar.update(i)
-    pbar.finish()
+    match = re.match(r'^\s*(\d+)\s*([kmg]?)b?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: {!r}".format(value))
+    number, unit = match.groups()
+    return int(number) * 1024 ** ' kmg'.index(unit.lower() or ' ')
 
-    return content.getvalue()
+
+def config_option(config, name, default=None, convert=None):
+    """
+    Obtain the option `name` from the 'default' section of `config`, or
+    `default` if it has not been set. If `convert` is provided, it will be
+    applied to configured values.
+    """
+    if not config.has_option('default', name):
+        return default
+    value = config.get('default', name)
+    return convert(value) if convert is not None else value
+
+
+@contextmanager
+def map_file(path):
+    """
+    Map the file at `path` into memory (read-only), yielding a buffer
+    containing its contents.
+
+    Pages are only read from disk once, however many times the buffer is
+    read, so the same mapping can be sniffed, hashed and uploaded without
+    reading the file again.
+    """
+    with open(path, 'rb') as source:
+        if not os.fstat(source.fileno()).st_size:
+            # Empty files can't be mapped.
+            yield b''
+            return
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+def peek(chunks, size):
+    """
+    Read at least `size` bytes from the start of the iterable `chunks` (unless
+    it is shorter than that).
+
+    Returns a tuple of the leading bytes, and an iterator over all the
+    chunks, including those that have been read.
+    """
+    chunks = iter(chunks)
+    head = []
+    length = 0
+    for chunk in chunks:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return b''.join(head), itertools.chain(head, chunks)
+
+
+def _open_uniform(rng):
+    """
+    Return a random number from `rng` in the open interval (0, 1).
+    """
+    value = 0.0
+    while value == 0.0:
+        value = rng.random()
+    return value
+
+
+def reservoir_sample(items, count, rng=None):
+    """
+    Return `count` items chosen uniformly at random from the iterable
+    `items` (or all of them, if there are fewer), in a random order.
+
+    `items` is read once, and only `count` items are held in memory, however
+    long it is. Li's "Algorithm L" is used, which skips ahead between
+    replacements, so only O(count * log(n / count)) random numbers are drawn
+    for `n` items. `rng` defaults to the `random` module.
+    """
+    rng = rng or random
+    items = iter(items)
+    reservoir = list(itertools.islice(items, max(0, count)))
+    if len(reservoir) == count and count > 0:
+        weight = math.exp(math.log(_open_uniform(rng)) / count)
+        while True:
+            skip = int(math.floor(
+                math.log(_open_uniform(rng)) / math.log(1 - weight)))
+            for item in itertools.islice(items, skip, skip + 1):
+                reservoir[rng.randrange(count)] = item
+                break
+            else:
+                break
+            weight *= math.exp(math.log(_open_uniform(rng)) / count)
+    rng.shuffle(reservoir)
+    return reservoir
 
 
 def correct_ext(data, is_buffer=False):
@@ -71,16 +161,22 @@ def correct_ext(data, is_buffer=False):
     Inspect the contents of an image (data), and determine what image type it
     conforms to. Return the correct file extension for this image-type.
 
-    Raises an UnknownFileType exception if data is not PNG, GIF or JPEG
-    image data.
+    Only the first few bytes are read. libmagic is used as a fallback for
+    images whose signature isn't recognised, if python-magic is installed
+    (and is also only given the first few bytes of a buffer).
+
+    Raises an UnknownFileType exception if data is not GIF, JPEG, PNG, WebP
+    or AVIF image data.
     """
-    magic_output = magic.from_buffer(data) if is_buffer else magic.from_file(
-        data)
-    match = re.search(r'JPEG|GIF|PNG', magic_output.decode('utf-8'))
-    if match:
-        return match.group(0).lower()
-    else:
-        raise UnknownFileType("Unknown file type: {}".format(magic_output))
+    head = bytes(data[:HEADER_SIZE]) if is_buffer else read_head(data)
+    kind = image_type(head)
+    if kind is not None:
+        return EXTENSIONS[kind]
+    ext = magic_ext(head if is_buffer else data, is_buffer)
+    if ext is not None:
+        return ext
+    raise UnknownFileType("Unknown file type: {}".format(
+        'image data' if is_buffer else data))
 
 
 def get_name_from_url(url):
@@ -90,33 +186,115 @@ def get_name_from_url(url):
     return re.match(r'.*/([^/\.]+)', url).group(1)
 
 
+def find_sources(paths):
+    """
+    Expand a sequence of command-line `paths` into a list of upload sources.
+
+    URLs are passed through untouched, directories are expanded to the
+    (non-hidden) files they contain, and glob patterns are expanded to
+    matching files. Anything else is passed through as-is, so that it
+    can be reported as a failure when it is uploaded.
+    """
+    sources = []
+    for path in paths:
+        if URL_RE.match(path):
+            sources.append(path)
+        elif isdir(path):
+            sources.extend(
+                join(path, name) for name in sorted(os.listdir(path))
+                if not name.startswith('.') and isfile(join(path, name)))
+        elif glob.has_magic(path):
+            sources.extend(sorted(
+                match for match in glob.glob(path) if isfile(match)))
+        else:
+            sources.append(path)
+    return sources
+
+
+UploadResult = namedtuple('UploadResult', ['source', 'url', 'error'])
+UploadResult.__doc__ = """
+The outcome of uploading a single `source` as part of a batch. Exactly one
+of `url` or `error` will be set.
+"""
+
+
 class GifShare(object):
     """
     High level application functionality.
+
+    If `dedup` is set, the contents of each upload are first compared with
+    the files already in the bucket. If a copy is found, it is either
+    linked to (`dedup='link'` returns the existing file's URL) or copied
+    within the bucket (`dedup='copy'`) instead of being uploaded again.
+
+    Images are downloaded from URLs over up to `connections` connections
+    at once, if the server supports it. Downloads of more than `max_size`
+    bytes are abandoned.
     """
 
-    def __init__(self, bucket):
+    def __init__(self, bucket, progress=True, dedup=None,
+                 connections=DEFAULT_CONNECTIONS, max_size=None):
+        if dedup is not None and dedup not in DEDUP_MODES:
+            raise ValueError(
+                "dedup must be one of: {}".format(', '.join(DEDUP_MODES)))
         self._bucket = bucket
+        self._progress = progress
+        self._dedup = dedup
+        self._connections = connections
+        self._max_size = max_size
+
+    def _use_duplicate(self, existing, filename, content_type, force):
+        """
+        Return the URL for `filename`, given that `existing` in the bucket
+        has the same contents.
+        """
+        LOG.debug("'%s' is a duplicate of '%s'", filename, existing)
+        if existing == filename or self._dedup == 'link':
+            return self._bucket.url_for(existing)
+        return self._bucket.copy_file(existing, filename, content_type, force)
 
     def upload_url(self, url, name=None, force=False):
         """
-        Download the image at `url` and then upload the image data. The name
-        is devised from the original URL. This can be overridden by providing
-        `name`.
+        Stream the image at `url` into the bucket, uploading the image data
+        as it is downloaded. The name is devised from the original URL. This
+        can be overridden by providing `name`.
 
         If `force` is `True`, any existing image at the specified path will be
         overwritten.
-        """
-        LOG.debug("Uploading URL '%s'", url)
-        data = download_file(url)
-        ext = correct_ext(data, True)
-        content_type = CONTENT_TYPE_MAP[ext]
-        filename = (name or get_name_from_url(url)) + '.' + ext
 
-        return self._bucket.upload_contents(
-            filename, content_type, data, force)
+        When deduplicating, the whole image must be downloaded before it can
+        be compared, so it is not streamed.
 
-    def upload_file(self, path, name=None, force=False):
+        The download is abandoned as soon as its first few bytes show that it
+        isn't a supported image, or once it exceeds the maximum size.
+        """
+        LOG.debug("Uploading URL '%s'", url)
+        with span('upload_url'):
+            download = timed_iter('download', iter_download(
+                url, progress=self._progress, connections=self._connections,
+                max_size=self._max_size))
+            try:
+                head, chunks = peek(download, SNIFF_SIZE)
+                with span('sniff'):
+                    ext = correct_ext(head, True)
+            except BaseException:
+                download.close()
+                raise
+            content_type = CONTENT_TYPE_MAP[ext]
+            filename = (name or get_name_from_url(url)) + '.' + ext
+
+            if self._dedup:
+                chunks = list(chunks)
+                with span('dedup'):
+                    existing = self._bucket.find_duplicate(chunks)
+                if existing is not None:
+                    return self._use_duplicate(
+                        existing, filename, content_type, force)
+
+            return self._bucket.upload_stream(
+                filename, content_type, chunks, force)
+
+    def upload_file(self, path, name=None, force=False, resume=False):
         """
         Upload a file from the filesystem.
 
@@ -124,13 +302,69 @@ class GifShare(object):
         original file name. This can be overridden by providing `name`.
 
         If `force` is `True`, any existing image at the specified path will be
-        overwritten.
+        overwritten. If `resume` is `True`, an interrupted upload of the
+        file is continued.
         """
         LOG.debug("Uploading file '%s'", path)
-        ext = correct_ext(path)
-        filename = (name or splitext(basename(path))[0]) + '.' + ext
-        content_type = CONTENT_TYPE_MAP[ext]
-        return self._bucket.upload_file(filename, content_type, path, force)
+        with span('upload_file'):
+            with map_file(path) as data:
+                with span('sniff'):
+                    ext = correct_ext(data, True)
+                filename = (name or splitext(basename(path))[0]) + '.' + ext
+                content_type = CONTENT_TYPE_MAP[ext]
+                digests = {}
+                if self._dedup:
+                    with span('dedup'):
+                        existing = self._bucket.find_duplicate(
+                            [data], digests)
+                    if existing is not None:
+                        return self._use_duplicate(
+                            existing, filename, content_type, force)
+                # The mapping (and checksum) are reused for the upload, so
+                # the file is only read once:
+                return self._bucket.upload_file(
+                    filename, content_type, path, force, resume=resume,
+                    data=data, md5=digests.get('md5'))
+
+    def upload(self, source, name=None, force=False):
+        """
+        Upload `source`, which may be either a URL or the path to a local file.
+        """
+        if URL_RE.match(source):
+            return self.upload_url(source, name, force=force)
+        elif isfile(source):
+            return self.upload_file(source, name, force=force)
+        else:
+            raise IOError(
+                '{} does not exist or is not a file!'.format(source))
+
+    def upload_many(self, sources, force=False,
+                    concurrency=DEFAULT_CONCURRENCY):
+        """
+        Upload each of `sources` (URLs or local paths), running up to
+        `concurrency` uploads at once against the shared bucket.
+
+        Yields an `UploadResult` for each source as its upload completes.
+        Failures are captured in the result rather than raised, so one bad
+        source does not abort the rest of the batch. The bucket is prepared
+        for the batch first, so that existence checks don't cost a request
+        per upload.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        def upload_one(source):
+            try:
+                return UploadResult(
+                    source, self.upload(source, force=force), None)
+            except Exception as error:  # pylint: disable=broad-except
+                LOG.debug("Failed to upload '%s'", source, exc_info=True)
+                return UploadResult(source, None, error)
+
+        self._bucket.prepare_batch()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = [pool.submit(upload_one, source) for source in sources]
+            for future in as_completed(futures):
+                yield future.result()
 
     def delete_file(self, remote_path):
         """
@@ -148,10 +382,16 @@ class GifShare(object):
         """
         Display the image with `name` in the user's browser.
         """
+        import webbrowser
+
         webbrowser.open_new(self.get_url(name))
 
-    def grep(self, pattern):
+    def grep(self, pattern, ignore_case=False, regex=False):
         """
         Return a list of all URLs containing `pattern`.
+
+        If `regex` is `True`, `pattern` is a regular expression. If
+        `ignore_case` is `True`, case is ignored.
         """
-        return list(self._bucket.grep(pattern))
+        return list(self._bucket.grep(
+            pattern, ignore_case=ignore_case, regex=regex))
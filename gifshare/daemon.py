@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+"""
+A long-running gifshare process which answers commands over a Unix socket.
+
+Every gifshare command normally pays for starting Python, importing boto,
+connecting to S3 and opening the key index before it does anything useful.
+`gifshare daemon` does all of that once, and then the command-line tool
+hands quick commands (such as `expand` and `grep`) to it.
+
+The protocol is a single line of JSON in each direction. The client sends
+`{"argv": [...], "store": {...}}` and the daemon replies with
+`{"status": <exit status>, "stdout": "...", "stderr": "..."}`.
+
+"store" holds the options which choose the store the command runs against
+(see `store_identity`). The daemon only runs commands for clients configured
+with the same store, and replies `{"refused": "..."}` to any other, which
+then runs the command itself.
+
+This module is imported by the command-line tool on every run, so the client
+side must stay cheap to import.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from contextlib import contextmanager
+import errno
+import json
+import logging
+import os
+from os.path import abspath, expanduser
+import socket
+import sys
+import threading
+
+
+LOG = logging.getLogger('gifshare.daemon')
+
+DEFAULT_SOCKET_PATH = '~/.gifshare.sock'
+DAEMON_COMMANDS = ('list', 'grep', 'expand', 'delete')
+CLIENT_TIMEOUT = 60
+# Errors from connecting to the socket which mean that no daemon is running:
+NOT_RUNNING_ERRORS = (errno.ENOENT, errno.ECONNREFUSED)
+# The options which choose the store that commands run against. Secrets
+# aren't sent: a different key for the same bucket is the same store.
+IDENTITY_OPTIONS = (
+    'storage', 'bucket', 'aws_access_id', 'endpoint_url', 'region',
+    'local_root', 'web_root', 'index')
+# Options naming files, which may be relative to the working directory:
+PATH_OPTIONS = ('local_root', 'index')
+
+
+def socket_path(config):
+    """
+    Return the path of the daemon's socket, from the 'daemon_socket' option in
+    `config` or the default.
+    """
+    if config.has_option('default', 'daemon_socket'):
+        return expanduser(config.get('default', 'daemon_socket'))
+    return expanduser(DEFAULT_SOCKET_PATH)
+
+
+def store_identity(config):
+    """
+    Return the options in `config` which identify the store that commands
+    run against, as a dict which can be sent to the daemon.
+    """
+    identity = {}
+    for name in IDENTITY_OPTIONS:
+        if config.has_option('default', name):
+            value = config.get('default', name)
+            if name in PATH_OPTIONS:
+                value = abspath(expanduser(value))
+            identity[name] = value
+    return identity
+
+
+def can_handle(arguments):
+    """
+    Return `True` if the daemon can run the command in the parsed
+    `arguments`. Commands which read from stdin are always run locally.
+    """
+    return (arguments.command in DAEMON_COMMANDS and
+            '-' not in getattr(arguments, 'paths', ()))
+
+
+def _read_line(sock):
+    """
+    Read a single newline-terminated message from `sock`.
+    """
+    data = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(data)
+
+
+def _exchange(path, message):
+    """
+    Send `message` to the daemon listening at `path`, returning its reply,
+    or `None` if no daemon is running.
+
+    Once the message has been sent, the daemon may act on it, so if no
+    reply arrives, DaemonError is raised rather than returning `None`.
+    """
+    from .exceptions import DaemonError
+
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CLIENT_TIMEOUT)
+        try:
+            sock.connect(path)
+        except socket.error as error:
+            if error.errno not in NOT_RUNNING_ERRORS:
+                raise DaemonError(
+                    "Couldn't connect to the gifshare daemon at {}: {}".format(
+                        path, error))
+            LOG.debug("No daemon is listening at %s", path, exc_info=True)
+            return None
+        try:
+            sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            return json.loads(_read_line(sock).decode('utf-8'))
+        except (socket.error, ValueError) as error:
+            raise DaemonError(
+                "The gifshare daemon at {} didn't answer ({}), so the "
+                "command may or may not have run".format(path, error))
+    finally:
+        sock.close()
+
+
+def request(path, argv, config):
+    """
+    Ask the daemon listening at `path` to run the command `argv` against the
+    store configured in `config`.
+
+    Returns the daemon's response, or `None` if no daemon is running or it
+    serves a different store, in which case the caller should run the
+    command itself. Raises DaemonError if the daemon was sent the command
+    but didn't answer.
+    """
+    response = _exchange(
+        path, {'argv': list(argv), 'store': store_identity(config)})
+    if response is not None and 'refused' in response:
+        LOG.debug("Daemon at %s refused the command: %s",
+                  path, response['refused'])
+        return None
+    return response
+
+
+class ThreadLocalStream(object):
+    """
+    A stand-in for sys.stdout or sys.stderr which sends output to a
+    per-thread buffer while one is being captured, so that concurrent
+    requests don't see each other's output.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def _stream(self):
+        return getattr(self._local, 'stream', None) or self._default
+
+    def write(self, text):
+        """
+        Write `text` to this thread's buffer, or the default stream.
+        """
+        return self._stream().write(text)
+
+    def flush(self):
+        """
+        Flush this thread's stream.
+        """
+        return self._stream().flush()
+
+    def isatty(self):
+        """
+        Captured output is never a terminal.
+        """
+        return False
+
+    @contextmanager
+    def capture(self):
+        """
+        Capture everything this thread writes, yielding the buffer.
+        """
+        from six import StringIO
+        self._local.stream = StringIO()
+        try:
+            yield self._local.stream
+        finally:
+            self._local.stream = None
+
+
+class Daemon(object):
+    """
+    Runs commands against a single, long-lived bucket connection.
+    """
+
+    def __init__(self, config, bucket=None):
+        from .cli import build_parser
+        from .storage import open_storage
+
+        self._config = config
+        self._identity = store_identity(config)
+        self._parser = build_parser()
+        self.bucket = bucket or open_storage(config, progress=False)
+        self._stdout = ThreadLocalStream(sys.stdout)
+        self._stderr = ThreadLocalStream(sys.stderr)
+
+    @contextmanager
+    def redirected(self):
+        """
+        Route sys.stdout and sys.stderr through per-thread buffers while the
+        daemon is running.
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def warm_up(self):
+        """
+        Connect to the bucket and bring the index up-to-date, so that the
+        first request is as quick as the rest.
+        """
+        self.bucket.warm_up()
+
+    def run(self, argv, store=None):
+        """
+        Run the command `argv` and return a response containing its exit
+        status and output.
+
+        `store` is the client's `store_identity`. If it doesn't match the
+        daemon's, the command is refused, so that it isn't run against the
+        wrong store.
+        """
+        from .exceptions import UserException
+
+        if store != self._identity:
+            return {'refused': "The daemon is configured for another store"}
+        with self._stdout.capture() as stdout, \
+                self._stderr.capture() as stderr:
+            try:
+                arguments = self._parser.parse_args(argv)
+                if arguments.command not in DAEMON_COMMANDS:
+                    raise UserException(
+                        "The daemon can't run '{}'".format(arguments.command))
+                arguments.target(arguments, self._config, bucket=self.bucket)
+                status = 0
+            except UserException as user_exception:
+                print(user_exception, file=sys.stderr)
+                status = 1
+            except SystemExit as exit_exception:
+                status = exit_exception.code
+            except Exception as error:  # pylint: disable=broad-except
+                LOG.exception("Error running %r", argv)
+                print("Error: {}".format(error), file=sys.stderr)
+                status = 1
+            return {
+                'status': status,
+                'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue(),
+            }
+
+
+def make_server(path, daemon):
+    """
+    Create a server listening on the Unix socket at `path`, handling each
+    connection in its own thread with `daemon`.
+    """
+    from six.moves import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        """
+        Handle a single request from the command-line client.
+        """
+
+        def handle(self):
+            try:
+                message = json.loads(self.rfile.readline().decode('utf-8'))
+                response = daemon.run(message['argv'], message.get('store'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                response = {
+                    'status': 2, 'stdout': '', 'stderr': 'Bad request\n'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """
+        A threaded Unix socket server.
+        """
+        daemon_threads = True
+
+    if os.path.exists(path):
+        if _exchange(path, {'argv': ['--version']}) is not None:
+            raise RuntimeError("A daemon is already listening on " + path)
+        os.unlink(path)
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    return server
+
+
+def serve(path, config):
+    """
+    Run a daemon listening on the Unix socket at `path` until interrupted.
+    """
+    daemon = Daemon(config)
+    daemon.warm_up()
+    server = make_server(path, daemon)
+    LOG.info("Listening on %s", path)
+    try:
+        with daemon.redirected():
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+Downloading images over HTTP.
+
+Downloads are streamed as they arrive. If the server supports byte ranges
+(it sends `Accept-Ranges: bytes`), a download which fails part-way through
+is resumed from where it stopped, rather than lost, and a large download can
+be split into several ranges which are fetched concurrently and reassembled
+in order.
+
+Requests are made with the shared, pooled session from gifshare.session,
+unless another session is given.
+
+Downloads are abandoned as early as possible if they can't be an image
+that gifshare will accept: as soon as the response headers show that they
+are text or too large, or once more than the maximum size has arrived.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import re
+
+from .exceptions import (
+    DownloadFailed, ImageTooLarge, ResumeFailed, UnknownFileType)
+from .progress import Progress
+from .timing import record
+
+
+LOG = logging.getLogger('gifshare.download')
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+MIN_RANGE_SIZE = 1024 * 1024
+MAX_RESUMES = 5
+DEFAULT_CONNECTIONS = 1
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-', re.IGNORECASE)
+
+
+def chunk_size_for(length):
+    """
+    Choose a download chunk size for a response of `length` bytes: roughly
+    a hundredth of the response, but never smaller than MIN_CHUNK_SIZE or
+    larger than MAX_CHUNK_SIZE.
+    """
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, length // 100))
+
+
+def is_identity(response):
+    """
+    Return `True` if the body of `response` isn't compressed.
+    """
+    return response.headers.get(
+        'content-encoding', 'identity').lower() == 'identity'
+
+
+def content_length(response):
+    """
+    Return the length of the body of `response` in bytes, or `None` if it
+    isn't known in advance. The length of a compressed body doesn't count,
+    because it is decompressed as it is read.
+    """
+    if not is_identity(response):
+        return None
+    try:
+        return int(response.headers['content-length'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def check_response(url, content_type, length, max_size=None):
+    """
+    Raise an exception if a response from `url` with the `content_type` and
+    `length` given in its headers can't be an acceptable image.
+    """
+    if content_type and content_type.lower().startswith('text/'):
+        raise UnknownFileType(
+            "{} isn't an image (it's {})".format(url, content_type))
+    if max_size is not None and length is not None and length > max_size:
+        raise ImageTooLarge(
+            "{} is {} bytes, which is larger than the maximum of {}".format(
+                url, length, max_size))
+
+
+def check_status(url, status, reason=None):
+    """
+    Raise DownloadFailed if a response from `url` has an error `status`.
+    """
+    if status >= 400:
+        raise DownloadFailed(url, status, reason)
+
+
+def check_size(url, size, max_size=None):
+    """
+    Raise an exception if `size` bytes downloaded from `url` is more than
+    `max_size`.
+    """
+    if max_size is not None and size > max_size:
+        raise ImageTooLarge(
+            "{} is larger than the maximum of {} bytes".format(url, max_size))
+
+
+def accepts_ranges(response):
+    """
+    Return `True` if `response` says its server supports byte-range
+    requests for the same URL, and ranges of it can be requested.
+
+    Ranges count bytes of the body as it was sent, so they can't be used to
+    resume a compressed body, whose bytes are counted after decompression.
+    """
+    return response.headers.get('accept-ranges', '').lower() == 'bytes' and \
+        is_identity(response)
+
+
+def range_validator(response):
+    """
+    Return a value for the If-Range header, so that ranges requested after
+    `response` are only returned if the image hasn't changed, or `None`.
+
+    Only strong ETags can be used with If-Range.
+    """
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def split_ranges(length, connections):
+    """
+    Split `length` bytes into up to `connections` (start, end) ranges, each
+    at least MIN_RANGE_SIZE long.
+    """
+    count = max(1, min(connections, length // MIN_RANGE_SIZE))
+    if count == 1:
+        return [(0, length)]
+    size = -(-length // count)
+    return [(start, min(start + size, length))
+            for start in range(0, length, size)]
+
+
+def request_range(session, url, start, end, validator=None):
+    """
+    Request bytes `start` to `end` (exclusive) of `url` with `session`,
+    returning the streamed response.
+
+    Raises ResumeFailed if the server sends anything but the range asked
+    for: in particular, the whole image (if it has changed since
+    `validator` was taken from it). Other failures raise IOError, so that
+    they are retried.
+    """
+    headers = {
+        'Range': 'bytes={}-{}'.format(start, '' if end is None else end - 1),
+        # Ranges must count the bytes of the image itself:
+        'Accept-Encoding': 'identity',
+    }
+    if validator:
+        headers['If-Range'] = validator
+    record(requests=1)
+    response = session.get(url, stream=True, headers=headers)
+    if response.status_code == 206:
+        match = CONTENT_RANGE_RE.match(
+            response.headers.get('content-range', ''))
+        if match and int(match.group(1)) == start and is_identity(response):
+            return response
+        response.close()
+        raise ResumeFailed(
+            "{} returned the wrong range (asked for bytes {}-, got {})".format(
+                url, start, response.headers.get('content-range')))
+    response.close()
+    if response.status_code in (200, 416):
+        raise ResumeFailed(
+            "{} changed while it was being downloaded (status {})".format(
+                url, response.status_code))
+    raise IOError(
+        "{} didn't return the requested range (status {})".format(
+            url, response.status_code))
+
+
+def iter_range(session, url, start, end, chunk_size, response=None,
+               validator=None, resumable=False):
+    """
+    Yield bytes `start` to `end` (exclusive, or `None` for the end of the
+    file) of `url` in chunks, reading from `response` first if it is given.
+
+    If the connection fails, or closes early, and the download is
+    `resumable`, the rest of the range is requested (up to MAX_RESUMES
+    times) and the download carries on from where it stopped.
+    """
+    position = start
+    resumes = 0
+    while True:
+        try:
+            if response is None:
+                response = request_range(
+                    session, url, position, end, validator)
+            for chunk in response.iter_content(chunk_size):
+                if end is not None:
+                    chunk = chunk[:end - position]
+                position += len(chunk)
+                yield chunk
+                if end is not None and position >= end:
+                    break
+            if end is None or position >= end:
+                return
+            raise IOError("The connection closed after {} of {} bytes".format(
+                position - start, end - start))
+        except IOError as error:
+            if not resumable or resumes >= MAX_RESUMES:
+                raise
+            resumes += 1
+            LOG.debug("Resuming download from byte %d after error: %s",
+                      position, error)
+        finally:
+            if response is not None:
+                response.close()
+                response = None
+
+
+def iter_ranges(session, url, response, ranges, chunk_size, validator):
+    """
+    Fetch each of `ranges` of `url` concurrently, yielding each range's
+    contents in order as it completes.
+
+    The first range is streamed from `response`, and the others are only
+    requested once its first chunk has been consumed, so nothing more is
+    fetched if the download is abandoned after looking at its first bytes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(start, end):
+        return b''.join(iter_range(
+            session, url, start, end, chunk_size, validator=validator,
+            resumable=True))
+
+    (start, end), rest = ranges[0], ranges[1:]
+    first = iter_range(
+        session, url, start, end, chunk_size, response, validator,
+        resumable=True)
+    try:
+        yield next(first, b'')
+        LOG.debug("Downloading %d more ranges concurrently", len(rest))
+        with ThreadPoolExecutor(max_workers=len(rest)) as pool:
+            futures = [pool.submit(fetch, start, end) for start, end in rest]
+            try:
+                for chunk in first:
+                    yield chunk
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        first.close()
+
+
+def iter_download(url, progress=True, connections=DEFAULT_CONNECTIONS,
+                  session=None, max_size=None):
+    """
+    Download an image from the provided `url`, yielding the file contents as
+    a series of `bytes` chunks as they arrive.
+
+    If the server supports ranges, an interrupted download is resumed, and
+    if `connections` is more than 1, a large image is fetched as that many
+    ranges at once. If `progress` is `False`, no progress bar is displayed.
+
+    The download is abandoned with an exception if the response is an error,
+    is text, or is (or turns out to be) more than `max_size` bytes. Closing
+    the generator also abandons the download.
+
+    Requests are made with `session`, or the shared session by default.
+    """
+    if session is None:
+        from .session import shared_session
+        session = shared_session()
+
+    LOG.debug("Downloading image ...")
+    record(requests=1)
+    response = session.get(url, stream=True)
+    try:
+        check_status(url, response.status_code, response.reason)
+        length = content_length(response)
+        check_response(
+            url, response.headers.get('content-type'), length, max_size)
+    except BaseException:
+        response.close()
+        raise
+    chunk_size = chunk_size_for(length or 0)
+    LOG.debug('Content length: %s, chunk size: %d', length, chunk_size)
+
+    resumable = accepts_ranges(response)
+    validator = range_validator(response) if resumable else None
+    ranges = split_ranges(length, connections) if resumable and length else []
+    if len(ranges) > 1:
+        chunks = iter_ranges(
+            session, url, response, ranges, chunk_size, validator)
+    else:
+        chunks = iter_range(
+            session, url, 0, length, chunk_size, response, validator, resumable)
+
+    i = 0
+    pbar = Progress('Downloading image ', length) if progress else None
+    try:
+        for chunk in chunks:
+            i += len(chunk)
+            check_size(url, i, max_size)
+            if pbar is not None:
+                pbar.update(i)
+            yield chunk
+    finally:
+        chunks.close()
+        if pbar is not None:
+            pbar.finish()
+
+
+def download_file(url, progress=True, connections=DEFAULT_CONNECTIONS,
+                  session=None, max_size=None):
+    """
+    Download an image from the provided `url` and return the file contents as
+    `bytes`.
+
+    If `progress` is `False`, no progress bar is displayed.
+    """
+    return b''.join(
+        iter_download(url, progress, connections, session, max_size))
@@ -36,3 +36,45 @@ class MissingFile(UserException):
     A UserException that indicates a requested file was missing from
     the server.
     """
+
+
+class InvalidPattern(UserException):
+    """
+    A UserException that indicates a search pattern could not be parsed.
+    """
+
+
+class ImageTooLarge(UserException):
+    """
+    A UserException that indicates an image being downloaded was larger than
+    the configured maximum size.
+    """
+
+
+class DownloadFailed(UserException):
+    """
+    A UserException that indicates the server an image was being downloaded
+    from answered with an error `status`.
+    """
+
+    def __init__(self, url, status, reason=None):
+        super(DownloadFailed, self).__init__(
+            "{} couldn't be downloaded: the server said {}{}".format(
+                url, status, ' ' + reason if reason else ''))
+        self.url = url
+        self.status = status
+
+
+class ResumeFailed(UserException):
+    """
+    A UserException that indicates part of an image couldn't be downloaded
+    again, because the server didn't return the part that was asked for
+    (usually because the image changed during the download).
+    """
+
+
+class DaemonError(UserException):
+    """
+    A UserException that indicates a command was sent to the gifshare daemon,
+    but no answer came back. The command may still have run.
+    """
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+A persistent, local index of the keys stored in a bucket.
+
+Listing a large bucket is slow and costs a LIST request for every thousand
+keys, so the `list`, `grep` and `list --random` commands answer from an
+SQLite database that is refreshed from S3 when it becomes stale, and kept
+up-to-date with gifshare's own uploads and deletes.
+
+Key names are also indexed by trigram, using SQLite's FTS5 trigram
+tokenizer, so that grep doesn't need to scan every name. If the installed
+SQLite doesn't support it, grep falls back to a scan.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from datetime import datetime
+import logging
+from os.path import expanduser
+import sqlite3
+import threading
+import time
+
+from .search import fts_query, matcher, query_literals
+
+
+LOG = logging.getLogger('gifshare.index')
+
+DEFAULT_INDEX_PATH = '~/.gifshare-index.sqlite'
+DEFAULT_INDEX_TTL = 300
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    id INTEGER PRIMARY KEY,
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    modified TEXT,
+    generation INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (bucket, name)
+);
+CREATE INDEX IF NOT EXISTS keys_etag ON keys (bucket, etag);
+CREATE TABLE IF NOT EXISTS refreshes (
+    bucket TEXT PRIMARY KEY,
+    refreshed REAL NOT NULL,
+    generation INTEGER NOT NULL
+);
+"""
+
+TRIGRAM_SCHEMA = """
+CREATE VIRTUAL TABLE key_names USING fts5(
+    name, content='keys', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS keys_insert AFTER INSERT ON keys BEGIN
+    INSERT INTO key_names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS keys_delete AFTER DELETE ON keys BEGIN
+    INSERT INTO key_names (key_names, rowid, name)
+    VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS keys_update AFTER UPDATE OF name ON keys BEGIN
+    INSERT INTO key_names (key_names, rowid, name)
+    VALUES ('delete', old.id, old.name);
+    INSERT INTO key_names (rowid, name) VALUES (new.id, new.name);
+END;
+INSERT INTO key_names (key_names) VALUES ('rebuild');
+"""
+
+UPSERT = """
+INSERT INTO keys (bucket, name, size, etag, modified, generation)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (bucket, name) DO UPDATE SET
+    size = excluded.size,
+    etag = excluded.etag,
+    modified = excluded.modified,
+    generation = excluded.generation
+"""
+
+
+def now_iso():
+    """
+    Return the current UTC time, formatted the same way as S3 formats
+    LastModified times.
+    """
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class KeyIndex(object):
+    """
+    An index of the names, sizes, ETags and modification times of the keys
+    in the bucket named `bucket_name`, stored in the SQLite database at
+    `path`. One database may hold indexes for several buckets.
+
+    The index is considered stale `ttl` seconds after it was last
+    refreshed. A KeyIndex may be shared between threads.
+    """
+
+    def __init__(self, path, bucket_name, ttl=DEFAULT_INDEX_TTL):
+        self.path = expanduser(path)
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._migrate()
+            self._db.executescript(SCHEMA)
+            self._trigrams = self._create_trigram_index()
+
+    def _migrate(self):
+        """
+        Discard an index created before keys had an `id` column (whose
+        trigram index used the implicit rowid, which VACUUM may change). It
+        is rebuilt by the next refresh.
+        """
+        columns = [row[1] for row in self._db.execute(
+            'PRAGMA table_info(keys)').fetchall()]
+        if columns and 'id' not in columns:
+            LOG.debug("Rebuilding the index in %s", self.path)
+            self._db.executescript(
+                'BEGIN;\n'
+                'DROP TABLE IF EXISTS key_names;\n'
+                'DROP TABLE keys;\n'
+                'DROP TABLE IF EXISTS refreshes;\n'
+                'COMMIT;\n')
+
+    def _create_trigram_index(self):
+        """
+        Create the trigram index if it doesn't already exist, returning
+        `False` if SQLite doesn't support it.
+        """
+        if self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'key_names'"
+        ).fetchall():
+            return True
+        try:
+            self._db.executescript(
+                'BEGIN;\n' + TRIGRAM_SCHEMA + 'COMMIT;\n')
+            return True
+        except sqlite3.OperationalError:
+            LOG.debug("Trigram index unavailable", exc_info=True)
+            self._db.rollback()
+            return False
+
+    def close(self):
+        """
+        Close the underlying database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, *params):
+        """
+        Run `sql`, returning all of the resulting rows.
+        """
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def refreshed(self):
+        """
+        Return the time (in seconds since the epoch) of the last complete
+        refresh, or `None` if the index has never been refreshed.
+        """
+        rows = self._query(
+            'SELECT refreshed FROM refreshes WHERE bucket = ?',
+            self.bucket_name)
+        # A refresh time of 0 means that the first refresh is running:
+        return rows[0][0] if rows and rows[0][0] else None
+
+    def is_stale(self):
+        """
+        Return `True` if the index should be refreshed before it is used.
+        """
+        refreshed = self.refreshed()
+        return refreshed is None or time.time() - refreshed > self.ttl
+
+    def refresh(self, keys):
+        """
+        Bring the index up-to-date with `keys`, an iterable over every boto
+        Key in the bucket.
+
+        Keys are written in batches as they are listed. Keys that were not
+        seen are only removed once the listing has completed, so an
+        interrupted refresh never loses entries.
+
+        The refresh's generation is published before listing starts, so
+        that keys added while it runs are kept, whether or not they were
+        listed.
+        """
+        with self._lock, self._db:
+            rows = self._db.execute(
+                'SELECT generation FROM refreshes WHERE bucket = ?',
+                (self.bucket_name,)).fetchall()
+            generation = (rows[0][0] if rows else 0) + 1
+            self._db.execute(
+                'INSERT INTO refreshes VALUES (?, 0, ?) '
+                'ON CONFLICT (bucket) DO UPDATE SET '
+                'generation = excluded.generation',
+                (self.bucket_name, generation))
+        LOG.debug("Refreshing index for '%s'", self.bucket_name)
+
+        count = 0
+        batch = []
+        for key in keys:
+            batch.append((
+                self.bucket_name, key.name, key.size, key.etag,
+                key.last_modified, generation))
+            if len(batch) >= BATCH_SIZE:
+                count += self._write_batch(batch)
+                batch = []
+        count += self._write_batch(batch)
+
+        with self._lock, self._db:
+            # Later generations belong to keys added by (or during) a
+            # refresh which started after this one:
+            self._db.execute(
+                'DELETE FROM keys WHERE bucket = ? AND generation < ?',
+                (self.bucket_name, generation))
+            self._db.execute(
+                'UPDATE refreshes SET refreshed = ? WHERE bucket = ?',
+                (time.time(), self.bucket_name))
+        LOG.debug("Indexed %d keys", count)
+        return count
+
+    def _write_batch(self, batch):
+        """
+        Upsert a batch of rows into the index.
+        """
+        with self._lock, self._db:
+            self._db.executemany(UPSERT, batch)
+        return len(batch)
+
+    def add(self, name, size=None, etag=None, modified=None):
+        """
+        Record that the key `name` has been uploaded. The key is given
+        the latest refresh's generation, so that a refresh which is
+        running doesn't remove it.
+        """
+        with self._lock, self._db:
+            rows = self._db.execute(
+                'SELECT generation FROM refreshes WHERE bucket = ?',
+                (self.bucket_name,)).fetchall()
+            self._db.execute(UPSERT, (
+                self.bucket_name, name, size, etag, modified or now_iso(),
+                rows[0][0] if rows else 0))
+
+    def remove(self, *names):
+        """
+        Record that the keys `names` have been deleted.
+        """
+        with self._lock, self._db:
+            self._db.executemany(
+                'DELETE FROM keys WHERE bucket = ? AND name = ?',
+                [(self.bucket_name, name) for name in names])
+
+    def __contains__(self, name):
+        return bool(self._query(
+            'SELECT 1 FROM keys WHERE bucket = ? AND name = ?',
+            self.bucket_name, name))
+
+    def __len__(self):
+        return self._query(
+            'SELECT COUNT(*) FROM keys WHERE bucket = ?',
+            self.bucket_name)[0][0]
+
+    def entries(self):
+        """
+        Return a dict mapping every key name in the index to its
+        (size, etag, modified) tuple.
+        """
+        return dict(
+            (row[0], tuple(row[1:])) for row in self._query(
+                'SELECT name, size, etag, modified FROM keys '
+                'WHERE bucket = ?', self.bucket_name))
+
+    def find_etag(self, etags):
+        """
+        Return the name of a key with any of the given `etags`, or `None`
+        if there isn't one. ETags are matched with or without quotes.
+        """
+        candidates = []
+        for etag in etags:
+            etag = etag.strip('"')
+            candidates.extend([etag, '"{}"'.format(etag)])
+        if not candidates:
+            return None
+        rows = self._query(
+            'SELECT name FROM keys WHERE bucket = ? AND etag IN ({}) '
+            'ORDER BY name LIMIT 1'.format(', '.join('?' * len(candidates))),
+            self.bucket_name, *candidates)
+        return rows[0][0] if rows else None
+
+    def names(self):
+        """
+        Return a list of all the key names in the index, in order.
+        """
+        return [row[0] for row in self._query(
+            'SELECT name FROM keys WHERE bucket = ? ORDER BY name',
+            self.bucket_name)]
+
+    def iter_names(self, batch_size=BATCH_SIZE):
+        """
+        Yield all the key names in the index, in order.
+
+        Names are read `batch_size` at a time, so the whole list is never
+        held in memory, and the database isn't locked between batches.
+        """
+        rows = self._query(
+            'SELECT name FROM keys WHERE bucket = ? ORDER BY name LIMIT ?',
+            self.bucket_name, batch_size)
+        while rows:
+            for row in rows:
+                yield row[0]
+            rows = self._query(
+                'SELECT name FROM keys WHERE bucket = ? AND name > ? '
+                'ORDER BY name LIMIT ?',
+                self.bucket_name, rows[-1][0], batch_size)
+
+    def boundaries(self, count):
+        """
+        Return up to `count - 1` key names which split the indexed names into
+        `count` roughly equal ranges, for partitioning a listing. Returns an
+        empty list if the index holds too few names to be worth splitting.
+        """
+        total = len(self)
+        if count < 2 or total < count * BATCH_SIZE:
+            return []
+        names = []
+        for i in range(1, count):
+            rows = self._query(
+                'SELECT name FROM keys WHERE bucket = ? ORDER BY name '
+                'LIMIT 1 OFFSET ?',
+                self.bucket_name, total * i // count)
+            if rows:
+                names.append(rows[0][0])
+        return names
+
+    def grep(self, pattern, ignore_case=False, regex=False):
+        """
+        Return a list of the key names matching `pattern`, in order.
+
+        By default, names containing `pattern` match. If `regex` is `True`,
+        `pattern` is a regular expression instead. If `ignore_case` is
+        `True`, case is ignored. Wherever possible, the trigram index is
+        used to avoid checking every name.
+        """
+        matches = matcher(pattern, ignore_case, regex)
+        literals = query_literals(pattern, regex)
+        if self._trigrams and literals:
+            names = self._query(
+                'SELECT name FROM keys WHERE bucket = ? AND id IN ('
+                'SELECT rowid FROM key_names WHERE key_names MATCH ?) '
+                'ORDER BY name',
+                self.bucket_name, fts_query(literals))
+        else:
+            names = self._query(
+                'SELECT name FROM keys WHERE bucket = ? ORDER BY name',
+                self.bucket_name)
+        return [row[0] for row in names if matches(row[0])]
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+A local journal of multipart uploads in progress.
+
+Each multipart upload of a local file is recorded in a journal file, along
+with the ETag of every part as it completes. If the upload is interrupted,
+the parts which were already sent stay in the bucket, and `gifshare upload
+--resume` uses the journal to find the upload and send only the missing
+parts.
+
+The journal is a log with one JSON record per line: an upload starting, or
+one of its parts completing. Recording a part only appends a
+line, however many parts there are. When an upload finishes, the log is
+rewritten with just the uploads still in progress.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+from os.path import abspath, expanduser
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the journal is only locked between
+    # threads.
+    fcntl = None
+
+
+LOG = logging.getLogger('gifshare.journal')
+
+DEFAULT_JOURNAL_PATH = '~/.gifshare-uploads.json'
+DEFAULT_STALE_UPLOAD_AGE = 7 * 24 * 60 * 60
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def fingerprint(path):
+    """
+    Return a dict identifying the current contents of the file at `path`,
+    without reading it.
+    """
+    stat = os.stat(path)
+    return {
+        'path': abspath(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+
+
+class UploadJournal(object):
+    """
+    A record of the multipart uploads in progress to the bucket named
+    `bucket_name`, stored in the journal file at `path`. One file may hold
+    the uploads for several buckets.
+
+    Every read and change of the file is made holding a lock, which is
+    taken with `flock` on `path` + '.lock' where that's available, so the
+    journal may be shared between threads and between processes.
+    """
+
+    def __init__(self, path, bucket_name):
+        self.path = expanduser(path)
+        self.bucket_name = bucket_name
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the journal's lock, excluding other threads and processes.
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _load(self):
+        """
+        Replay the journal file, returning a dict mapping each upload's key
+        to its entry. Lines which can't be read (such as one left half-written
+        by a crash) are skipped.
+        """
+        entries = {}
+        try:
+            with open(self.path) as journal:
+                lines = journal.readlines()
+        except (IOError, OSError):
+            return entries
+        for line in lines:
+            try:
+                record = json.loads(line)
+                op, key = record.pop('op'), record.pop('key')
+            except (ValueError, TypeError, AttributeError, KeyError):
+                continue
+            if op == 'start':
+                record.setdefault('parts', {})
+                entries[key] = record
+                continue
+            entry = entries.get(key)
+            if op == 'part' and entry is not None and \
+                    record.get('upload_id') == entry['upload_id']:
+                entry['parts'][str(record['number'])] = record['etag']
+        return entries
+
+    def _append(self, record):
+        """
+        Add `record` to the end of the journal file, on a line of its own
+        even if the last line was left unfinished.
+        """
+        line = json.dumps(record, sort_keys=True).encode('utf-8') + b'\n'
+        with open(self.path, 'ab+') as journal:
+            journal.seek(0, os.SEEK_END)
+            if journal.tell():
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    line = b'\n' + line
+            journal.write(line)
+
+    def _save(self, entries):
+        """
+        Atomically replace the journal file with a start record for each of
+        `entries`.
+        """
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as journal:
+                for key, entry in sorted(entries.items()):
+                    journal.write(json.dumps(
+                        dict(entry, op='start', key=key),
+                        sort_keys=True) + '\n')
+            _replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _key(self, name):
+        return '{}/{}'.format(self.bucket_name, name)
+
+    def start(self, name, upload_id, source, part_size):
+        """
+        Record that a multipart upload `upload_id` of the file with
+        `source` fingerprint has been started to the key `name`.
+        """
+        with self._locked():
+            self._append(dict(
+                source, op='start', key=self._key(name), upload_id=upload_id,
+                part_size=part_size, started=time.time(), parts={}))
+
+    def record_part(self, name, upload_id, number, etag):
+        """
+        Record that part `number` of the upload `upload_id` to `name` was
+        uploaded with `etag`.
+        """
+        with self._locked():
+            self._append({
+                'op': 'part', 'key': self._key(name), 'upload_id': upload_id,
+                'number': number, 'etag': etag.strip('"')})
+
+    def finish(self, name, upload_id=None):
+        """
+        Remove the upload to `name` from the journal, because it has been
+        completed or cancelled. If `upload_id` is given, the entry is only
+        removed if it is for that upload.
+        """
+        with self._locked():
+            entries = self._load()
+            entry = entries.get(self._key(name))
+            if entry is not None and upload_id in (None, entry['upload_id']):
+                del entries[self._key(name)]
+            self._save(entries)
+
+    def get(self, name):
+        """
+        Return the journal entry for the upload to `name`, or `None`.
+        """
+        with self._locked():
+            return self._load().get(self._key(name))
+
+    def uploads(self):
+        """
+        Return a dict mapping the key name of every upload in this bucket's
+        journal to its entry.
+        """
+        prefix = self.bucket_name + '/'
+        with self._locked():
+            return dict(
+                (key[len(prefix):], entry)
+                for key, entry in self._load().items()
+                if key.startswith(prefix))
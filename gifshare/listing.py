@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent listing of a bucket's keys.
+
+S3 returns a thousand keys per LIST request, and each request needs the last
+key of the one before, so listing a large bucket one page at a time is bound
+by request latency. Instead, the keyspace is split into partitions which are
+listed concurrently, each in its own thread, and their keys are merged:
+
+* With a delimiter, each common prefix under the delimiter (each top-level
+  "directory") is a partition.
+* Otherwise, the keyspace is split into ranges of names between boundaries.
+  Good boundaries (which split the bucket evenly) can be taken from the
+  local index. Without them, the names are split by their first character.
+
+Partitions are listed by a fixed pool of worker threads, however many
+partitions there are, and each worker stops listing once a few pages of its
+partition are waiting to be consumed, so a listing never holds more than a
+few pages per worker in memory.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import namedtuple
+import logging
+import string
+import threading
+
+from six.moves import queue
+
+from . import timing
+
+
+LOG = logging.getLogger('gifshare.listing')
+
+DEFAULT_LIST_CONCURRENCY = 4
+PAGE_SIZE = 1000
+MAX_BUFFERED_PAGES = 4
+STOP_POLL_INTERVAL = 0.1
+ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+_DONE = object()
+
+
+Partition = namedtuple('Partition', ['prefix', 'lower', 'upper'])
+Partition.__doc__ = """
+The keys starting with `prefix`, whose names are greater than `lower` and no
+greater than `upper`. Either bound may be `None`.
+"""
+
+
+class _Failure(object):
+    """
+    Carries an exception raised while listing a partition to the consumer.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def default_boundaries(count):
+    """
+    Return `count - 1` boundaries which split ALPHABET into `count` roughly
+    equal ranges.
+    """
+    count = min(max(1, count), len(ALPHABET))
+    return [ALPHABET[len(ALPHABET) * i // count] for i in range(1, count)]
+
+
+def range_partitions(boundaries):
+    """
+    Return the partitions covering the whole keyspace, split at the sorted
+    `boundaries`.
+    """
+    bounds = [None] + sorted(set(boundaries)) + [None]
+    return [Partition('', lower, upper)
+            for lower, upper in zip(bounds, bounds[1:])]
+
+
+def partition_pages(bucket, partition, stop=None):
+    """
+    Yield the keys in `partition` of the boto `bucket`, as lists of up to
+    PAGE_SIZE keys, until the partition is exhausted or the `stop` event is
+    set.
+    """
+    page = []
+    for key in bucket.list(
+            prefix=partition.prefix, marker=partition.lower or ''):
+        if partition.lower is not None and key.name <= partition.lower:
+            continue
+        if partition.upper is not None and key.name > partition.upper:
+            break
+        page.append(key)
+        if len(page) >= PAGE_SIZE:
+            yield page
+            page = []
+            if stop is not None and stop.is_set():
+                return
+    if page:
+        yield page
+
+
+class _Lister(object):
+    """
+    Lists partitions in a pool of up to `concurrency` worker threads, which
+    take partitions in the order they were started, and send their pages to
+    a queue as they arrive.
+    """
+
+    def __init__(self, bucket, concurrency):
+        self._bucket = bucket
+        self.concurrency = max(1, concurrency)
+        self._jobs = queue.Queue()
+        self._workers = []
+        self._within = timing.current()
+        self.stop = threading.Event()
+
+    def pages(self):
+        """
+        Return a new queue for the pages of one partition.
+        """
+        return queue.Queue(MAX_BUFFERED_PAGES)
+
+    def start(self, partition, pages):
+        """
+        List `partition` in a worker as soon as one is free, putting each
+        page on the queue `pages` followed by _DONE.
+        """
+        self._jobs.put((partition, pages))
+        if len(self._workers) < self.concurrency:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self):
+        """
+        Stop listing, and let the workers exit.
+        """
+        self.stop.set()
+        for _ in self._workers:
+            self._jobs.put(None)
+
+    def _put(self, pages, item):
+        """
+        Put `item` on the queue `pages`, waiting while it is full, unless
+        the listing is stopped. Returns `False` if it was stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                pages.put(item, timeout=STOP_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _work(self):
+        """
+        List partitions until the listing is closed.
+        """
+        while True:
+            job = self._jobs.get()
+            if job is None or self.stop.is_set():
+                return
+            partition, pages = job
+            with timing.span('s3.list_partition', self._within):
+                try:
+                    for page in partition_pages(
+                            self._bucket, partition, self.stop):
+                        if not self._put(pages, page):
+                            return
+                except Exception as error:  # pylint: disable=broad-except
+                    self._put(pages, _Failure(error))
+                self._put(pages, _DONE)
+
+
+def _drain(pages, partitions=1):
+    """
+    Yield the keys from the queue `pages` until `partitions` partitions have
+    finished.
+    """
+    while partitions:
+        page = pages.get()
+        if page is _DONE:
+            partitions -= 1
+        elif isinstance(page, _Failure):
+            raise page.error
+        else:
+            for key in page:
+                yield key
+
+
+def _list_by_delimiter(lister, bucket, delimiter, ordered):
+    """
+    Yield the keys in `bucket`, listing the keys under each common prefix
+    (up to `delimiter`) as a separate partition.
+    """
+    # The top level is listed with the delimiter, which returns the keys at
+    # the top level along with the common prefixes, in order:
+    segments = []
+    shared = queue.Queue(MAX_BUFFERED_PAGES * lister.concurrency)
+    started = 0
+    for item in bucket.list(delimiter=delimiter):
+        if hasattr(item, 'size'):
+            segments.append(item)
+            if not ordered:
+                yield item
+        else:
+            pages = lister.pages() if ordered else shared
+            lister.start(Partition(item.name, None, None), pages)
+            segments.append(pages)
+            started += 1
+    LOG.debug("Listing %d prefixes", started)
+
+    if not ordered:
+        for key in _drain(shared, started):
+            yield key
+        return
+
+    for segment in segments:
+        if isinstance(segment, queue.Queue):
+            for key in _drain(segment):
+                yield key
+        else:
+            yield segment
+
+
+def list_keys(bucket, concurrency=DEFAULT_LIST_CONCURRENCY, delimiter=None,
+              boundaries=None, ordered=True):
+    """
+    Yield every key in the boto `bucket`, listing up to `concurrency`
+    partitions at once.
+
+    If `delimiter` is given, the keys under each common prefix are listed
+    as a partition. Otherwise the keyspace is split at `boundaries` (or at
+    `default_boundaries`). If `ordered` is `True`, keys are yielded in name
+    order, as a plain listing would; otherwise they are yielded as soon as
+    they arrive.
+    """
+    if concurrency <= 1 and not delimiter:
+        for key in bucket.list():
+            yield key
+        return
+
+    lister = _Lister(bucket, concurrency)
+    try:
+        if delimiter:
+            for key in _list_by_delimiter(lister, bucket, delimiter, ordered):
+                yield key
+            return
+
+        partitions = range_partitions(
+            boundaries or default_boundaries(concurrency))
+        LOG.debug("Listing %d partitions", len(partitions))
+        if ordered:
+            queues = [lister.pages() for _ in partitions]
+            for partition, pages in zip(partitions, queues):
+                lister.start(partition, pages)
+            for pages in queues:
+                for key in _drain(pages):
+                    yield key
+        else:
+            shared = queue.Queue(MAX_BUFFERED_PAGES * lister.concurrency)
+            for partition in partitions:
+                lister.start(partition, shared)
+            for key in _drain(shared, len(partitions)):
+                yield key
+    finally:
+        lister.close()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storing images in a local directory.
+
+LocalDirectory keeps images in a directory on disk, for a web server to
+serve (or for testing without S3). Every write goes to a temporary file
+beside its destination, which is then renamed into place, so readers never
+see a partial image. Without `force`, the temporary file is hard-linked to
+its destination instead, which fails if the destination exists, so two
+uploads of the same name can't overwrite each other.
+
+Local files are copied with sendfile where the OS supports it, so their
+contents are never read into Python.
+
+The MD5 digest of every stored file is kept in the key index, so that
+finding a duplicate doesn't mean reading the whole directory. Files are only
+hashed again when their size or modification time changes.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import binascii
+from collections import namedtuple
+from datetime import datetime
+import errno
+import hashlib
+import logging
+import os
+from os.path import abspath, expanduser
+import shutil
+import tempfile
+import time
+
+from six.moves.urllib.request import pathname2url
+
+from .core import config_option, load_config
+from .exceptions import FileAlreadyExists, MissingFile, UserException
+from .index import KeyIndex, DEFAULT_INDEX_PATH, DEFAULT_INDEX_TTL
+from .journal import DEFAULT_STALE_UPLOAD_AGE
+from . import timing
+from .storage import Storage
+
+
+LOG = logging.getLogger('gifshare.local')
+
+TEMP_PREFIX = '.gifshare-'
+TEMP_SUFFIX = '.tmp'
+FILE_MODE = 0o644
+COPY_BUFFER_SIZE = 1024 * 1024
+# Errors from os.link meaning that the filesystem can't make hard links:
+NO_LINK_ERRORS = (errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS, errno.EXDEV)
+# Errors from os.sendfile meaning that it can't copy between these files:
+NO_SENDFILE_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK)
+
+_replace = getattr(os, 'replace', os.rename)
+
+IndexedFile = namedtuple(
+    'IndexedFile', ['name', 'size', 'etag', 'last_modified'])
+
+
+def copy_data(source, destination):
+    """
+    Copy everything from the file object `source` to `destination`,
+    returning the number of bytes copied. The copy is made by the kernel
+    with sendfile if possible.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None:
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = sendfile(destination.fileno(), source.fileno(),
+                                offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            return offset
+        except OSError as error:
+            if offset or error.errno not in NO_SENDFILE_ERRORS:
+                raise
+    shutil.copyfileobj(source, destination, COPY_BUFFER_SIZE)
+    return destination.tell()
+
+
+def _unlink(path):
+    """
+    Delete the file at `path`, if there is one.
+    """
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def _makedirs(path):
+    """
+    Create the directory `path` and its parents, if they don't exist.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _is_temp(filename):
+    return filename.startswith(TEMP_PREFIX) and filename.endswith(TEMP_SUFFIX)
+
+
+def _modified(stat):
+    """
+    Return the modification time in `stat` as a string for the index, to
+    the microsecond, so that rewritten files are noticed.
+    """
+    return datetime.utcfromtimestamp(stat.st_mtime).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def file_md5(path):
+    """
+    Return the hex MD5 digest of the file at `path`.
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as stored:
+        for chunk in iter(lambda: stored.read(COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalDirectory(Storage):
+    """
+    Stores images in a local directory.
+
+    Should be initialised with a ConfigParser instance containing:
+
+    * local_root - the directory to store images in, which is created if
+      it doesn't exist
+
+    And optionally:
+
+    * web_root - the URL `local_root` is served from. Defaults to a file://
+      URL for the directory.
+    * stale_upload_age - the age, in seconds, after which `cleanup_uploads`
+      deletes the temporary files left by interrupted uploads
+    * index - the path to the index database holding the stored files'
+      digests, or 'off' to compare a new image with every stored file of
+      the same size when deduplicating
+    * index_ttl - the number of seconds before the index is checked for
+      files changed by other programs
+
+    Content types aren't stored: the web server serving the directory
+    should choose them from the file extension (which gifshare always
+    corrects).
+
+    A single LocalDirectory may be shared between threads and processes.
+    """
+
+    def __init__(self, config=None, progress=True):
+        if config is None:
+            config = load_config()
+        self.progress = progress
+        self.root = abspath(expanduser(config.get('default', 'local_root')))
+        _makedirs(self.root)
+        self._web_root = config_option(
+            config, 'web_root', 'file://' + pathname2url(self.root) + '/')
+        self._stale_upload_age = config_option(
+            config, 'stale_upload_age', DEFAULT_STALE_UPLOAD_AGE, int)
+        self.index = None
+        index_path = config_option(config, 'index', DEFAULT_INDEX_PATH)
+        if index_path and index_path.lower() != 'off':
+            # Bucket names can't contain ':', so this can't clash with one:
+            self.index = KeyIndex(
+                index_path, 'local:' + self.root,
+                config_option(config, 'index_ttl', DEFAULT_INDEX_TTL, int))
+
+    def _path(self, name):
+        """
+        Return the path of the file called `name`, refusing names which
+        would be stored outside the root directory.
+        """
+        path = os.path.normpath(os.path.join(self.root, *name.split('/')))
+        if not path.startswith(self.root + os.sep):
+            raise UserException("'{}' is not a valid image name".format(name))
+        return path
+
+    def _name(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _store(self, filename, force, span, fill):
+        """
+        Store `filename` atomically, by calling `fill` with a temporary file
+        (which it writes to, returning the number of bytes written) and then
+        moving the temporary file into place. Returns the new URL.
+        """
+        path = self._path(filename)
+        if not force and os.path.exists(path):
+            raise FileAlreadyExists(
+                "File at {} already exists!".format(self.url_for(filename)))
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        with timing.span(span):
+            handle, temp = tempfile.mkstemp(
+                prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX, dir=directory)
+            try:
+                with os.fdopen(handle, 'wb') as destination:
+                    size = fill(destination)
+                os.chmod(temp, FILE_MODE)
+                self._commit(temp, path, filename, force)
+            finally:
+                _unlink(temp)
+            timing.record(size=size)
+        return self.url_for(filename)
+
+    def _commit(self, temp, path, filename, force):
+        """
+        Move the finished temporary file `temp` to `path`, without
+        overwriting an existing file unless `force` is `True`.
+        """
+        if force:
+            _replace(temp, path)
+            return
+        try:
+            os.link(temp, path)
+        except OSError as error:
+            if error.errno != errno.EEXIST and \
+                    error.errno not in NO_LINK_ERRORS:
+                raise
+            # The filesystem can't make hard links, so check, then rename:
+            if error.errno == errno.EEXIST or os.path.exists(path):
+                raise FileAlreadyExists("File at {} already exists!".format(
+                    self.url_for(filename)))
+            _replace(temp, path)
+
+    def _record(self, name, etag=None):
+        """
+        Add the stored file `name`, with the hex MD5 digest `etag` (if it's
+        known), to the index.
+        """
+        if self.index is None:
+            return
+        try:
+            stat = os.stat(self._path(name))
+        except OSError:
+            return
+        self.index.add(name, stat.st_size, etag, _modified(stat))
+
+    def upload_stream(self, filename, content_type, chunks, force=False):
+        """
+        Store the image data in `chunks` as `filename`, returning its URL.
+        """
+        digest = hashlib.md5()
+
+        def fill(destination):
+            size = 0
+            for chunk in chunks:
+                destination.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            return size
+
+        url = self._store(filename, force, 'local.put', fill)
+        self._record(filename, digest.hexdigest())
+        return url
+
+    def upload_file(self, filename, content_type, path, force=False,
+                    resume=False, data=None, md5=None):
+        """
+        Copy the local file at `path` to `filename`, returning its URL.
+
+        If the file has already been mapped, `data` is written, and `md5`
+        (if given) saves hashing it again. Otherwise the copy is made by
+        the kernel, from the file. Copies are never partly made, so there's
+        nothing to resume.
+        """
+        if data is None:
+            with open(path, 'rb') as source:
+                url = self._store(
+                    filename, force, 'local.put',
+                    lambda destination: copy_data(source, destination))
+            # Hashed by the next refresh of the index:
+            self._record(filename)
+            return url
+
+        def fill(destination):
+            destination.write(data)
+            return len(data)
+
+        url = self._store(filename, force, 'local.put', fill)
+        if self.index is not None:
+            self._record(filename, binascii.hexlify(md5).decode('ascii')
+                         if md5 else hashlib.md5(data).hexdigest())
+        return url
+
+    def copy_file(self, source, filename, content_type, force=False):
+        """
+        Copy the stored file `source` to `filename`, returning the new URL.
+        """
+        try:
+            original = open(self._path(source), 'rb')
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            raise MissingFile("The image '%s' does not exist" % source)
+        with original:
+            LOG.debug("Copying '%s' to '%s'", source, filename)
+            url = self._store(
+                filename, force, 'local.copy',
+                lambda destination: copy_data(original, destination))
+        self._record(filename)
+        return url
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def _walk(self):
+        """
+        Yield the path of every stored file, and its temporary files.
+        """
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                yield os.path.join(directory, filename)
+
+    def names(self):
+        return iter(sorted(
+            self._name(path) for path in self._walk()
+            if not _is_temp(os.path.basename(path))))
+
+    def delete(self, name):
+        with timing.span('local.delete'):
+            _unlink(self._path(name))
+        if self.index is not None:
+            self.index.remove(name)
+
+    def url_for(self, name):
+        return self._web_root + name
+
+    def refresh_index(self, force=True):
+        """
+        Bring the index up-to-date with the directory, hashing the files
+        which are new, or have changed since they were indexed. Unless
+        `force` is `True`, the index is only refreshed if it is stale. Does
+        nothing if the index is disabled.
+        """
+        if self.index is not None and (force or self.index.is_stale()):
+            with timing.span('index.refresh'):
+                self.index.refresh(self._indexed_files(self.index.entries()))
+
+    def _indexed_files(self, known):
+        """
+        Yield an IndexedFile for every stored file, reusing the digests in
+        `known` (a dict from `KeyIndex.entries`) for unchanged files.
+        """
+        for path in self._walk():
+            if _is_temp(os.path.basename(path)):
+                continue
+            name = self._name(path)
+            try:
+                stat = os.stat(path)
+                size, modified = stat.st_size, _modified(stat)
+                indexed = known.get(name)
+                if indexed is not None and indexed[1] and \
+                        indexed[0] == size and indexed[2] == modified:
+                    etag = indexed[1]
+                else:
+                    etag = file_md5(path)
+            except (IOError, OSError):
+                # Deleted since it was listed.
+                continue
+            yield IndexedFile(name, size, etag, modified)
+
+    def find_duplicate(self, chunks, digests=None):
+        """
+        Return the name of a stored file with the same contents as the data
+        in `chunks`, or `None` if there isn't one.
+
+        The file is found by its digest in the index (and read once, to
+        make sure that it hasn't changed). Without the index, every stored
+        file of the same size is read.
+        """
+        digest = hashlib.md5()
+        size = 0
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+        if digests is not None:
+            digests['md5'] = digest.digest()
+        if self.index is None:
+            return self._scan_for_duplicate(digest.hexdigest(), size)
+
+        self.refresh_index(force=False)
+        for _ in range(2):
+            name = self.index.find_etag([digest.hexdigest()])
+            if name is None:
+                return None
+            try:
+                if file_md5(self._path(name)) == digest.hexdigest():
+                    return name
+            except (IOError, OSError):
+                pass
+            # Changed by another program since the index was refreshed:
+            self.refresh_index(force=True)
+        return None
+
+    def _scan_for_duplicate(self, hexdigest, size):
+        """
+        Return the name of a stored file of `size` bytes with the hex MD5
+        digest `hexdigest`, reading every file of that size.
+        """
+        for name in self.names():
+            path = self._path(name)
+            try:
+                if os.path.getsize(path) != size:
+                    continue
+                if file_md5(path) == hexdigest:
+                    return name
+            except (IOError, OSError):
+                # Deleted since it was listed.
+                continue
+        return None
+
+    def cleanup_uploads(self, max_age=None):
+        """
+        Delete the temporary files of uploads which were interrupted more
+        than `max_age` seconds ago (by default, `stale_upload_age`),
+        returning their names.
+        """
+        if max_age is None:
+            max_age = self._stale_upload_age
+        cutoff = time.time() - max_age
+        removed = []
+        for path in self._walk():
+            if not _is_temp(os.path.basename(path)):
+                continue
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                _unlink(path)
+            except OSError:
+                continue
+            removed.append(self._name(path))
+        return sorted(removed)
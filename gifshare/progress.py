@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+Terminal progress display for gifshare.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+from timeit import default_timer
+
+
+UPDATE_INTERVAL = 0.1
+
+
+def is_interactive():
+    """
+    Return `True` if stdout is attached to a terminal, and so progress should
+    be displayed.
+    """
+    isatty = getattr(sys.stdout, 'isatty', None)
+    return bool(isatty and isatty())
+
+
+class Progress(object):
+    """
+    A progress bar labelled with `label`, counting up to `total` (or just
+    showing activity, if `total` is `None`).
+
+    Redraws are rate-limited to one every `interval` seconds, so it is cheap
+    to call `update` very frequently. If stdout is not a terminal, nothing is
+    displayed at all.
+    """
+
+    def __init__(self, label, total, interval=UPDATE_INTERVAL):
+        self._interval = interval
+        self._last_update = None
+        self._pbar = None
+        if is_interactive():
+            import progressbar
+
+            if total is None:
+                widgets = [label, progressbar.AnimatedMarker()]
+                total = progressbar.UnknownLength
+            else:
+                widgets = [label, progressbar.Bar(), progressbar.Percentage()]
+            self._pbar = progressbar.ProgressBar(
+                widgets=widgets, maxval=total)
+            self._pbar.start()
+
+    def update(self, value):
+        """
+        Record that `value` out of the total has been completed, redrawing
+        the progress bar if it hasn't been redrawn recently.
+        """
+        if self._pbar is None:
+            return
+        now = default_timer()
+        if (self._last_update is None or
+                now - self._last_update >= self._interval):
+            self._last_update = now
+            self._pbar.update(value)
+
+    def finish(self):
+        """
+        Complete and dispose of the progress bar.
+        """
+        if self._pbar is not None:
+            self._pbar.finish()
+            self._pbar = None
@@ -6,21 +6,133 @@ Functionality specific to Amazon S3 storage.
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import base64
+import binascii
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import itertools
 import json
 import logging
-import sys
+import threading
 
+from boto.exception import S3ResponseError
 from boto.s3.key import Key
-from boto.s3.connection import S3Connection
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from boto.s3.multipart import MultiPartUpload
 from boto.s3.website import WebsiteConfiguration
+from boto.utils import compute_md5, parse_ts
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from six import BytesIO
+from six.moves.urllib.parse import urlsplit
+
+from .core import (
+    DEFAULT_CONCURRENCY, load_config, config_option, map_file, parse_size)
+from .exceptions import FileAlreadyExists
+from .index import KeyIndex, DEFAULT_INDEX_PATH, DEFAULT_INDEX_TTL
+from .journal import (
+    UploadJournal, fingerprint, DEFAULT_JOURNAL_PATH, DEFAULT_STALE_UPLOAD_AGE)
+from .listing import DEFAULT_LIST_CONCURRENCY, list_keys
+from .progress import Progress
+from . import timing
+from .storage import DeleteResult, Storage
+from .throttle import Throttle
 
-import progressbar
 
-from .core import load_config
-from .exceptions import FileAlreadyExists, MissingFile
+LOG = logging.getLogger('gifshare.s3')
 
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+DEFAULT_MULTIPART_CONCURRENCY = 4
+EXISTENCE_CHECKS = ('conditional', 'head')
+MAX_DELETE_BATCH = 1000
 
-LOG = logging.getLogger('gifshare.s3')
+
+def endpoint_options(endpoint):
+    """
+    Return the S3Connection arguments for connecting to an S3-compatible
+    service at the URL `endpoint` (e.g. "http://localhost:5000") instead of
+    Amazon S3, or no arguments if `endpoint` isn't set.
+    """
+    if not endpoint:
+        return {}
+    parts = urlsplit(endpoint)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("endpoint_url must be an http or https URL")
+    options = {
+        'host': parts.hostname,
+        'is_secure': parts.scheme == 'https',
+        'calling_format': OrdinaryCallingFormat(),
+    }
+    if parts.port:
+        options['port'] = parts.port
+    return options
+
+
+@contextmanager
+def precondition(url):
+    """
+    Convert a failed conditional write to `url` into a FileAlreadyExists
+    exception.
+    """
+    try:
+        yield
+    except S3ResponseError as error:
+        if error.status == 412:
+            raise FileAlreadyExists("File at {} already exists!".format(url))
+        raise
+
+
+def content_etags(chunks, part_size, multipart_threshold):
+    """
+    Calculate the ETags S3 would give the data in `chunks` if it was
+    uploaded by gifshare: the MD5 of the data, and, if it is large enough
+    to be uploaded in parts of `part_size`, the multipart ETag (the MD5 of
+    the parts' MD5s, followed by the number of parts).
+
+    Returns a list of the possible (unquoted) ETags.
+    """
+    whole = hashlib.md5()
+    part_digests = []
+    part = hashlib.md5()
+    part_length = 0
+    size = 0
+    for chunk in chunks:
+        whole.update(chunk)
+        size += len(chunk)
+        view = memoryview(chunk)
+        while view:
+            taken = view[:part_size - part_length]
+            part.update(taken)
+            part_length += len(taken)
+            view = view[len(taken):]
+            if part_length == part_size:
+                part_digests.append(part.digest())
+                part = hashlib.md5()
+                part_length = 0
+    if part_length or not part_digests:
+        part_digests.append(part.digest())
+
+    etags = [whole.hexdigest()]
+    if size >= multipart_threshold:
+        etags.append('{}-{}'.format(
+            hashlib.md5(b''.join(part_digests)).hexdigest(),
+            len(part_digests)))
+    return etags
+
+
+def buffer_md5(data, digest=None):
+    """
+    Return the MD5 of the buffer `data`, as the (hex digest, base64 digest)
+    pair that boto accepts in place of calculating it itself. If the MD5
+    `digest` is already known, it is used instead of reading `data`.
+    """
+    if digest is None:
+        digest = hashlib.md5(data).digest()
+    return (binascii.hexlify(digest).decode('ascii'),
+            base64.b64encode(digest).decode('ascii'))
 
 
 def upload_callback():
@@ -32,7 +144,6 @@ def upload_callback():
     called with update == total.
     """
     pbar = [None]
-    widgets = ['Uploading image ', progressbar.Bar(), progressbar.Percentage()]
 
     def callback(update, total):
         """
@@ -40,8 +151,7 @@ def upload_callback():
         progress bar.
         """
         if pbar[0] is None:
-            pbar[0] = progressbar.ProgressBar(widgets=widgets, maxval=total)
-            pbar[0].start()
+            pbar[0] = Progress('Uploading image ', total)
         else:
             pbar[0].update(update)
         if update == total:
@@ -50,7 +160,7 @@ def upload_callback():
     return callback
 
 
-class Bucket(object):
+class Bucket(Storage):
     """
     Encapsulation of various operations on an S3 bucket.
 
@@ -61,18 +171,86 @@ class Bucket(object):
     * aws_secret_access_key
     * bucket
     * web_root
+
+    The following items are optional, and control multipart uploads of
+    large files:
+
+    * multipart_threshold - files at least this big are uploaded in parts
+    * multipart_chunksize - the size of each part
+    * multipart_concurrency - the number of parts uploaded at once
+
+    Listing and searching is answered from a local index of the bucket's
+    keys, controlled by:
+
+    * index - the path to the index database, or 'off' to always list the
+      bucket directly
+    * index_ttl - the number of seconds before the index is refreshed
+
+    Unless forced, uploads never overwrite existing files. How this is
+    checked is controlled by:
+
+    * existence_check - 'conditional' (the default) sends a single
+      conditional PUT which S3 rejects if the file already exists. 'head'
+      checks with a HEAD request before each upload, for S3-compatible
+      stores that don't support conditional writes.
+
+    In either case, files the index knows about are rejected without
+    making any requests.
+
+    If `progress` is `False`, no progress bars are displayed during uploads.
+    A single Bucket may be shared between threads.
     """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, progress=True):
         if config is None:
             config = load_config()
+        self.progress = progress
         self._bucket = None
+        self._bucket_lock = threading.Lock()
         self._key_id = config.get('default', 'aws_access_id')
         self._access_key = config.get('default', 'aws_secret_access_key')
         self._bucket_name = config.get('default', 'bucket')
         self._web_root = config.get('default', 'web_root')
-
-        self._connection = S3Connection(self._key_id, self._access_key)
+        self._multipart_threshold = config_option(
+            config, 'multipart_threshold', DEFAULT_MULTIPART_THRESHOLD,
+            parse_size)
+        self._multipart_chunksize = max(MIN_PART_SIZE, config_option(
+            config, 'multipart_chunksize', DEFAULT_MULTIPART_CHUNKSIZE,
+            parse_size))
+        self._multipart_concurrency = config_option(
+            config, 'multipart_concurrency', DEFAULT_MULTIPART_CONCURRENCY,
+            int)
+
+        self._existence_check = config_option(
+            config, 'existence_check', 'conditional').lower()
+        if self._existence_check not in EXISTENCE_CHECKS:
+            raise ValueError(
+                "existence_check must be one of: {}".format(
+                    ', '.join(EXISTENCE_CHECKS)))
+
+        self._list_concurrency = config_option(
+            config, 'list_concurrency', DEFAULT_LIST_CONCURRENCY, int)
+        self._list_delimiter = config_option(config, 'list_delimiter', None)
+
+        self.index = None
+        index_path = config_option(config, 'index', DEFAULT_INDEX_PATH)
+        if index_path and index_path.lower() != 'off':
+            self.index = KeyIndex(
+                index_path, self._bucket_name,
+                config_option(config, 'index_ttl', DEFAULT_INDEX_TTL, int))
+
+        self.journal = None
+        journal_path = config_option(
+            config, 'upload_journal', DEFAULT_JOURNAL_PATH)
+        if journal_path and journal_path.lower() != 'off':
+            self.journal = UploadJournal(journal_path, self._bucket_name)
+        self._stale_upload_age = config_option(
+            config, 'stale_upload_age', DEFAULT_STALE_UPLOAD_AGE, int)
+
+        self.throttle = Throttle.from_config(config)
+        self._connection = self.throttle.wrap(S3Connection(
+            self._key_id, self._access_key,
+            **endpoint_options(config_option(config, 'endpoint_url'))))
 
     @property
     def bucket(self):
@@ -81,7 +259,11 @@ class Bucket(object):
         """
 
         if not self._bucket:
-            self._bucket = self._connection.get_bucket(self._bucket_name)
+            with self._bucket_lock:
+                if not self._bucket:
+                    with timing.span('s3.get_bucket'):
+                        self._bucket = self._connection.get_bucket(
+                            self._bucket_name)
         return self._bucket
 
     def key_for(self, filename, content_type=None):
@@ -95,33 +277,482 @@ class Bucket(object):
         k.content_type = content_type
         return k
 
-    def list(self):
+    def _upload_callback(self):
         """
-        Return an iterator over the image URLs stored in this bucket.
+        Return a progress callback for an upload, or `None` if progress
+        display is disabled.
         """
-        bucket = self.bucket
-        for key in bucket.list():
-            url = self._web_root + key.name
-            yield url
+        return upload_callback() if self.progress else None
 
-    def upload_file(self, filename, content_type, path, force=False):
+    def warm_up(self):
+        """
+        Connect to the bucket and bring the index up-to-date.
+        """
+        _ = self.bucket
+        self.refresh_index(force=False)
+
+    def refresh_index(self, force=True):
+        """
+        Refresh the local key index from S3. Unless `force` is `True`, the
+        index is only refreshed if it is stale. Does nothing if the index is
+        disabled.
+        """
+        if self.index is not None and (force or self.index.is_stale()):
+            with timing.span('index.refresh'):
+                self.index.refresh(self._list_keys(ordered=False))
+
+    def _list_keys(self, ordered=True):
+        """
+        Return an iterator over every boto Key in the bucket, listing
+        partitions of the bucket concurrently. Unless `ordered` is `False`,
+        keys are returned in name order.
+        """
+        boundaries = None
+        if self.index is not None and not self._list_delimiter:
+            boundaries = self.index.boundaries(self._list_concurrency)
+        return timing.timed_iter('s3.list', list_keys(
+            self.bucket, self._list_concurrency,
+            delimiter=self._list_delimiter, boundaries=boundaries,
+            ordered=ordered), size=None)
+
+    def prepare_batch(self):
+        """
+        Prepare for a batch of uploads by making sure that the index is
+        fresh, so that existence checks for the whole batch are answered by
+        (at most) a single listing.
+        """
+        self.refresh_index(force=False)
+
+    def _known(self, name):
+        """
+        Return `True` if the index knows that `name` exists, `False` if it
+        is fresh and knows that it doesn't, or `None` if the index is
+        stale or unavailable.
+        """
+        if self.index is None or self.index.is_stale():
+            return None
+        return name in self.index
+
+    def _check_upload(self, key, filename, force, multipart=False):
+        """
+        Check whether an upload of `filename` to `key` may go ahead, raising
+        FileAlreadyExists if it would overwrite an existing file (unless
+        `force` is `True`).
+
+        Returns extra headers to send with the upload. With conditional
+        checks, these make S3 reject the upload if the file exists, so no
+        separate request is needed. Multipart uploads are also checked up
+        front, so that a large upload isn't wasted.
+        """
+        if force:
+            return {}
+        url = self._web_root + filename
+        if self._known(filename):
+            raise FileAlreadyExists("File at {} already exists!".format(url))
+        if self._existence_check == 'head' or multipart:
+            with timing.span('s3.exists'):
+                exists = key.exists()
+            if exists:
+                raise FileAlreadyExists(
+                    "File at {} already exists!".format(url))
+        if self._existence_check == 'conditional':
+            return {'If-None-Match': '*'}
+        return {}
+
+    def _record_upload(self, filename, size, etag):
+        """
+        Add a newly uploaded file to the local index.
+        """
+        if self.index is not None:
+            self.index.add(filename, size, etag)
+
+    def names(self):
+        """
+        Return an iterator over the names of the files in this bucket.
+        """
+        if self.index is not None:
+            self.refresh_index(force=False)
+            return self.index.iter_names()
+        return (key.name for key in self._list_keys())
+
+    def exists(self, name):
+        """
+        Return `True` if `name` exists in the bucket. If the index knows it
+        does, no request is made.
+        """
+        with timing.span('s3.exists'):
+            return bool(self._known(name) or self.key_for(name).exists())
+
+    def delete(self, name):
+        """
+        Delete `name` from the bucket, without checking that it exists.
+        """
+        with timing.span('s3.delete'):
+            self.key_for(name).delete()
+        if self.index is not None:
+            self.index.remove(name)
+
+    def upload_file(self, filename, content_type, path, force=False,
+                    resume=False, data=None, md5=None):
         """
         Upload a file from the filesystem to the S3 bucket.
 
         `filename` is a path to the local file. The uploaded file will be
         stored at `path`, with the provided `content-type`. If `force` is
         `True`, any existing image at the specified path will be overwritten.
+
+        The file is memory-mapped, so it is only read from disk once: the
+        checksum is calculated from the mapping, and the upload is sent from
+        it.
+
+        Multipart uploads are recorded in the upload journal. If `resume` is
+        `True`, an interrupted upload of the same file is continued, rather
+        than starting again from the beginning.
+
+        If the caller has already mapped the file, the mapping may be
+        passed as `data` (and its MD5 digest as `md5`), so that it isn't
+        mapped (or hashed) again.
         """
-        url = self._web_root + filename
+        if data is None:
+            with map_file(path) as data:
+                return self.upload_file(
+                    filename, content_type, path, force, resume, data, md5)
 
+        url = self._web_root + filename
         key = self.key_for(filename, content_type)
-        if key.exists() and not force:
-            raise FileAlreadyExists("File at {} already exists!".format(url))
+        size = len(data)
+        multipart = size >= self._multipart_threshold
+        headers = self._check_upload(key, filename, force, multipart)
         LOG.debug("Uploading image ...")
-        key.set_contents_from_filename(path, cb=upload_callback())
+        if multipart:
+            etag = self._upload_multipart(
+                key, data, size, headers, path, resume)
+        else:
+            with precondition(url), timing.span('s3.put'):
+                key.set_contents_from_file(
+                    data if size else BytesIO(data), headers=headers,
+                    cb=self._upload_callback(), md5=buffer_md5(data, md5),
+                    size=size)
+                timing.record(size=size)
+            etag = key.etag
+        self._record_upload(filename, size, etag)
 
         return url
 
+    def _part_size(self, size):
+        """
+        Return the part size to use for a multipart upload of `size` bytes,
+        growing the configured chunk size if necessary to stay within S3's
+        limit on the number of parts.
+        """
+        part_size = self._multipart_chunksize
+        while size > part_size * MAX_PARTS:
+            part_size *= 2
+        return part_size
+
+    def _upload_multipart(self, key, data, size, headers=None, path=None,
+                          resume=False):
+        """
+        Upload the buffer `data` to `key` as a multipart upload, sending
+        several parts concurrently.
+
+        If `data` is the contents of the local file at `path`, and the
+        journal is enabled, the upload is journaled, and left in the bucket
+        if it fails. If `resume` is `True`, the parts already uploaded by an
+        interrupted upload of the same file are not sent again.
+        """
+        part_size = self._part_size(size)
+        LOG.debug("Uploading %d bytes in parts of %d bytes", size, part_size)
+
+        if path is None or self.journal is None:
+            multipart, done = None, set()
+        else:
+            source = fingerprint(path)
+            multipart, done = None, set()
+            if resume:
+                multipart, done = self._resumable_upload(
+                    key.name, data, source, part_size)
+            if multipart is None:
+                # Any earlier upload to this key is superseded:
+                self._cancel_journaled(key.name)
+                multipart = self._initiate_upload(key)
+                self.journal.start(key.name, multipart.id, source, part_size)
+
+        parts = (
+            (number, lambda offset=offset: data[offset:offset + part_size])
+            for number, offset in enumerate(
+                range(0, size, part_size), start=1)
+            if number not in done
+        )
+        sent = sum(
+            min(part_size, size - (number - 1) * part_size)
+            for number in done)
+        if multipart is None:
+            return self._upload_parts(key, parts, size, headers)
+
+        def record(number, etag):
+            self.journal.record_part(key.name, multipart.id, number, etag)
+
+        try:
+            etag = self._upload_parts(
+                key, parts, size, headers, multipart, sent, record)
+        except FileAlreadyExists:
+            self.journal.finish(key.name, multipart.id)
+            raise
+        except BaseException:
+            LOG.warning(
+                "The upload to '%s' was interrupted. Upload the file again "
+                "with --resume to continue it.", key.name)
+            raise
+        self.journal.finish(key.name, multipart.id)
+        return etag
+
+    def _initiate_upload(self, key):
+        """
+        Start a multipart upload to `key`, returning the boto
+        MultiPartUpload.
+        """
+        with timing.span('s3.initiate'):
+            return self.bucket.initiate_multipart_upload(
+                key.name, headers={'Content-Type': key.content_type})
+
+    def _resumable_upload(self, name, data, source, part_size):
+        """
+        Find the journaled upload of the file with `source` fingerprint (and
+        contents `data`) to `name`.
+
+        Returns the upload, and the set of part numbers which don't need to
+        be sent again, because S3 holds them with the ETags recorded in the
+        journal, and they still match `data`. Returns `None` for the upload
+        if there isn't one which can be resumed.
+        """
+        entry = self.journal.get(name)
+        if entry is None:
+            LOG.info("There is no interrupted upload to '%s'", name)
+            return None, set()
+        if entry['part_size'] != part_size or any(
+                entry.get(field) != value for field, value in source.items()):
+            LOG.info("'%s' has changed since its upload was interrupted",
+                     source['path'])
+            return None, set()
+
+        multipart = MultiPartUpload(self.bucket)
+        multipart.key_name = name
+        multipart.id = entry['upload_id']
+        try:
+            uploaded = dict(
+                (part.part_number, part.etag.strip('"'))
+                for part in multipart)
+        except S3ResponseError as error:
+            if error.status != 404:
+                raise
+            LOG.info("The interrupted upload to '%s' no longer exists", name)
+            self.journal.finish(name, multipart.id)
+            return None, set()
+
+        done = set()
+        for number, etag in entry['parts'].items():
+            number = int(number)
+            offset = (number - 1) * part_size
+            if uploaded.get(number) == etag and hashlib.md5(
+                    data[offset:offset + part_size]).hexdigest() == etag:
+                done.add(number)
+        LOG.debug("Resuming upload %s with %d parts already uploaded",
+                  multipart.id, len(done))
+        return multipart, done
+
+    def _cancel_journaled(self, name):
+        """
+        Cancel the journaled upload to `name`, if there is one.
+        """
+        entry = self.journal.get(name)
+        if entry is None:
+            return
+        LOG.debug("Cancelling multipart upload %s", entry['upload_id'])
+        try:
+            self.bucket.cancel_multipart_upload(name, entry['upload_id'])
+        except S3ResponseError:
+            LOG.debug("Couldn't cancel upload", exc_info=True)
+        self.journal.finish(name, entry['upload_id'])
+
+    def cleanup_uploads(self, max_age=None):
+        """
+        Cancel the incomplete multipart uploads in the bucket which were
+        started more than `max_age` seconds ago (stale_upload_age by
+        default), so that their parts stop using storage, and forget them in
+        the journal. Returns the names of the cancelled uploads.
+        """
+        if max_age is None:
+            max_age = self._stale_upload_age
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        cancelled = []
+        remaining = set()
+        for upload in self.bucket.list_multipart_uploads():
+            if parse_ts(upload.initiated) > cutoff:
+                remaining.add(upload.id)
+                continue
+            LOG.debug("Cancelling multipart upload %s", upload.id)
+            upload.cancel_upload()
+            cancelled.append(upload.key_name)
+
+        if self.journal is not None:
+            for name, entry in self.journal.uploads().items():
+                if entry['upload_id'] not in remaining:
+                    self.journal.finish(name, entry['upload_id'])
+        return cancelled
+
+    def _upload_parts(self, key, parts, size=None, headers=None,
+                      multipart=None, sent=0, record=None):
+        """
+        Upload `parts` to `key` as a multipart upload.
+
+        `parts` is an iterable of (part number, read function) pairs, where
+        each read function returns the part's data. Up to
+        multipart_concurrency parts are read and uploaded at once, and
+        `parts` is not advanced while all of the workers are busy, so a lazy
+        iterable is only buffered a few parts ahead of the upload. Progress is
+        only displayed if the total `size` is known. `headers` are sent
+        when the upload is completed.
+
+        If any part fails, the whole upload is cancelled so that the uploaded
+        parts do not continue to use storage. Returns the ETag of the
+        completed upload.
+
+        To continue an existing upload, pass it as `multipart`, with the
+        number of bytes it already holds as `sent`. If `record` is given, it
+        is called with the number and ETag of each part as it is uploaded,
+        and the upload is left in place if it fails, so it can be resumed
+        (unless the file already exists).
+        """
+        if multipart is None:
+            multipart = self._initiate_upload(key)
+
+        concurrency = max(1, self._multipart_concurrency)
+        slots = threading.BoundedSemaphore(concurrency)
+        errors = []
+        progress_lock = threading.Lock()
+        uploaded = [sent]
+        callback = self._upload_callback() if size is not None else None
+        within = timing.current()
+
+        def upload_part(number, read):
+            """
+            Read a single part and upload it.
+            """
+            try:
+                data = BytesIO(read())
+                length = len(data.getvalue())
+                md5 = compute_md5(data)
+                with timing.span('s3.upload_part', within):
+                    multipart.upload_part_from_file(
+                        data, number, md5=md5, size=length)
+                    timing.record(size=length)
+                if record is not None:
+                    record(number, md5[0])
+                if callback is not None:
+                    with progress_lock:
+                        uploaded[0] += length
+                        callback(uploaded[0], size)
+            except BaseException as error:
+                errors.append(error)
+                raise
+            finally:
+                slots.release()
+
+        try:
+            if callback is not None:
+                callback(sent, size)
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = []
+                for number, read in parts:
+                    slots.acquire()
+                    if errors:
+                        slots.release()
+                        break
+                    futures.append(pool.submit(upload_part, number, read))
+                for future in futures:
+                    future.result()
+            with precondition(self._web_root + key.name), \
+                    timing.span('s3.complete'):
+                if headers:
+                    completed = self.bucket.complete_multipart_upload(
+                        multipart.key_name, multipart.id,
+                        multipart.to_xml(), headers=dict(headers))
+                else:
+                    completed = multipart.complete_upload()
+            return completed.etag
+        except BaseException as error:
+            if record is None or isinstance(error, FileAlreadyExists):
+                LOG.debug("Cancelling multipart upload %s", multipart.id)
+                multipart.cancel_upload()
+            raise
+
+    def upload_stream(self, filename, content_type, chunks, force=False):
+        """
+        Upload image data to the S3 bucket as it arrives.
+
+        `filename` contains path under the S3 bucket. `content-type` is the
+        content type stored against the image file. `chunks` is an iterable
+        of `bytes` chunks containing the binary image data.
+
+        Data smaller than multipart_threshold is sent in a single request.
+        Anything larger is sent as a multipart upload, with parts being sent
+        while later chunks are still arriving, so only a few parts are held in
+        memory at once.
+
+        If `force` is `True`, any existing image at the specified path will be
+        overwritten.
+        """
+        dest_url = self._web_root + filename
+        key = self.key_for(filename, content_type)
+
+        chunks = iter(chunks)
+        pending = bytearray()
+        for chunk in chunks:
+            pending.extend(chunk)
+            if len(pending) >= self._multipart_threshold:
+                break
+        else:
+            headers = self._check_upload(key, filename, force)
+            LOG.debug("Uploading image ...")
+            with precondition(dest_url), timing.span('s3.put'):
+                key.set_contents_from_string(
+                    bytes(pending), headers=headers,
+                    cb=self._upload_callback())
+                timing.record(size=len(pending))
+            self._record_upload(filename, len(pending), key.etag)
+            return dest_url
+
+        headers = self._check_upload(
+            key, filename, force, multipart=True)
+        LOG.debug("Uploading image ...")
+
+        part_size = self._multipart_chunksize
+        size = [0]
+
+        def parts():
+            """
+            Generate parts of `part_size` from the buffered and remaining
+            chunks. The final part may be smaller.
+            """
+            buf = pending
+            number = 0
+            for chunk in itertools.chain([b''], chunks):
+                buf.extend(chunk)
+                while len(buf) >= part_size:
+                    number += 1
+                    data = bytes(buf[:part_size])
+                    del buf[:part_size]
+                    size[0] += len(data)
+                    yield number, lambda data=data: data
+            if buf or not number:
+                size[0] += len(buf)
+                yield number + 1, lambda data=bytes(buf): data
+
+        etag = self._upload_parts(key, parts(), headers=headers)
+        self._record_upload(filename, size[0], etag)
+        return dest_url
+
     def upload_contents(self, filename, content_type, data, force=False):
         """
         Upload image data to the S3 bucket.
@@ -135,42 +766,116 @@ class Bucket(object):
         """
         dest_url = self._web_root + filename
         key = self.key_for(filename, content_type)
-        if key.exists() and not force:
-            raise FileAlreadyExists(
-                "File at {} already exists!".format(dest_url))
+        headers = self._check_upload(key, filename, force)
         LOG.debug("Uploading image ...")
-        key.set_contents_from_string(data, cb=upload_callback())
+        with precondition(dest_url), timing.span('s3.put'):
+            key.set_contents_from_string(
+                data, headers=headers, cb=self._upload_callback())
+            timing.record(size=len(data))
+        self._record_upload(filename, len(data), key.etag)
 
         return dest_url
 
-    def delete_file(self, remote_path):
+    def _delete_batch(self, names):
         """
-        Delete an S3 file at the specified `remote_path`.
+        Delete up to MAX_DELETE_BATCH `names` with a single multi-object
+        delete request, returning a DeleteResult for each.
         """
-        key = self.key_for(remote_path)
-        if key.exists():
-            key.delete()
-        else:
-            print("The image '%s' does not exist" % remote_path,
-                  file=sys.stderr)
+        try:
+            with timing.span('s3.delete'):
+                result = self.bucket.delete_keys(names, quiet=True)
+        except S3ResponseError as error:
+            # Reported in the same form as the errors for single keys:
+            message = '{}: {}'.format(
+                error.error_code or error.status,
+                error.message or error.reason)
+            return [DeleteResult(name, message) for name in names]
+        failed = dict(
+            (error.key, '{}: {}'.format(error.code, error.message))
+            for error in result.errors)
+        if self.index is not None:
+            self.index.remove(*[name for name in names if name not in failed])
+        return [DeleteResult(name, failed.get(name)) for name in names]
+
+    def delete_files(self, names, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Delete the files `names`, in multi-object delete requests of up to
+        MAX_DELETE_BATCH names each, sending up to `concurrency` requests at
+        once.
 
-    def get_url(self, name):
+        Yields a DeleteResult for each name as its batch completes. Unlike
+        `delete_file`, no check is made that the files exist first: S3
+        reports missing files as deleted.
         """
-        Generate a URL for `name` stored in the bucket.
+        names = list(names)
+        batches = [
+            names[start:start + MAX_DELETE_BATCH]
+            for start in range(0, len(names), MAX_DELETE_BATCH)]
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = [
+                pool.submit(self._delete_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                for result in future.result():
+                    yield result
+
+    def find_duplicate(self, chunks, digests=None):
         """
-        key = self.key_for(name)
-        if key.exists():
-            return self._web_root + name
-        else:
-            raise MissingFile("The image '%s' does not exist" % name)
+        Return the name of a file in the bucket with the same contents as
+        the data in `chunks`, or `None` if there isn't one (or there is no
+        index to look it up in).
+
+        Files are matched by ETag, so files uploaded in parts by other tools
+        (with a different part size) won't be found. If `digests` is a dict,
+        the MD5 digest of the data is stored in it as 'md5'.
+        """
+        if self.index is None:
+            LOG.warning("Deduplication requires the index to be enabled.")
+            return None
+        self.refresh_index(force=False)
+        etags = content_etags(
+            chunks, self._multipart_chunksize, self._multipart_threshold)
+        if digests is not None:
+            digests['md5'] = binascii.unhexlify(etags[0])
+        return self.index.find_etag(etags)
+
+    def copy_file(self, source, filename, content_type, force=False):
+        """
+        Copy the file `source`, already in the bucket, to `filename`
+        without uploading it again, returning the new URL.
+
+        If `force` is `True`, any existing image at `filename` will be
+        overwritten.
+        """
+        dest_url = self._web_root + filename
+        key = self.key_for(filename, content_type)
+        # Copies can't be made conditional, so always check first:
+        self._check_upload(key, filename, force, multipart=True)
+        LOG.debug("Copying '%s' to '%s'", source, filename)
+        with timing.span('s3.copy'):
+            copied = self.bucket.copy_key(
+                filename, self._bucket_name, source,
+                metadata={'Content-Type': content_type})
+        self._record_upload(filename, None, copied.etag)
+        return dest_url
 
-    def grep(self, pattern):
+    def url_for(self, name):
+        """
+        Return the URL for `name`, without checking that it exists.
         """
-        Yielding URLs where the filename matches `pattern`.
+        return self._web_root + name
+
+    def names_matching(self, pattern, ignore_case=False, regex=False):
+        """
+        Return an iterator over the names of files matching `pattern`.
+
+        If `regex` is `True`, `pattern` is a regular expression. If
+        `ignore_case` is `True`, case is ignored.
         """
-        for key in self.bucket.list():
-            if pattern in key.name:
-                yield self._web_root + key.name
+        if self.index is not None:
+            self.refresh_index(force=False)
+            return iter(self.index.grep(pattern, ignore_case, regex))
+        return super(Bucket, self).names_matching(
+            pattern, ignore_case, regex)
 
     def init_bucket(self):
         bucket = self._connection.create_bucket(self._bucket_name)
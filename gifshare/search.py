@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Filename matching for gifshare's grep, and the query planning used to
+search the key index with it.
+
+Names are indexed by their three-character substrings (trigrams). Any name
+matching a pattern must contain every literal string that the pattern
+requires, so searching the index for those literals narrows the search to a
+small set of candidates, which are then checked properly.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:     # Python < 3.11
+    import sre_parse    # pylint: disable=deprecated-module
+
+from .exceptions import InvalidPattern
+
+
+GRAM_SIZE = 3
+_REPEATS = tuple(
+    getattr(sre_parse, name) for name in (
+        'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_parse, name))
+
+
+def _literal_runs(parsed):
+    """
+    Yield the runs of literal characters which must appear in any string
+    matched by the parsed regular expression `parsed`.
+    """
+    run = []
+    for op, arg in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(arg))
+            continue
+        if run:
+            yield ''.join(run)
+            run = []
+        if op == sre_parse.SUBPATTERN:
+            for literal in _literal_runs(arg[-1]):
+                yield literal
+        elif op in _REPEATS and arg[0] >= 1:
+            for literal in _literal_runs(arg[2]):
+                yield literal
+    if run:
+        yield ''.join(run)
+
+
+def required_literals(pattern):
+    """
+    Return a list of literal strings which must appear in any string that
+    matches the regular expression `pattern`. Only runs of at least
+    three characters are useful to the index, so shorter ones are dropped.
+
+    The list may be empty, in which case the index cannot help.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error as error:
+        raise InvalidPattern(
+            "Invalid pattern '{}': {}".format(pattern, error))
+    return [run for run in _literal_runs(parsed) if len(run) >= GRAM_SIZE]
+
+
+def query_literals(pattern, regex=False):
+    """
+    Return a list of literal strings, each at least three characters long,
+    that any name matching `pattern` must contain. An empty list means that
+    every name is a candidate.
+    """
+    if not regex:
+        return [pattern] if len(pattern) >= GRAM_SIZE else []
+    return required_literals(pattern)
+
+
+def fts_query(literals):
+    """
+    Build an SQLite FTS5 query requiring all of `literals`.
+    """
+    return ' AND '.join(
+        '"{}"'.format(literal.replace('"', '""')) for literal in literals)
+
+
+def matcher(pattern, ignore_case=False, regex=False):
+    """
+    Return a function that returns `True` for names matching `pattern`.
+
+    By default, a name matches if it contains `pattern`. If `regex` is
+    `True`, `pattern` is treated as a regular expression which is searched
+    for in the name. If `ignore_case` is `True`, case is ignored.
+    """
+    if regex:
+        try:
+            compiled = re.compile(
+                pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as error:
+            raise InvalidPattern(
+                "Invalid pattern '{}': {}".format(pattern, error))
+        return lambda name: compiled.search(name) is not None
+    elif ignore_case:
+        pattern = pattern.lower()
+        return lambda name: pattern in name.lower()
+    else:
+        return lambda name: pattern in name
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+A shared, pooled HTTP session for downloading images.
+
+Every download goes through the same requests session, which keeps a pool
+of connections open to each host, so that fetching several images from one
+server only pays for connection (and TLS) setup once. Connection failures
+and server errors are retried with a backoff, and every request has a
+timeout.
+
+This module is cheap to import: requests is only imported when the session
+is first used.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import namedtuple
+import logging
+import threading
+
+from .core import config_option
+
+
+LOG = logging.getLogger('gifshare.session')
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_POOLS = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_TIMEOUT = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+ConnectionStats = namedtuple(
+    'ConnectionStats', ['host', 'requests', 'connections'])
+ConnectionStats.__doc__ = """
+The number of `requests` made to `host`, and the number of `connections`
+which were opened to make them.
+"""
+
+
+class HttpSession(object):
+    """
+    A requests session which keeps up to `pool_size` connections open to
+    each of the `pools` most recently used hosts.
+
+    Requests which fail to connect, or which get a response with one of
+    RETRY_STATUSES, are retried up to `retries` times, waiting longer each
+    time (starting at `backoff` seconds). Requests time out if a connection
+    can't be made in `connect_timeout` seconds, or if the server doesn't
+    send anything for `timeout` seconds.
+
+    An HttpSession may be shared between threads.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, pools=DEFAULT_POOLS,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 timeout=DEFAULT_TIMEOUT):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        self.timeout = (connect_timeout, timeout)
+        self._adapter = HTTPAdapter(
+            pool_connections=pools, pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries, backoff_factor=backoff,
+                status_forcelist=RETRY_STATUSES, raise_on_status=False))
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create an HttpSession using the settings in `config`.
+        """
+        return cls(
+            pool_size=config_option(
+                config, 'http_pool_size', DEFAULT_POOL_SIZE, int),
+            retries=config_option(
+                config, 'http_retries', DEFAULT_RETRIES, int),
+            connect_timeout=config_option(
+                config, 'http_connect_timeout', DEFAULT_CONNECT_TIMEOUT,
+                float),
+            timeout=config_option(
+                config, 'http_timeout', DEFAULT_TIMEOUT, float))
+
+    def get(self, url, **kwargs):
+        """
+        Make a GET request to `url`, with the session's timeout unless
+        another is given. Takes the same arguments as `requests.get`.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        """
+        Return a list of ConnectionStats for each host with an open pool.
+        """
+        pools = self._adapter.poolmanager.pools
+        stats = []
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats.append(ConnectionStats(
+                    '{}://{}:{}'.format(pool.scheme, pool.host, pool.port),
+                    pool.num_requests, pool.num_connections))
+        return stats
+
+    def close(self):
+        """
+        Close all of the session's connections.
+        """
+        self.session.close()
+
+
+_SETTINGS = {'config': None}
+_SHARED = []
+_SHARED_LOCK = threading.Lock()
+
+
+def configure(config):
+    """
+    Use the settings in `config` for the shared session. This must be
+    called before the shared session is first used.
+    """
+    _SETTINGS['config'] = config
+
+
+def shared_session():
+    """
+    Return the HttpSession shared by every download in this process,
+    creating it if necessary.
+    """
+    if not _SHARED:
+        with _SHARED_LOCK:
+            if not _SHARED:
+                config = _SETTINGS['config']
+                _SHARED.append(
+                    HttpSession() if config is None
+                    else HttpSession.from_config(config))
+    return _SHARED[0]
+
+
+def connection_stats():
+    """
+    Return the ConnectionStats of the shared session, or an empty list if
+    it has not been used.
+    """
+    return _SHARED[0].stats() if _SHARED else []
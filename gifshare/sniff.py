@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Image type detection.
+
+Image types are identified from the signature in their first few dozen
+bytes, in pure Python. If the signature isn't recognised and python-magic is
+installed, libmagic is asked as a fallback.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import re
+import struct
+
+
+LOG = logging.getLogger('gifshare.sniff')
+
+HEADER_SIZE = 64
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+AVIF_BRANDS = (b'avif', b'avis')
+
+# The file extension for each detected image type:
+EXTENSIONS = {
+    'gif': 'gif',
+    'jpeg': 'jpeg',
+    'png': 'png',
+    'apng': 'png',
+    'webp': 'webp',
+    'avif': 'avif',
+}
+
+
+def _png_type(head):
+    """
+    Distinguish an animated PNG from a still one, by looking for an acTL
+    chunk before the first IDAT chunk in `head`.
+    """
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(head):
+        length, chunk_type = struct.unpack('>I4s', head[offset:offset + 8])
+        if chunk_type == b'acTL':
+            return 'apng'
+        if chunk_type == b'IDAT':
+            break
+        offset += 12 + length
+    return 'png'
+
+
+def _is_avif(head):
+    """
+    Return `True` if `head` starts with an ISO media 'ftyp' box listing an
+    AVIF brand.
+    """
+    if len(head) < 12 or head[4:8] != b'ftyp':
+        return False
+    size = min(struct.unpack('>I', head[:4])[0], len(head))
+    brands = [head[8:12]] + [
+        head[offset:offset + 4] for offset in range(16, size - 3, 4)]
+    return any(brand in AVIF_BRANDS for brand in brands)
+
+
+def image_type(head):
+    """
+    Identify the image whose leading bytes are `head`, returning one of
+    'gif', 'jpeg', 'png', 'apng', 'webp' or 'avif', or `None` if the
+    signature isn't recognised.
+
+    `head` only needs to be HEADER_SIZE bytes long.
+    """
+    head = bytes(head[:HEADER_SIZE])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == PNG_SIGNATURE:
+        return _png_type(head)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if _is_avif(head):
+        return 'avif'
+    return None
+
+
+def read_head(path, size=HEADER_SIZE):
+    """
+    Read the first `size` bytes of the file at `path`.
+    """
+    with open(path, 'rb') as image:
+        return image.read(size)
+
+
+def magic_ext(data, is_buffer=False):
+    """
+    Ask libmagic for the extension of the image in `data` (a path, or a
+    buffer if `is_buffer` is `True`).
+
+    Returns `None` if libmagic doesn't recognise the image, or if
+    python-magic isn't installed.
+    """
+    try:
+        import magic
+    except ImportError:
+        LOG.debug("python-magic isn't installed")
+        return None
+
+    output = magic.from_buffer(data) if is_buffer else magic.from_file(data)
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    LOG.debug("libmagic says: %s", output)
+    match = re.search(r'JPEG|GIF|PNG|Web/P|AVIF', output)
+    if match:
+        return match.group(0).lower().replace('/', '')
+    return None
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+The interface gifshare stores images through, and choosing a backend.
+
+GifShare, the command-line tool and the daemon only talk to their bucket
+through the methods of Storage, so any class implementing them can stand
+in for S3. Two are provided: `gifshare.s3.Bucket`, and
+`gifshare.local.LocalDirectory`, which keeps images in a local directory
+(to be served by any web server, or used in tests and CI without S3).
+
+The backend is chosen with the `storage` configuration option:
+
+    [default]
+    storage=local
+    local_root=/srv/gifs
+    web_root=https://gifs.example.com/
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import namedtuple
+import importlib
+import logging
+import sys
+
+from .core import load_config, config_option, DEFAULT_CONCURRENCY
+from .exceptions import MissingFile
+from .search import matcher
+
+
+LOG = logging.getLogger('gifshare.storage')
+
+# Each backend's name in the `storage` option, and the module and class
+# implementing it. Backends are imported when they're chosen, so that local
+# storage doesn't need boto installed.
+BACKENDS = {
+    's3': ('s3', 'Bucket'),
+    'local': ('local', 'LocalDirectory'),
+}
+DEFAULT_BACKEND = 's3'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+DeleteResult = namedtuple('DeleteResult', ['name', 'error'])
+DeleteResult.__doc__ = """
+The outcome of deleting a single file `name` as part of a batch. `error` is
+`None` if the file was deleted.
+"""
+
+
+def open_storage(config=None, progress=True):
+    """
+    Create the storage backend selected by the `storage` option in `config`
+    (S3, unless it says otherwise). If `progress` is `False`, no progress
+    bars are displayed during uploads.
+    """
+    if config is None:
+        config = load_config()
+    backend = config_option(config, 'storage', DEFAULT_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError("storage must be one of: {}".format(
+            ', '.join(sorted(BACKENDS))))
+    module_name, class_name = BACKENDS[backend]
+    module = importlib.import_module('.' + module_name, __package__)
+    return getattr(module, class_name)(config, progress=progress)
+
+
+class Storage(object):
+    """
+    A place to store images, and the URLs they're served from.
+
+    Backends must implement `upload_stream`, `exists`, `names`, `delete` and
+    `url_for`. Everything else is built from those, and may be overridden
+    with something faster: uploading from a file without reading it into
+    Python, answering searches from an index, or deleting in batches.
+
+    Names are paths relative to the root of the store, separated with '/'.
+    Backends must be safe to share between threads.
+    """
+
+    def upload_stream(self, filename, content_type, chunks, force=False):
+        """
+        Store the image data in `chunks` (an iterable of `bytes`) as
+        `filename`, with the given `content_type`, and return its URL.
+
+        Raises FileAlreadyExists if `filename` exists, unless `force` is
+        `True`.
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        """
+        Return `True` if a file called `name` is stored.
+        """
+        raise NotImplementedError
+
+    def names(self):
+        """
+        Return an iterator over the names of the stored files, in order.
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """
+        Delete the file called `name`. Deleting a missing file does nothing.
+        """
+        raise NotImplementedError
+
+    def url_for(self, name):
+        """
+        Return the URL for `name`, without checking that it exists.
+        """
+        raise NotImplementedError
+
+    def upload_contents(self, filename, content_type, data, force=False):
+        """
+        Store the image `data` as `filename`, and return its URL.
+        """
+        return self.upload_stream(filename, content_type, [data], force)
+
+    def upload_file(self, filename, content_type, path, force=False,
+                    resume=False, data=None, md5=None):
+        """
+        Store the local file at `path` as `filename`, and return its URL.
+
+        If the file has already been read, its contents may be passed as
+        `data` (such as a mapping from `map_file`), and their MD5 digest as
+        `md5`, so that backends needn't read or hash it again. `resume` is
+        only meaningful to backends which upload large files in parts, and
+        is otherwise ignored.
+        """
+        if data is not None:
+            return self.upload_stream(filename, content_type, [data], force)
+        with open(path, 'rb') as source:
+            return self.upload_stream(
+                filename, content_type,
+                iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''), force)
+
+    def copy_file(self, source, filename, content_type, force=False):
+        """
+        Copy the stored file `source` to `filename`, returning the new URL.
+        Only needed by backends which can find duplicates.
+        """
+        raise NotImplementedError
+
+    def find_duplicate(self, chunks, digests=None):
+        """
+        Return the name of a stored file with the same contents as the data
+        in `chunks`, or `None` if there isn't one (or the backend can't
+        tell).
+
+        If `digests` is a dict, the MD5 digest of the data is stored in it
+        as 'md5' (if it was calculated), to be passed on to `upload_file`.
+        """
+        LOG.warning("Deduplication isn't supported by this storage.")
+        return None
+
+    def get_url(self, name):
+        """
+        Return the URL for `name`, raising MissingFile if it isn't stored.
+        """
+        if self.exists(name):
+            return self.url_for(name)
+        raise MissingFile("The image '%s' does not exist" % name)
+
+    def list(self):
+        """
+        Return an iterator over the URLs of the stored images.
+        """
+        return (self.url_for(name) for name in self.names())
+
+    def names_matching(self, pattern, ignore_case=False, regex=False):
+        """
+        Return an iterator over the names of files matching `pattern`.
+
+        If `regex` is `True`, `pattern` is a regular expression. If
+        `ignore_case` is `True`, case is ignored.
+        """
+        matches = matcher(pattern, ignore_case, regex)
+        return (name for name in self.names() if matches(name))
+
+    def grep(self, pattern, ignore_case=False, regex=False):
+        """
+        Yielding URLs where the filename matches `pattern`.
+
+        If `regex` is `True`, `pattern` is a regular expression. If
+        `ignore_case` is `True`, case is ignored.
+        """
+        for name in self.names_matching(pattern, ignore_case, regex):
+            yield self.url_for(name)
+
+    def delete_file(self, remote_path):
+        """
+        Delete the file stored at `remote_path`, reporting it if it doesn't
+        exist.
+        """
+        if self.exists(remote_path):
+            self.delete(remote_path)
+        else:
+            print("The image '%s' does not exist" % remote_path,
+                  file=sys.stderr)
+
+    def delete_files(self, names, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Delete the files `names`, yielding a DeleteResult for each. Missing
+        files are reported as deleted. `concurrency` is a hint for backends
+        which delete over the network.
+        """
+        for name in names:
+            try:
+                self.delete(name)
+            except (IOError, OSError) as error:
+                yield DeleteResult(name, str(error))
+            else:
+                yield DeleteResult(name, None)
+
+    def warm_up(self):
+        """
+        Make any connections and bring any cached listing up-to-date, so
+        that a long-running process answers its first request as quickly
+        as the rest.
+        """
+        self.refresh_index(force=False)
+
+    def refresh_index(self, force=True):
+        """
+        Refresh any cached listing of the store. Does nothing by default.
+        """
+
+    def prepare_batch(self):
+        """
+        Prepare for a batch of uploads. Does nothing by default.
+        """
+
+    def cleanup_uploads(self, max_age=None):
+        """
+        Cancel uploads which were interrupted more than `max_age` seconds
+        ago, returning the names of the files they were uploading. Does
+        nothing by default.
+        """
+        return []
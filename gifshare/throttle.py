@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive concurrency, retries and hedging for S3 requests.
+
+Every request a Bucket makes goes through one Throttle, however many threads
+are making them. The Throttle limits how many requests are in flight at
+once, and adapts the limit the way TCP adapts its window (AIMD): each
+success raises the limit a little, and each throttling response (503
+SlowDown, or another server error) or connection failure halves it. Only the
+first failure among the requests sent at the same limit halves it, so a
+burst of failures doesn't collapse the limit to nothing.
+
+Failed requests are retried after a random delay of up to `base_delay *
+2 ** attempt` seconds ("full jitter"), so that retries from many threads
+don't arrive together. Requests are retried by the Throttle, rather than by
+boto, so that it sees every failure. A throttled request wasn't acted on,
+so it is always retried, but after a connection failure only idempotent
+requests are: S3 may have received a POST (such as one completing a
+multipart upload) before the connection failed.
+
+Optionally, a GET or HEAD which hasn't been answered after `hedge_after`
+seconds is sent again, if there's room under the limit, and whichever
+response arrives first is used.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import functools
+import logging
+import random
+import threading
+import time
+
+from boto.exception import S3ResponseError
+from six.moves.http_client import HTTPException
+
+from .core import config_option
+from .timing import record
+
+
+LOG = logging.getLogger('gifshare.throttle')
+
+DEFAULT_INITIAL_LIMIT = 8
+DEFAULT_MAX_LIMIT = 64
+DEFAULT_RETRIES = 5
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 20.0
+DECREASE_FACTOR = 0.5
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+HEDGE_METHODS = ('GET', 'HEAD')
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class _Throttled(Exception):
+    """
+    Raised (from boto's retry handler) to stop boto handling a throttling
+    response itself.
+    """
+
+    def __init__(self, status, reason, body):
+        super(_Throttled, self).__init__(status, reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def _reject_throttled(response, attempt, next_sleep):
+    """
+    A boto retry handler which turns a throttling response into _Throttled.
+    """
+    if response.status in THROTTLE_STATUSES:
+        raise _Throttled(response.status, response.reason, response.read())
+    return None
+
+
+def _discard(future):
+    """
+    Read and throw away the response of a hedged request that lost the race,
+    so that its connection can be reused.
+    """
+    if not future.cancelled() and future.exception() is None:
+        response = future.result()
+        if response is not None:
+            response.read()
+
+
+class Throttle(object):
+    """
+    Limits, retries and hedges the requests made by boto S3Connections.
+
+    The number of requests in flight starts at `limit`, and adapts between
+    `minimum` and `maximum`. Failed requests are retried up to `retries`
+    times, waiting a random time of up to `base_delay * 2 ** attempt`
+    seconds (but never more than `max_delay`). If `hedge_after` is given,
+    slow GETs and HEADs are sent again after that many seconds.
+
+    A Throttle may be shared between threads and connections.
+    """
+
+    def __init__(self, limit=DEFAULT_INITIAL_LIMIT, minimum=1,
+                 maximum=DEFAULT_MAX_LIMIT, retries=DEFAULT_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 hedge_after=None, sleep=time.sleep, rng=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self._limit = float(max(self.minimum, min(self.maximum, limit)))
+        self._sleep = sleep
+        self._random = rng or random.Random()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._epoch = 0
+        self._pool = None
+        self.retried = 0
+        self.hedged = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a Throttle using the settings in `config`.
+        """
+        maximum = config_option(
+            config, 'request_concurrency', DEFAULT_MAX_LIMIT, int)
+        return cls(
+            limit=min(maximum, DEFAULT_INITIAL_LIMIT), maximum=maximum,
+            retries=config_option(
+                config, 'request_retries', DEFAULT_RETRIES, int),
+            hedge_after=config_option(config, 'hedge_after', None, float))
+
+    @property
+    def limit(self):
+        """
+        The number of requests currently allowed in flight at once.
+        """
+        return int(self._limit)
+
+    def acquire(self, blocking=True):
+        """
+        Wait for room under the limit, and claim it for a request. Returns
+        a token to pass to `release`, or `None` if `blocking` is `False`
+        and there's no room.
+        """
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                if not blocking:
+                    return None
+                self._condition.wait()
+            self._in_flight += 1
+            return self._epoch
+
+    def release(self, token, throttled=False):
+        """
+        Release the room claimed by `acquire` (which returned `token`), and
+        adapt the limit: halve it if the request was `throttled`, and raise
+        it by roughly one for every limit's-worth of successes otherwise.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if not throttled:
+                self._limit = min(
+                    self.maximum, self._limit + 1.0 / self._limit)
+            elif token == self._epoch:
+                # Requests sent before this decrease don't decrease it again:
+                self._epoch += 1
+                self._limit = max(
+                    self.minimum, self._limit * DECREASE_FACTOR)
+                LOG.debug("Request throttled; limit is now %d", self.limit)
+            self._condition.notify_all()
+
+    def backoff(self, attempt):
+        """
+        Return how long to wait before retry number `attempt` (from 0).
+        """
+        return self._random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def wrap(self, connection):
+        """
+        Send every request made by `connection` (a boto S3Connection)
+        through this Throttle, returning the connection.
+        """
+        connection.make_request = functools.partial(
+            self.request, connection.make_request)
+        return connection
+
+    def request(self, make_request, method, *args, **kwargs):
+        """
+        Call `make_request` (an S3Connection's method) to make a request,
+        within the limit, retrying and hedging it as necessary.
+        """
+        if self.hedge_after is None or method not in HEDGE_METHODS or \
+                kwargs.get('sender') is not None:
+            return self._send(make_request, method, args, kwargs)
+        return self._hedge(make_request, method, args, kwargs)
+
+    def _send(self, make_request, method, args, kwargs, blocking=True):
+        """
+        Make a request, retrying it if it is throttled, or if it is
+        idempotent and the connection fails. Returns `None` if `blocking` is `False` and there's no room under
+        the limit for it.
+        """
+        kwargs = dict(kwargs, override_num_retries=0,
+                      retry_handler=_reject_throttled)
+        attempt = 0
+        while True:
+            token = self.acquire(blocking)
+            if token is None:
+                return None
+            blocking = True
+            record(requests=1)
+            try:
+                response = make_request(method, *args, **kwargs)
+            except (_Throttled, HTTPException, IOError) as error:
+                self.release(token, throttled=True)
+                throttled = isinstance(error, _Throttled)
+                if attempt >= self.retries or not (
+                        throttled or method in IDEMPOTENT_METHODS):
+                    if throttled:
+                        raise S3ResponseError(
+                            error.status, error.reason, error.body)
+                    raise
+                delay = self.backoff(attempt)
+                LOG.debug("%s request failed (%s); retrying in %.2f seconds",
+                          method, error, delay)
+                self.retried += 1
+                attempt += 1
+                self._sleep(delay)
+            except BaseException:
+                self.release(token)
+                raise
+            else:
+                self.release(token)
+                return response
+
+    def _executor(self):
+        """
+        Return the thread pool hedged requests are made from.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self._condition:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.maximum * 2)
+            return self._pool
+
+    def _hedge(self, make_request, method, args, kwargs):
+        """
+        Make a request, sending it again if it hasn't been answered after
+        `hedge_after` seconds, and return the first response.
+        """
+        from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+
+        pool = self._executor()
+        primary = pool.submit(self._send, make_request, method, args, kwargs)
+        try:
+            return primary.result(timeout=self.hedge_after)
+        except TimeoutError:
+            pass
+
+        hedge = pool.submit(
+            self._send, make_request, method, args, kwargs, blocking=False)
+        pending = set([primary, hedge])
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            answered = [future for future in done
+                        if future.exception() is None and
+                        future.result() is not None]
+            if answered:
+                winner = answered[0]
+                if winner is hedge:
+                    self.hedged += 1
+                for other in (primary, hedge):
+                    if other is not winner:
+                        other.add_done_callback(_discard)
+                return winner.result()
+            for future in done:
+                error = error or future.exception()
+        raise error
+
+    def close(self):
+        """
+        Stop the thread pool used for hedged requests, if there is one.
+        """
+        with self._condition:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
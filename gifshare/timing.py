@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing the phases of gifshare's work.
+
+The phases of an upload (downloading the image, recognising its type,
+checking the bucket, sending it) are each wrapped in a span, which records
+how long the phase took, how many requests it made, and how many bytes it
+moved. Spans nest: requests and bytes count towards every enclosing span in
+the same thread, or (for work handed to another thread) the spans it was
+started `within`.
+
+Finished spans are passed to every hook added with `add_hook`, so that they
+can be sent to a metrics system, or collected by a Recorder (which is what
+`gifshare --profile` does):
+
+    recorder = timing.Recorder()
+    timing.add_hook(recorder)
+    gifshare.upload('http://funnygifz.guru/a/funny.gif')
+    print(recorder.report())
+
+Hooks are called from whichever thread finished the span, so they must be
+thread-safe. Nothing is timed while there are no hooks.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import namedtuple
+from contextlib import contextmanager
+import threading
+from timeit import default_timer
+
+
+Span = namedtuple(
+    'Span', ['name', 'parent', 'start', 'seconds', 'requests', 'bytes'])
+Span.__doc__ = """
+A finished phase called `name`, which started at `start` (a timeit timer
+value) and took `seconds`, making `requests` requests and moving `bytes`
+bytes. `parent` is the name of the enclosing span in the same thread, or
+`None`.
+"""
+
+_HOOKS = []
+_HOOKS_LOCK = threading.Lock()
+_RECORD_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def add_hook(hook):
+    """
+    Call `hook` with a Span whenever a span finishes.
+    """
+    global _HOOKS  # pylint: disable=global-statement
+    with _HOOKS_LOCK:
+        _HOOKS = _HOOKS + [hook]
+
+
+def remove_hook(hook):
+    """
+    Stop calling `hook` when spans finish.
+    """
+    global _HOOKS  # pylint: disable=global-statement
+    with _HOOKS_LOCK:
+        _HOOKS = [other for other in _HOOKS if other != hook]
+
+
+def _stack():
+    """
+    Return the current thread's stack of unfinished spans.
+    """
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    return stack
+
+
+class _Timer(object):
+    """
+    An unfinished span.
+    """
+    __slots__ = ('name', 'parent', 'start', 'seconds', 'requests', 'bytes')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.start = default_timer()
+        self.seconds = 0.0
+        self.requests = 0
+        self.bytes = 0
+
+    def finish(self):
+        span = Span(self.name, self.parent, self.start, self.seconds,
+                    self.requests, self.bytes)
+        for hook in _HOOKS:
+            hook(span)
+
+
+def _push(timer):
+    stack = _stack()
+    timer.parent = stack[-1].name if stack else None
+    stack.append(timer)
+
+
+def _pop(timer):
+    stack = _stack()
+    if stack and stack[-1] is timer:
+        stack.pop()
+
+
+def current():
+    """
+    Return this thread's unfinished spans, so that work done for them in
+    another thread can be counted towards them (see `span`).
+    """
+    return tuple(_stack())
+
+
+@contextmanager
+def span(name, within=None):
+    """
+    Time the enclosed block as a span called `name`.
+
+    If the block runs in a worker thread, pass the spans it is working for
+    (from `current` in the thread that started it) as `within`.
+    """
+    if not _HOOKS:
+        yield
+        return
+    saved = None
+    if within is not None:
+        saved, _LOCAL.stack = _stack(), list(within)
+    timer = _Timer(name, None)
+    _push(timer)
+    try:
+        yield
+    finally:
+        _pop(timer)
+        if saved is not None:
+            _LOCAL.stack = saved
+        timer.seconds = default_timer() - timer.start
+        timer.finish()
+
+
+def record(requests=0, size=0):
+    """
+    Count `requests` requests, and `size` bytes moved, towards every
+    unfinished span in this thread.
+    """
+    if _HOOKS:
+        with _RECORD_LOCK:
+            for timer in _stack():
+                timer.requests += requests
+                timer.bytes += size
+
+
+def timed_iter(name, items, size=len):
+    """
+    Wrap the iterable `items` (such as the chunks of a download), timing it
+    as a span called `name`. Only the time spent waiting for items counts,
+    so a download which is streamed as it is uploaded can be told apart from
+    the upload. Each item counts as `size(item)` bytes, unless `size` is
+    `None`. The span finishes when `items` is exhausted or closed.
+    """
+    if not _HOOKS:
+        return items
+    return _timed_iter(name, items, size)
+
+
+def _timed_iter(name, items, size):
+    timer = _Timer(name, None)
+    items = iter(items)
+    try:
+        while True:
+            started = default_timer()
+            _push(timer)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                _pop(timer)
+                timer.seconds += default_timer() - started
+            if size is not None:
+                _push(timer)
+                record(size=size(item))
+                _pop(timer)
+            yield item
+    finally:
+        close = getattr(items, 'close', None)
+        if close is not None:
+            close()
+        timer.finish()
+
+
+class Recorder(object):
+    """
+    A hook which adds up the spans with each name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+
+    def __call__(self, finished):
+        with self._lock:
+            phase = self._phases.setdefault(finished.name, {
+                'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'requests': 0, 'bytes': 0})
+            phase['count'] += 1
+            phase['seconds'] += finished.seconds
+            phase['max_seconds'] = max(
+                phase['max_seconds'], finished.seconds)
+            phase['requests'] += finished.requests
+            phase['bytes'] += finished.bytes
+
+    def summary(self):
+        """
+        Return a dict mapping each span name to the number of spans, their
+        total and longest time in seconds, and their total requests and
+        bytes.
+        """
+        with self._lock:
+            return dict(
+                (name, dict(phase)) for name, phase in self._phases.items())
+
+    def report(self):
+        """
+        Return the summary as a table, with the slowest phases first.
+        """
+        row = '{:<22} {:>6} {:>10} {:>10} {:>9} {:>12}'
+        lines = [row.format(
+            'phase', 'count', 'total ms', 'max ms', 'requests', 'bytes')]
+        for name, phase in sorted(
+                self.summary().items(), key=lambda item: -item[1]['seconds']):
+            lines.append(row.format(
+                name, phase['count'], round(phase['seconds'] * 1000, 1),
+                round(phase['max_seconds'] * 1000, 1), phase['requests'],
+                phase['bytes']))
+        return '\n'.join(lines)
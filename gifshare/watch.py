@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+"""
+Watching a folder, and uploading images as they arrive in it.
+
+On Linux, the folder is watched with inotify (called through ctypes, so
+there's nothing extra to install). Elsewhere, the folder is polled.
+
+A file is only uploaded once it has settled: nothing has been written to it
+for a few seconds, and its size and modification time have stopped
+changing, so partially-written files aren't uploaded. Files which settle at
+around the same time are uploaded together, concurrently, with one Bucket.
+
+Every file which has been handled is recorded in a state file, along with
+its size and modification time, so that restarting the watch doesn't upload
+anything again, but does catch up with any files that arrived while it was
+stopped.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+from os.path import abspath, expanduser, isdir, isfile, join
+import select
+import stat as stat_module
+import struct
+import sys
+import time
+
+from .core import DEFAULT_CONCURRENCY
+from .exceptions import UserException
+
+
+LOG = logging.getLogger('gifshare.watch')
+
+DEFAULT_STATE_PATH = '~/.gifshare-watch.json'
+DEFAULT_SETTLE = 2.0
+POLL_INTERVAL = 1.0
+IDLE_TIMEOUT = 60.0
+MAX_BATCH = 100
+# Failed uploads are retried after RETRY_DELAY seconds, doubling with each
+# failure up to MAX_RETRY_DELAY:
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 300.0
+PARTIAL_SUFFIXES = ('.part', '.partial', '.crdownload', '.download', '.tmp')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _fsdecode(name):
+    if isinstance(name, bytes):
+        return name.decode(sys.getfilesystemencoding(), 'surrogateescape'
+                           if sys.version_info[0] >= 3 else 'replace')
+    return name
+
+
+def _fsencode(name):
+    if isinstance(name, bytes):
+        return name
+    return name.encode(sys.getfilesystemencoding(), 'surrogateescape'
+                       if sys.version_info[0] >= 3 else 'strict')
+
+
+def is_candidate(name):
+    """
+    Return `True` if a file called `name` might be an image to upload, rather
+    than a hidden file, or one which is still being downloaded.
+    """
+    return not (
+        name.startswith('.') or name.endswith('~') or
+        name.lower().endswith(PARTIAL_SUFFIXES))
+
+
+def file_stat(path):
+    """
+    Return the (size, modification time) of the file at `path`, or `None` if
+    it isn't a file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not stat_module.S_ISREG(stat.st_mode):
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def list_files(directory):
+    """
+    Return the paths of the candidate files in `directory`.
+    """
+    return [join(directory, name) for name in sorted(os.listdir(directory))
+            if is_candidate(name) and isfile(join(directory, name))]
+
+
+class InotifyWatcher(object):
+    """
+    Reports the files in `directory` which have been written to, or moved
+    into it, using inotify.
+
+    Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(
+                self._fd, ctypes.c_char_p(_fsencode(directory)),
+                ctypes.c_uint32(WATCH_MASK)) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, "Couldn't watch {}".format(directory))
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes, returning the set of paths
+        of candidate files which have changed. If events were lost, every
+        candidate file in the directory is returned.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = _fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                LOG.debug("inotify queue overflowed; rescanning")
+                changed.update(list_files(self.directory))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise UserException(
+                    "{} is no longer available".format(self.directory))
+            elif name and is_candidate(name):
+                changed.add(join(self.directory, name))
+        return changed
+
+    def close(self):
+        """
+        Stop watching the directory.
+        """
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """
+    Reports the files in `directory` which have changed, by comparing their
+    sizes and modification times every `interval` seconds.
+    """
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        return dict(
+            (path, file_stat(path)) for path in list_files(self.directory))
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds, returning the set of paths of
+        candidate files which have changed.
+        """
+        time.sleep(min(timeout, self.interval))
+        stats = self._scan()
+        changed = set(
+            path for path, stat in stats.items()
+            if stat is not None and self._stats.get(path) != stat)
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(directory):
+    """
+    Return an InotifyWatcher for `directory`, or a PollingWatcher if inotify
+    isn't available.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError):
+        LOG.debug("Falling back to polling %s", directory, exc_info=True)
+        return PollingWatcher(directory)
+
+
+class WatchState(object):
+    """
+    The files that have already been handled, stored in the JSON file at
+    `path`, mapping each file's absolute path to its size, modification
+    time, and the URL it was uploaded to (or the error that stopped it from
+    being uploaded).
+    """
+
+    def __init__(self, path):
+        self.path = expanduser(path)
+        try:
+            with open(self.path) as state:
+                self._files = json.load(state)
+        except (IOError, OSError, ValueError):
+            self._files = {}
+
+    def is_handled(self, path, stat):
+        """
+        Return `True` if the file at `path`, with the (size, modification
+        time) `stat`, has already been handled.
+        """
+        entry = self._files.get(abspath(path))
+        return entry is not None and (entry['size'], entry['mtime']) == stat
+
+    def record(self, path, stat, url=None, error=None):
+        """
+        Record that the file at `path` with `stat` was handled.
+        """
+        self._files[abspath(path)] = {
+            'size': stat[0], 'mtime': stat[1], 'url': url, 'error': error}
+
+    def save(self):
+        """
+        Atomically write the state file.
+        """
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as state:
+            json.dump(self._files, state, indent=1, sort_keys=True)
+        _replace(temp_path, self.path)
+
+
+class FolderWatch(object):
+    """
+    Uploads the images arriving in `directory` with `gifshare` (a GifShare).
+
+    Files are uploaded once they have settled for `settle` seconds, up to
+    `concurrency` at a time. Files which are already recorded in `state` (a
+    WatchState) are skipped. If `force` is `True`, existing images in the
+    bucket are overwritten.
+    """
+
+    def __init__(self, gifshare, directory, state, settle=DEFAULT_SETTLE,
+                 concurrency=DEFAULT_CONCURRENCY, force=False, watcher=None,
+                 clock=time.time):
+        if not isdir(directory):
+            raise UserException("{} is not a directory!".format(directory))
+        self.directory = directory
+        self._gifshare = gifshare
+        self._state = state
+        self._settle = settle
+        self._concurrency = concurrency
+        self._force = force
+        self._watcher = watcher or make_watcher(directory)
+        self._clock = clock
+        # The time each pending file may be uploaded, and its stat then:
+        self._pending = {}
+        # The number of times each file has failed to upload:
+        self._failures = {}
+
+    def _touch(self, path):
+        """
+        Record that the file at `path` has changed.
+        """
+        stat = file_stat(path)
+        if stat is None:
+            self._pending.pop(path, None)
+            self._failures.pop(path, None)
+        elif not self._state.is_handled(path, stat):
+            self._pending[path] = (self._clock() + self._settle, stat)
+
+    def scan(self):
+        """
+        Queue every file in the directory which hasn't been handled yet.
+        """
+        for path in list_files(self.directory):
+            self._touch(path)
+
+    def settled(self):
+        """
+        Return (and stop tracking) the pending files which haven't changed
+        for the settle time.
+        """
+        now = self._clock()
+        ready = []
+        for path, (due, stat) in sorted(self._pending.items()):
+            if now < due:
+                continue
+            current = file_stat(path)
+            if current is None:
+                del self._pending[path]
+            elif current != stat:
+                # Written to without an event (e.g. through a mapping):
+                self._pending[path] = (now + self._settle, current)
+            else:
+                del self._pending[path]
+                ready.append((path, stat))
+                if len(ready) >= MAX_BATCH:
+                    break
+        return ready
+
+    def upload(self, files):
+        """
+        Upload the (path, stat) pairs in `files` concurrently, recording
+        each of them in the state, and yielding an UploadResult for each.
+
+        Files which fail because of a UserException (such as not being an
+        image) are recorded as handled, so that they aren't retried. Other
+        failures are queued again, and retried after a growing delay.
+        """
+        stats = dict(files)
+        try:
+            for result in self._gifshare.upload_many(
+                    list(stats), force=self._force,
+                    concurrency=self._concurrency):
+                stat = stats[result.source]
+                if result.error is None:
+                    self._failures.pop(result.source, None)
+                    self._state.record(result.source, stat, url=result.url)
+                elif isinstance(result.error, UserException):
+                    self._failures.pop(result.source, None)
+                    self._state.record(
+                        result.source, stat, error=str(result.error))
+                else:
+                    self._retry(result.source, stat)
+                yield result
+        finally:
+            self._state.save()
+
+    def _retry(self, path, stat):
+        """
+        Queue the file at `path`, which failed to upload, to be retried
+        after a delay which doubles with each failure.
+        """
+        failures = self._failures.get(path, 0)
+        self._failures[path] = failures + 1
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** failures)
+        LOG.debug("Retrying %s in %.0f seconds", path, delay)
+        if path not in self._pending:
+            self._pending[path] = (self._clock() + delay, stat)
+
+    def step(self, timeout=None):
+        """
+        Wait for changes, then upload any files which have settled, yielding
+        an UploadResult for each.
+        """
+        if timeout is None:
+            timeout = IDLE_TIMEOUT
+            if self._pending:
+                first = min(due for due, _ in self._pending.values())
+                timeout = max(0, first - self._clock())
+        for path in self._watcher.wait(timeout):
+            self._touch(path)
+        ready = self.settled()
+        if ready:
+            LOG.debug("Uploading %d settled files", len(ready))
+            for result in self.upload(ready):
+                yield result
+
+    def run(self):
+        """
+        Upload the files already in the directory which haven't been
+        handled, then watch for new files, yielding an UploadResult for each
+        upload. Runs until interrupted.
+        """
+        self.scan()
+        try:
+            while True:
+                for result in self.step():
+                    yield result
+        finally:
+            self._watcher.close()
@@ -26,7 +26,7 @@ setup(
     license='MIT License',
     entry_points={
         'console_scripts': [
-            'gifshare = gifshare:main',
+            'gifshare = gifshare.cli:main',
         ]
     },
     packages=['gifshare'],
@@ -45,5 +45,11 @@ setup(
     install_requires=open(
         os.path.join(HERE, 'requirements/_base.txt')
     ).readlines(),
+    extras_require={
+        # libmagic is only consulted for images with unrecognised headers.
+        'magic': ['python-magic>=0.4.6'],
+        # The asyncio API in gifshare.aio:
+        'aio': ['aiobotocore>=2.0.0', 'aiohttp>=3.7.0'],
+    },
     zip_safe=False,
 )
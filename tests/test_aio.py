@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from contextlib import contextmanager
+import datetime
+import threading
+import unittest
+
+from mock import AsyncMock, MagicMock, patch
+from six.moves.configparser import ConfigParser
+
+from .util import *
+import gifshare.aio
+from gifshare.exceptions import FileAlreadyExists
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    ClientError = None
+
+try:
+    from moto.server import ThreadedMotoServer
+    import aiobotocore
+except ImportError:
+    ThreadedMotoServer = None
+
+
+defaults = {
+    'aws_access_id': 'dummy-access-id',
+    'aws_secret_access_key': 'dummy-secret-access-key',
+    'web_root': 'http://dummy.web.root/',
+    'region': 'us-east-1',
+    'bucket': 'not.a.bucket',
+    'index': 'off',
+}
+
+
+def make_config_stub(**options):
+    values = dict(defaults, **options)
+    stub = MagicMock(spec=ConfigParser)
+    stub.get.side_effect = lambda _, key: values[key]
+    stub.has_option.side_effect = lambda _, key: key in values
+    return stub
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def collect(iterable):
+    return [item async for item in iterable]
+
+
+async def aiter_(items):
+    for item in items:
+        yield item
+
+
+class TestPeek(unittest.TestCase):
+    def test_peek(self):
+        async def peek():
+            head, chunks = await gifshare.aio.peek(
+                aiter_([b'abc', b'def', b'ghi']), 4)
+            return head, await collect(chunks)
+
+        self.assertEqual(
+            run(peek()), (b'abcdef', [b'abc', b'def', b'ghi']))
+
+
+class TestAsyncGifShare(unittest.TestCase):
+    def setUp(self):
+        self.bucket = MagicMock(spec=gifshare.aio.AsyncBucket)
+        self.bucket.upload_file = AsyncMock(
+            return_value='http://dummy.web.root/test_image.png')
+        self.bucket.upload_stream = AsyncMock(
+            return_value='http://dummy.web.root/test_image.png')
+        self.bucket.get_url = AsyncMock(
+            return_value='http://dummy.web.root/test_image.png')
+        self.bucket.refresh_index = AsyncMock()
+        self.gifshare = gifshare.aio.AsyncGifShare(self.bucket)
+
+    def test_upload_file(self):
+        url = run(self.gifshare.upload_file(image_path('png')))
+        self.bucket.upload_file.assert_awaited_with(
+            'test_image.png', 'image/png', image_path('png'), False)
+        self.assertEqual(url, 'http://dummy.web.root/test_image.png')
+
+    def test_upload_file_off_the_loop(self):
+        threads = []
+
+        def correct_ext(path):
+            threads.append(threading.current_thread())
+            return 'png'
+
+        with patch('gifshare.aio.correct_ext', side_effect=correct_ext):
+            run(self.gifshare.upload_file(image_path('png')))
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_upload_url(self):
+        image_data = load_image('png')
+        streamed = []
+
+        async def upload_stream(filename, content_type, chunks, force):
+            streamed.extend(await collect(chunks))
+            return 'http://dummy.web.root/' + filename
+        self.bucket.upload_stream.side_effect = upload_stream
+
+        with patch.object(
+                self.gifshare, 'iter_download',
+                return_value=aiter_([image_data[:1000], image_data[1000:]])):
+            url = run(self.gifshare.upload_url(
+                'http://some.domain/path/kitten.png', force=True))
+        self.assertEqual(url, 'http://dummy.web.root/kitten.png')
+        self.assertEqual(b''.join(streamed), image_data)
+
+    def test_upload_many(self):
+        async def upload_file(filename, content_type, path, force):
+            if filename.startswith('test_image.gif'):
+                raise FileAlreadyExists('exists')
+            return 'http://dummy.web.root/' + filename
+        self.bucket.upload_file.side_effect = upload_file
+
+        results = run(collect(self.gifshare.upload_many(
+            [image_path('png'), image_path('gif'), image_path('jpeg')])))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(
+            sorted(result.url for result in results if result.url),
+            ['http://dummy.web.root/test_image.jpeg',
+             'http://dummy.web.root/test_image.png'])
+        [failure] = [result for result in results if result.error]
+        self.assertEqual(failure.source, image_path('gif'))
+        self.bucket.refresh_index.assert_awaited_with(force=False)
+
+    def test_grep(self):
+        self.bucket.grep = MagicMock(
+            return_value=aiter_(['http://dummy.web.root/kitten.png']))
+        self.assertEqual(
+            run(collect(self.gifshare.grep('KIT', ignore_case=True))),
+            ['http://dummy.web.root/kitten.png'])
+        self.bucket.grep.assert_called_with(
+            'KIT', ignore_case=True, regex=False)
+
+    def test_get_url(self):
+        self.assertEqual(
+            run(self.gifshare.get_url('test_image.png')),
+            'http://dummy.web.root/test_image.png')
+
+
+def client_error(status):
+    return ClientError(
+        {'Error': {'Code': str(status)},
+         'ResponseMetadata': {'HTTPStatusCode': status}}, 'operation')
+
+
+@unittest.skipIf(ClientError is None, 'botocore is not installed')
+class TestAsyncBucket(unittest.TestCase):
+    def make_bucket(self, **options):
+        bucket = gifshare.aio.AsyncBucket(
+            make_config_stub(**options), concurrency=2)
+        bucket._client = MagicMock()
+        for operation in ('put_object', 'head_object',
+                          'create_multipart_upload', 'upload_part',
+                          'complete_multipart_upload',
+                          'abort_multipart_upload'):
+            setattr(bucket._client, operation, AsyncMock())
+        return bucket
+
+    async def with_slots(self, bucket, coroutine):
+        bucket._slots = asyncio.Semaphore(2)
+        return await coroutine
+
+    def test_upload_file(self):
+        bucket = self.make_bucket()
+        bucket._client.put_object.return_value = {'ETag': '"etag"'}
+        url = run(self.with_slots(bucket, bucket.upload_file(
+            'test_image.png', 'image/png', image_path('png'))))
+        self.assertEqual(url, 'http://dummy.web.root/test_image.png')
+        kwargs = bucket._client.put_object.call_args[1]
+        self.assertEqual(kwargs['Body'], load_image('png'))
+        self.assertEqual(kwargs['IfNoneMatch'], '*')
+        self.assertFalse(bucket._client.head_object.called)
+
+    def test_index_is_used_off_the_loop(self):
+        bucket = self.make_bucket()
+        bucket._client.put_object.return_value = {'ETag': '"etag"'}
+        bucket.index = MagicMock()
+        bucket.index.is_stale.return_value = False
+        bucket.index.__contains__.return_value = False
+        threads = []
+        bucket.index.add.side_effect = (
+            lambda *args: threads.append(threading.current_thread()))
+        bucket.index.is_stale.side_effect = (
+            lambda: threads.append(threading.current_thread()))
+        run(self.with_slots(bucket, bucket.upload_file(
+            'test_image.png', 'image/png', image_path('png'))))
+        bucket.index.add.assert_called_once_with(
+            'test_image.png', len(load_image('png')), '"etag"')
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_file_is_mapped_off_the_loop(self):
+        bucket = self.make_bucket()
+        bucket._client.put_object.return_value = {'ETag': '"etag"'}
+        threads = []
+        map_file = gifshare.aio.map_file
+
+        @contextmanager
+        def mapping(path):
+            threads.append(threading.current_thread())
+            with map_file(path) as data:
+                yield data
+
+        with patch('gifshare.aio.map_file', side_effect=mapping):
+            run(self.with_slots(bucket, bucket.upload_file(
+                'test_image.png', 'image/png', image_path('png'))))
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_upload_exists(self):
+        bucket = self.make_bucket()
+        bucket._client.put_object.side_effect = client_error(412)
+        with self.assertRaises(FileAlreadyExists):
+            run(self.with_slots(bucket, bucket.upload_stream(
+                'test_image.png', 'image/png', aiter_([b'data']))))
+
+    @patch('gifshare.aio.MIN_PART_SIZE', 1024)
+    def test_upload_stream_multipart(self):
+        bucket = self.make_bucket(
+            multipart_threshold='4k', multipart_chunksize='2k')
+        bucket._client.head_object.side_effect = client_error(404)
+        bucket._client.create_multipart_upload.return_value = {
+            'UploadId': 'upload-id'}
+        bucket._client.upload_part.side_effect = (
+            lambda **kwargs: {'ETag': str(kwargs['PartNumber'])})
+        bucket._client.complete_multipart_upload.return_value = {
+            'ETag': '"etag-3"'}
+        data = load_image('jpeg')
+        run(self.with_slots(bucket, bucket.upload_stream(
+            'test_image.jpeg', 'image/jpeg',
+            aiter_([data[i:i + 700] for i in range(0, len(data), 700)]))))
+
+        sent = sorted(
+            (call[1]['PartNumber'], call[1]['Body'])
+            for call in bucket._client.upload_part.call_args_list)
+        self.assertEqual(b''.join(body for _, body in sent), data)
+        self.assertTrue(all(len(body) == 2048 for _, body in sent[:-1]))
+        kwargs = bucket._client.complete_multipart_upload.call_args[1]
+        self.assertEqual(
+            kwargs['MultipartUpload']['Parts'],
+            [{'ETag': str(n), 'PartNumber': n} for n, _ in sent])
+        self.assertEqual(kwargs['IfNoneMatch'], '*')
+
+    @patch('gifshare.aio.MIN_PART_SIZE', 1024)
+    def test_upload_file_multipart_failure(self):
+        bucket = self.make_bucket(
+            multipart_threshold='4k', multipart_chunksize='2k')
+        bucket._client.head_object.side_effect = client_error(404)
+        bucket._client.create_multipart_upload.return_value = {
+            'UploadId': 'upload-id'}
+        bucket._client.upload_part.side_effect = IOError
+        with self.assertRaises(IOError):
+            run(self.with_slots(bucket, bucket.upload_file(
+                'test_image.jpeg', 'image/jpeg', image_path('jpeg'))))
+        bucket._client.abort_multipart_upload.assert_awaited_with(
+            Bucket='not.a.bucket', Key='test_image.jpeg',
+            UploadId='upload-id')
+        self.assertFalse(bucket._client.complete_multipart_upload.called)
+
+    def test_list(self):
+        bucket = self.make_bucket()
+        modified = datetime.datetime(2014, 11, 7)
+        bucket._client.get_paginator.return_value.paginate.return_value = \
+            aiter_([
+                {'Contents': [
+                    {'Key': 'a.gif', 'Size': 1, 'ETag': '"1"',
+                     'LastModified': modified}]},
+                {'Contents': [
+                    {'Key': 'b.png', 'Size': 2, 'ETag': '"2"',
+                     'LastModified': modified}]},
+            ])
+        self.assertEqual(run(collect(bucket.list())), [
+            'http://dummy.web.root/a.gif', 'http://dummy.web.root/b.png'])
+
+    def test_get_url_missing(self):
+        bucket = self.make_bucket()
+        bucket._client.head_object.side_effect = client_error(404)
+        with self.assertRaises(gifshare.aio.MissingFile):
+            run(self.with_slots(bucket, bucket.get_url('missing.gif')))
+
+
+@unittest.skipIf(
+    ThreadedMotoServer is None, 'moto[server] and aiobotocore are required')
+class TestAsyncBucketAgainstMoto(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadedMotoServer(port=0, verbose=False)
+        self.server.start()
+        host, port = self.server.get_host_and_port()
+        self.config = make_config_stub(
+            endpoint_url='http://{}:{}'.format(host, port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_round_trip(self):
+        async def round_trip():
+            async with gifshare.aio.AsyncBucket(self.config) as bucket:
+                await bucket._client.create_bucket(Bucket='not.a.bucket')
+                gs = gifshare.aio.AsyncGifShare(bucket)
+                url = await gs.upload_file(image_path('png'), 'kitten')
+                with self.assertRaises(FileAlreadyExists):
+                    await gs.upload_file(image_path('png'), 'kitten')
+                return (url, await gs.get_url('kitten.png'),
+                        await collect(gs.grep('KIT', ignore_case=True)))
+
+        url, expanded, matches = run(round_trip())
+        self.assertEqual(url, 'http://dummy.web.root/kitten.png')
+        self.assertEqual(expanded, url)
+        self.assertEqual(matches, [url])
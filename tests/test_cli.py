@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from nose.tools import assert_raises
 from mock import MagicMock, patch, call, ANY
 
 from .util import *
 import gifshare.cli
+from gifshare.exceptions import DaemonError
+import gifshare.s3
+import gifshare.timing
 
 config_stub = MagicMock()
+config_stub.has_option.return_value = False
 
 
 class TestMain(unittest.TestCase):
@@ -21,6 +30,24 @@ class TestMain(unittest.TestCase):
         gifshare.cli.main(['list'])
         self.assertEqual(cmd_list.call_count, 1)
 
+    @patch('gifshare.cli.command_list')
+    def test_main_stats_json(self, cmd_list):
+        def command(arguments, config):
+            with gifshare.timing.span('s3.list'):
+                gifshare.timing.record(requests=2)
+        cmd_list.side_effect = command
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'stats.json')
+
+        self.assertEqual(
+            gifshare.cli.main(['--stats-json', path, 'list']), 0)
+        with open(path) as stats_file:
+            stats = json.load(stats_file)
+        self.assertEqual(stats['command'], 'list')
+        self.assertEqual(stats['phases']['s3.list']['requests'], 2)
+        self.assertEqual(stats['phases']['s3.list']['count'], 1)
+
     @patch('gifshare.cli.command_list')
     def test_main_error(self, cmd_list):
         cmd_list.side_effect = gifshare.exceptions.UserException
@@ -28,7 +55,7 @@ class TestMain(unittest.TestCase):
         self.assertEqual(result, 1)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_list_arguments(self, bucket_mock, load_config_stub):
         bucket_instance = MagicMock()
         bucket_mock.return_value = bucket_instance
@@ -38,67 +65,136 @@ class TestMain(unittest.TestCase):
         ]
 
         gifshare.cli.main(['list'])
-        self.assertEqual(bucket_mock.call_args, call(config_stub))
+        self.assertEqual(bucket_mock.call_args, call(config_stub, progress=True))
         self.assertEqual(bucket_instance.list.call_count, 1)
 
-    @patch('random.choice')
+    @patch('gifshare.cli.reservoir_sample')
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
-    def test_main_list_random(self, bucket_mock, load_config_stub, random_choice):
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_list_random(self, bucket_mock, load_config_stub,
+                              reservoir_sample):
         bucket_instance = MagicMock()
         bucket_mock.return_value = bucket_instance
-        bucket_instance.list.return_value = [
+        urls = iter([
             'http://dummy.web.root/image1.jpeg',
             'http://dummy.web.root/image2.jpeg',
-        ]
+        ])
+        bucket_instance.list.return_value = urls
+        reservoir_sample.return_value = ['http://dummy.web.root/image2.jpeg']
 
         gifshare.cli.main(['list', '-r'])
         bucket_init = bucket_mock.call_args
-        self.assertEqual(bucket_init, call(config_stub))
+        self.assertEqual(bucket_init, call(config_stub, progress=True))
         self.assertEqual(bucket_instance.list.call_count, 1)
 
-        self.assertEqual(random_choice.call_count, 1)
+        # The URLs are sampled as they are streamed, not gathered first:
+        reservoir_sample.assert_called_once_with(urls, 1)
+
+        gifshare.cli.main(['list', '-r', '-n', '5'])
+        reservoir_sample.assert_called_with(urls, 5)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
-    @patch('gifshare.core.download_file')
-    def test_main_upload_url(self, download_file, bucket_mock, load_config_stub):
-        download_file.return_value = load_image('png')
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    @patch('gifshare.core.iter_download')
+    def test_main_upload_url(self, iter_download, bucket_mock, load_config_stub):
+        iter_download.return_value = iter([load_image('png')])
 
         gifshare.cli.main(['upload', 'http://probably.giphy/kittiez.png'])
-        self.assertEqual(bucket_mock.call_args, call(config_stub))
-        self.assertEqual(download_file.call_count, 1)
+        self.assertEqual(bucket_mock.call_args, call(config_stub, progress=True))
+        self.assertEqual(iter_download.call_count, 1)
 
+    @patch('sys.stderr')
+    @patch('gifshare.session.shared_session')
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_upload_url_not_found(self, bucket_mock, load_config_stub,
+                                       shared_session, stderr_stub):
+        response = MagicMock(status_code=404, reason='Not Found', headers={})
+        shared_session.return_value.get.return_value = response
+
+        result = gifshare.cli.main(
+            ['--no-daemon', 'upload', 'http://probably.giphy/missing.gif'])
+        self.assertEqual(result, 1)
+        stderr_stub.write.assert_any_call(
+            "http://probably.giphy/missing.gif couldn't be downloaded: "
+            "the server said 404 Not Found")
+        self.assertFalse(bucket_mock.return_value.upload_stream.called)
+
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_upload_file(self, bucket_mock, load_config_stub):
         gifshare.cli.main(['upload', image_path('png')])
-        self.assertEqual(bucket_mock.call_args, call(config_stub))
+        self.assertEqual(bucket_mock.call_args, call(config_stub, progress=True))
+        self.assertEqual(bucket_mock.return_value.upload_file.call_count, 1)
+
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_upload_resume(self, bucket_mock, load_config_stub):
+        gifshare.cli.main(['upload', '--resume', image_path('png')])
+        bucket_mock.return_value.upload_file.assert_called_once_with(
+            'test_image.png', 'image/png', image_path('png'), False,
+            resume=True, data=ANY, md5=None)
+
+    @patch('sys.stderr')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_cleanup(self, bucket_mock, load_config_stub, stderr_stub):
+        bucket_mock.return_value.cleanup_uploads.return_value = ['a.gif']
+        gifshare.cli.main(['cleanup', '--max-age', '3600'])
+        bucket_mock.return_value.cleanup_uploads.assert_called_once_with(3600)
+
+    @patch('sys.stderr')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_batch(self, bucket_mock, load_config_stub, stderr_stub):
+        result = gifshare.cli.main(
+            ['batch', '-j', '2', image_path('png'), image_path('gif')])
+        self.assertEqual(
+            bucket_mock.call_args, call(config_stub, progress=False))
+        self.assertEqual(bucket_mock.return_value.upload_file.call_count, 2)
+        self.assertEqual(result, 0)
+
+    @patch('sys.stderr')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_batch_failure(self, bucket_mock, load_config_stub,
+                                stderr_stub):
+        result = gifshare.cli.main(
+            ['batch', image_path('png'), '/tmp/non-existent.png'])
         self.assertEqual(bucket_mock.return_value.upload_file.call_count, 1)
+        self.assertEqual(result, 1)
+
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_upload_dedup(self, bucket_mock, load_config_stub):
+        bucket_mock.return_value.find_duplicate.return_value = 'old.png'
+        gifshare.cli.main(['upload', '--dedup', 'link', image_path('png')])
+        bucket_mock.return_value.url_for.assert_called_with('old.png')
+        self.assertFalse(bucket_mock.return_value.upload_file.called)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_upload_missing_file(self, bucket_mock, load_config_stub):
         with self.assertRaises(IOError):
             gifshare.cli.main(['upload', '/tmp/non-existent.png'])
             self.assertEqual(bucket_mock.call_count, 0)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_delete(self, bucket_mock, load_config_stub):
         result = gifshare.cli.main(['delete', 'my/file.png'])
         bucket_mock.return_value.delete_file.assert_called_with('my/file.png')
         self.assertEqual(result, 0)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_expand(self, bucket_mock, load_config_stub):
         result = gifshare.cli.main(['expand', 'test.png'])
         bucket_mock.return_value.get_url.assert_called_with('test.png')
         self.assertEqual(result, 0)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     @patch('webbrowser.open_new')
     def test_main_show(self, open_new_mock, bucket_mock, load_config_stub):
         result = gifshare.cli.main(['show', 'test.png'])
@@ -106,12 +202,162 @@ class TestMain(unittest.TestCase):
         self.assertEqual(result, 0)
 
     @patch('gifshare.cli.load_config', return_value=config_stub)
-    @patch('gifshare.cli.Bucket', spec=gifshare.cli.Bucket)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
     def test_main_grep(self, bucket_mock, load_config_stub):
         bucket_mock.return_value.grep.return_value = [
             'http://dummy.web.root/image1.jpeg',
             'http://dummy.web.root/image2.jpeg',
         ]
         result = gifshare.cli.main(['grep', 'test'])
-        bucket_mock.return_value.grep.assert_called_with('test')
+        bucket_mock.return_value.grep.assert_called_with(
+            'test', ignore_case=False, regex=False)
         self.assertEqual(result, 0)
+
+        result = gifshare.cli.main(['grep', '-i', '-E', 'te.t'])
+        bucket_mock.return_value.grep.assert_called_with(
+            'te.t', ignore_case=True, regex=True)
+        self.assertEqual(result, 0)
+
+    @patch('gifshare.cli.daemon.request')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    @patch('sys.stdout')
+    def test_main_uses_daemon(self, stdout_stub, bucket_mock,
+                              load_config_stub, request_mock):
+        request_mock.return_value = {
+            'status': 0, 'stdout': 'http://dummy.web.root/test.png\n',
+            'stderr': ''}
+        result = gifshare.cli.main(['expand', 'test.png'])
+        request_mock.assert_called_with(
+            ANY, ['expand', 'test.png'], config_stub)
+        stdout_stub.write.assert_called_with('http://dummy.web.root/test.png\n')
+        self.assertEqual(bucket_mock.call_count, 0)
+        self.assertEqual(result, 0)
+
+    @patch('gifshare.cli.daemon.request', return_value=None)
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_daemon_refused(self, bucket_mock, load_config_stub,
+                                 request_mock):
+        result = gifshare.cli.main(['expand', 'test.png'])
+        self.assertEqual(request_mock.call_count, 1)
+        bucket_mock.return_value.get_url.assert_called_with('test.png')
+        self.assertEqual(result, 0)
+
+    @patch('gifshare.cli.daemon.request',
+           side_effect=DaemonError('No answer'))
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    @patch('sys.stderr')
+    def test_main_daemon_stalled(self, stderr_stub, bucket_mock,
+                                 load_config_stub, request_mock):
+        result = gifshare.cli.main(['delete', 'test.png'])
+        self.assertEqual(bucket_mock.call_count, 0)
+        self.assertEqual(result, 1)
+
+    @patch('gifshare.cli.daemon.request')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    def test_main_no_daemon(self, bucket_mock, load_config_stub, request_mock):
+        result = gifshare.cli.main(['--no-daemon', 'expand', 'test.png'])
+        self.assertEqual(request_mock.call_count, 0)
+        bucket_mock.return_value.get_url.assert_called_with('test.png')
+        self.assertEqual(result, 0)
+
+    @patch('gifshare.cli.daemon.request')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.cli.command_upload')
+    def test_main_upload_skips_daemon(self, cmd_upload, load_config_stub,
+                                      request_mock):
+        gifshare.cli.main(['upload', 'a-file'])
+        self.assertEqual(request_mock.call_count, 0)
+        self.assertEqual(cmd_upload.call_count, 1)
+
+
+class TestDelete(unittest.TestCase):
+    def setUp(self):
+        self.bucket = MagicMock(spec=gifshare.s3.Bucket)
+        self.bucket.delete_files.side_effect = lambda names, concurrency: [
+            gifshare.s3.DeleteResult(name, None) for name in names]
+
+    def parse(self, *argv):
+        return gifshare.cli.build_parser().parse_args(('delete',) + argv)
+
+    @patch('sys.stderr')
+    def test_many(self, stderr_stub):
+        gifshare.cli.command_delete(
+            self.parse('a.gif', 'b.gif', 'a.gif', '-j', '2'), config_stub,
+            bucket=self.bucket)
+        self.bucket.delete_files.assert_called_with(
+            ['a.gif', 'b.gif'], concurrency=2)
+        self.assertFalse(self.bucket.delete_file.called)
+
+    @patch('sys.stderr')
+    @patch('sys.stdin', ['a.gif\n', '\n', 'b.gif\n'])
+    def test_stdin(self, stderr_stub):
+        gifshare.cli.command_delete(
+            self.parse('-'), config_stub, bucket=self.bucket)
+        self.bucket.delete_files.assert_called_with(
+            ['a.gif', 'b.gif'], concurrency=gifshare.core.DEFAULT_CONCURRENCY)
+
+    @patch('sys.stderr')
+    def test_grep(self, stderr_stub):
+        self.bucket.names_matching.return_value = iter(['kitten.gif'])
+        gifshare.cli.command_delete(
+            self.parse('--grep', 'KIT', '-i'), config_stub,
+            bucket=self.bucket)
+        self.bucket.names_matching.assert_called_with(
+            'KIT', ignore_case=True, regex=False)
+        self.bucket.delete_files.assert_called_with(
+            ['kitten.gif'], concurrency=gifshare.core.DEFAULT_CONCURRENCY)
+
+    @patch('sys.stdout')
+    def test_dry_run(self, stdout_stub):
+        self.bucket.names_matching.return_value = iter(['kitten.gif'])
+        gifshare.cli.command_delete(
+            self.parse('--dry-run', '--grep', 'kit', 'puppy.gif'),
+            config_stub, bucket=self.bucket)
+        stdout_stub.write.assert_any_call('puppy.gif')
+        stdout_stub.write.assert_any_call('kitten.gif')
+        self.assertFalse(self.bucket.delete_files.called)
+        self.assertFalse(self.bucket.delete_file.called)
+
+    @patch('sys.stderr')
+    def test_failures(self, stderr_stub):
+        self.bucket.delete_files.side_effect = lambda names, concurrency: [
+            gifshare.s3.DeleteResult('a.gif', None),
+            gifshare.s3.DeleteResult('b.gif', 'AccessDenied: Denied')]
+        with self.assertRaises(gifshare.exceptions.UserException):
+            gifshare.cli.command_delete(
+                self.parse('a.gif', 'b.gif'), config_stub,
+                bucket=self.bucket)
+
+    def test_nothing_selected(self):
+        with self.assertRaises(gifshare.exceptions.UserException):
+            gifshare.cli.command_delete(
+                self.parse(), config_stub, bucket=self.bucket)
+
+    @patch('gifshare.cli.daemon.request')
+    @patch('gifshare.cli.load_config', return_value=config_stub)
+    @patch('gifshare.s3.Bucket', spec=gifshare.s3.Bucket)
+    @patch('sys.stdin', ['a.gif\n'])
+    @patch('sys.stderr')
+    def test_stdin_skips_daemon(self, stderr_stub, bucket_mock,
+                                load_config_stub, request_mock):
+        bucket_mock.return_value.delete_files.return_value = []
+        gifshare.cli.main(['delete', '-'])
+        self.assertEqual(request_mock.call_count, 0)
+
+
+class TestStartup(unittest.TestCase):
+    def test_cli_import_is_light(self):
+        # Slow third-party modules are only imported by the commands that
+        # use them:
+        code = (
+            'import sys, gifshare, gifshare.cli; '
+            'print(" ".join(sorted(sys.modules)))')
+        modules = subprocess.check_output(
+            [sys.executable, '-c', code]).decode('utf-8').split()
+        for heavy in ('boto', 'magic', 'requests', 'progressbar',
+                      'webbrowser', 'sqlite3', 'gifshare.s3'):
+            self.assertNotIn(heavy, modules)
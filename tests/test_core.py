@@ -2,13 +2,16 @@
 
 from __future__ import absolute_import
 
+import random
+import tempfile
 import unittest
 from nose.tools import assert_raises
-from mock import MagicMock, patch, call, ANY
+from mock import MagicMock, patch, ANY
 
 from .util import *
 
 import gifshare
+import gifshare.s3
 
 
 class TestGifShare(unittest.TestCase):
@@ -27,30 +30,142 @@ class TestGifShare(unittest.TestCase):
             u'test_image.png',
             u'image/png',
             image_path('png'),
-            False
+            False,
+            resume=False,
+            data=ANY,
+            md5=None
         )
         self.assertEqual(url, 'http://dummy.web.root/test_image.png')
 
+    def test_upload_file_unknown_type(self):
+        # Uses the real libmagic fallback (if it's installed), which must be
+        # given bytes rather than the file's mapping:
+        bucket = self._configure_bucket_instance_mock()
+        gs = gifshare.core.GifShare(bucket)
+        with assert_raises(gifshare.core.UnknownFileType):
+            gs.upload_file(image_path('ico'))
+        self.assertFalse(bucket.upload_file.called)
+
+    def test_upload_file_dedup_miss(self):
+        bucket = self._configure_bucket_instance_mock()
+
+        def find_duplicate(chunks, digests):
+            digests['md5'] = b'digest'
+            return None
+
+        uploaded = []
+
+        def upload_file(*args, **kwargs):
+            # The mapping is closed once the upload returns:
+            uploaded.append((bytes(kwargs['data']), kwargs['md5']))
+
+        bucket.find_duplicate.side_effect = find_duplicate
+        bucket.upload_file.side_effect = upload_file
+        gs = gifshare.core.GifShare(bucket, dedup='link')
+        gs.upload_file(image_path('png'))
+        self.assertEqual(uploaded, [(load_image('png'), b'digest')])
+
     def test_upload_missing_file(self):
         bucket = self._configure_bucket_instance_mock()
         gs = gifshare.core.GifShare(bucket)
         with assert_raises(IOError):
             gs.upload_file('/tmp/non-existent')
 
-    @patch('gifshare.core.download_file')
-    def test_upload_url(self, download_file_stub):
-        download_file_stub.return_value = load_image('png')
+    @patch('gifshare.core.iter_download')
+    def test_upload_url_not_image(self, iter_download_stub):
+        download = MagicMock(name='download')
+        download.__iter__.return_value = iter([b'<html>' * 1000])
+        iter_download_stub.return_value = download
         bucket = self._configure_bucket_instance_mock()
+        gs = gifshare.core.GifShare(bucket, max_size=1024)
+        with assert_raises(gifshare.exceptions.UnknownFileType):
+            gs.upload_url('http://nonsense.url/page.html')
+        # The rest of the download is abandoned:
+        download.close.assert_called_once_with()
+        self.assertEqual(
+            iter_download_stub.call_args[1]['max_size'], 1024)
+        self.assertFalse(bucket.upload_stream.called)
+
+    @patch('gifshare.core.iter_download')
+    def test_upload_url(self, iter_download_stub):
+        image_data = load_image('png')
+        iter_download_stub.return_value = iter(
+            [image_data[:1000], image_data[1000:]])
+        bucket = self._configure_bucket_instance_mock()
+        bucket.upload_stream.return_value = \
+            'http://dummy.web.root/test_image.png'
+        streamed = []
+        bucket.upload_stream.side_effect = (
+            lambda _n, _c, chunks, _f: streamed.extend(chunks) or
+            bucket.upload_stream.return_value)
         gs = gifshare.core.GifShare(bucket)
         url = gs.upload_url(image_path('png'))
-        bucket.upload_contents.assert_called_with(
+        bucket.upload_stream.assert_called_with(
             u'test_image.png',
             u'image/png',
-            load_image('png'),
+            ANY,
             False
         )
+        self.assertEqual(b''.join(streamed), image_data)
         self.assertEqual(url, 'http://dummy.web.root/test_image.png')
 
+    def test_upload_file_dedup_link(self):
+        bucket = self._configure_bucket_instance_mock()
+        hashed = []
+        bucket.find_duplicate.side_effect = (
+            lambda chunks, digests: hashed.extend(bytes(c) for c in chunks) or
+            'original.png')
+        bucket.url_for.return_value = 'http://dummy.web.root/original.png'
+        gs = gifshare.core.GifShare(bucket, dedup='link')
+
+        url = gs.upload_file(image_path('png'))
+        self.assertEqual(url, 'http://dummy.web.root/original.png')
+        self.assertEqual(b''.join(hashed), load_image('png'))
+        self.assertFalse(bucket.upload_file.called)
+        self.assertFalse(bucket.copy_file.called)
+
+    def test_upload_file_dedup_copy(self):
+        bucket = self._configure_bucket_instance_mock()
+        bucket.find_duplicate.return_value = 'original.png'
+        gs = gifshare.core.GifShare(bucket, dedup='copy')
+
+        gs.upload_file(image_path('png'), force=True)
+        bucket.copy_file.assert_called_with(
+            'original.png', 'test_image.png', 'image/png', True)
+        self.assertFalse(bucket.upload_file.called)
+
+    def test_upload_file_dedup_same_name(self):
+        bucket = self._configure_bucket_instance_mock()
+        bucket.find_duplicate.return_value = 'test_image.png'
+        gs = gifshare.core.GifShare(bucket, dedup='copy')
+
+        gs.upload_file(image_path('png'))
+        bucket.url_for.assert_called_with('test_image.png')
+        self.assertFalse(bucket.copy_file.called)
+
+    def test_upload_file_dedup_no_match(self):
+        bucket = self._configure_bucket_instance_mock()
+        bucket.find_duplicate.return_value = None
+        gs = gifshare.core.GifShare(bucket, dedup='copy')
+
+        gs.upload_file(image_path('png'))
+        self.assertEqual(bucket.upload_file.call_count, 1)
+
+    @patch('gifshare.core.iter_download')
+    def test_upload_url_dedup(self, iter_download_stub):
+        iter_download_stub.return_value = iter([load_image('png')])
+        bucket = self._configure_bucket_instance_mock()
+        bucket.find_duplicate.return_value = 'original.png'
+        gs = gifshare.core.GifShare(bucket, dedup='link')
+
+        gs.upload_url('http://some.domain/path/test_image.png')
+        bucket.url_for.assert_called_with('original.png')
+        self.assertFalse(bucket.upload_stream.called)
+
+    def test_invalid_dedup(self):
+        with self.assertRaises(ValueError):
+            gifshare.core.GifShare(MagicMock(), dedup='maybe')
+
     def test_delete_existing(self):
         bucket = self._configure_bucket_instance_mock()
         gs = gifshare.core.GifShare(bucket)
@@ -76,6 +191,35 @@ class TestGifShare(unittest.TestCase):
         gs.show('test.png')
         open_new.assert_called_with('http://dummy.web.root/test.png')
 
+    @patch('gifshare.core.iter_download')
+    def test_upload_dispatches_url(self, iter_download_stub):
+        iter_download_stub.return_value = iter([load_image('png')])
+        bucket = self._configure_bucket_instance_mock()
+        gs = gifshare.core.GifShare(bucket)
+        gs.upload('http://some.domain/path/test_image.png')
+        self.assertEqual(bucket.upload_stream.call_count, 1)
+
+    def test_upload_dispatches_file(self):
+        bucket = self._configure_bucket_instance_mock()
+        gs = gifshare.core.GifShare(bucket)
+        gs.upload(image_path('png'))
+        self.assertEqual(bucket.upload_file.call_count, 1)
+
+    def test_upload_many(self):
+        bucket = self._configure_bucket_instance_mock()
+        gs = gifshare.core.GifShare(bucket)
+        results = list(gs.upload_many(
+            [image_path('png'), image_path('gif'), '/tmp/non-existent'],
+            concurrency=2))
+
+        self.assertEqual(len(results), 3)
+        bucket.prepare_batch.assert_called_once_with()
+        self.assertEqual(bucket.upload_file.call_count, 2)
+        failures = [r for r in results if r.error is not None]
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].source, '/tmp/non-existent')
+        self.assertIsInstance(failures[0].error, IOError)
+
     def test_grep(self):
         bucket = self._configure_bucket_instance_mock()
         bucket.grep.return_value = [
@@ -84,7 +228,8 @@ class TestGifShare(unittest.TestCase):
         ]
         gs = gifshare.core.GifShare(bucket)
         gs.grep('pattern')
-        bucket.grep.assert_called_with('pattern')
+        bucket.grep.assert_called_with(
+            'pattern', ignore_case=False, regex=False)
 
 
 class TestExtensionDetection(unittest.TestCase):
@@ -122,32 +267,96 @@ class TestExtensionDetection(unittest.TestCase):
         with self.assertRaises(gifshare.core.UnknownFileType):
             gifshare.core.correct_ext(load_image('ico'), True)
 
+    def test_webp(self):
+        self.assertEqual(
+            gifshare.core.correct_ext(b'RIFF\x24\x00\x00\x00WEBPVP8 ', True),
+            'webp')
+
+    @patch('gifshare.core.magic_ext', return_value='jpeg')
+    def test_magic_fallback(self, magic_ext):
+        self.assertEqual(
+            gifshare.core.correct_ext(b'\x00' * 100, True), 'jpeg')
+        magic_ext.assert_called_with(
+            b'\x00' * gifshare.sniff.HEADER_SIZE, True)
+
+    @patch('gifshare.core.magic_ext')
+    def test_signature_skips_magic(self, magic_ext):
+        gifshare.core.correct_ext(image_path('gif'))
+        self.assertEqual(magic_ext.call_count, 0)
+
 
 class TestMiscellaneousFunctions(unittest.TestCase):
-    @patch('gifshare.core.progressbar.ProgressBar')
-    @patch('gifshare.core.requests')
-    def test_download_file(self, requests_mock, progress_bar_stub):
-        pbar_mock = MagicMock()
-        progress_bar_stub.return_value.start.return_value = pbar_mock
-
-        response_stub = MagicMock()
-        response_stub.headers = {
-            'content-length': 197
-        }
-
-        def iter_content_stub(_):
-            for i in range(3):
-                yield ' ' * 64
-            yield ' ' * 5
-        response_stub.iter_content = iter_content_stub
-        requests_mock.get.return_value = response_stub
-        gifshare.core.download_file('http://nonsense.url/')
-        requests_mock.get.assert_called_with(
-            'http://nonsense.url/', stream=True)
-        pbar_mock.update.assert_has_calls([
-            call(64), call(128), call(192), call(197)
+    def test_find_sources(self):
+        fixtures = os.path.dirname(image_path('png'))
+        sources = gifshare.core.find_sources([
+            'http://some.domain/path/myfile.jpeg',
+            os.path.join(fixtures, '*.gif'),
+            fixtures,
+            '/tmp/non-existent.png',
         ])
-        pbar_mock.finish.assert_called_once_with()
+        self.assertEqual(sources[0], 'http://some.domain/path/myfile.jpeg')
+        self.assertEqual(sources[1], image_path('gif'))
+        self.assertEqual(sources[2:6], [
+            image_path('gif'), image_path('ico'),
+            image_path('jpeg'), image_path('png')])
+        self.assertEqual(sources[6], '/tmp/non-existent.png')
+
+    def test_peek(self):
+        head, chunks = gifshare.core.peek(
+            iter([b'abc', b'def', b'ghi']), 4)
+        self.assertEqual(head, b'abcdef')
+        self.assertEqual(list(chunks), [b'abc', b'def', b'ghi'])
+
+        head, chunks = gifshare.core.peek(iter([b'ab']), 4)
+        self.assertEqual(head, b'ab')
+        self.assertEqual(list(chunks), [b'ab'])
+
+    def test_reservoir_sample(self):
+        self.assertEqual(
+            sorted(gifshare.core.reservoir_sample(range(3), 5)), [0, 1, 2])
+        self.assertEqual(gifshare.core.reservoir_sample(range(3), 0), [])
+        self.assertEqual(gifshare.core.reservoir_sample([], 1), [])
+
+        sample = gifshare.core.reservoir_sample(
+            range(100000), 10, random.Random(1))
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(len(set(sample)), 10)
+
+    def test_reservoir_sample_is_uniform(self):
+        rng = random.Random(42)
+        counts = [0] * 20
+        for _ in range(20000):
+            for item in gifshare.core.reservoir_sample(range(20), 2, rng):
+                counts[item] += 1
+        # Each item is picked 2000 times on average:
+        self.assertTrue(all(1800 < count < 2200 for count in counts), counts)
+
+    def test_reservoir_sample_streams(self):
+        consumed = []
+
+        def items():
+            for i in range(1000):
+                consumed.append(i)
+                yield i
+        gifshare.core.reservoir_sample(items(), 3)
+        self.assertEqual(len(consumed), 1000)
+
+    def test_map_file(self):
+        with gifshare.core.map_file(image_path('gif')) as data:
+            self.assertEqual(data[:6], b'GIF89a')
+            self.assertEqual(bytes(data), load_image('gif'))
+
+    def test_map_empty_file(self):
+        with tempfile.NamedTemporaryFile() as empty:
+            with gifshare.core.map_file(empty.name) as data:
+                self.assertEqual(data, b'')
+
+    def test_parse_size(self):
+        self.assertEqual(gifshare.core.parse_size('1048576'), 1048576)
+        self.assertEqual(gifshare.core.parse_size('512k'), 512 * 1024)
+        self.assertEqual(gifshare.core.parse_size('8MB'), 8 * 1024 ** 2)
+        with self.assertRaises(ValueError):
+            gifshare.core.parse_size('lots')
 
     def test_get_name_from_url(self):
         self.assertEqual(
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import MagicMock, patch
+from six.moves.configparser import ConfigParser
+
+import gifshare.daemon
+from gifshare.exceptions import DaemonError, UserException
+
+
+config_stub = MagicMock()
+config_stub.has_option.return_value = False
+
+
+class TestSocketPath(unittest.TestCase):
+    def test_default(self):
+        self.assertEqual(
+            gifshare.daemon.socket_path(config_stub),
+            os.path.expanduser('~/.gifshare.sock'))
+
+    def test_configured(self):
+        config = MagicMock()
+        config.has_option.return_value = True
+        config.get.return_value = '/tmp/gifshare.sock'
+        self.assertEqual(
+            gifshare.daemon.socket_path(config), '/tmp/gifshare.sock')
+
+
+def make_config(**options):
+    config = ConfigParser()
+    config.add_section('default')
+    for name, value in options.items():
+        config.set('default', name, value)
+    return config
+
+
+class TestStoreIdentity(unittest.TestCase):
+    def test_identity(self):
+        config = make_config(
+            bucket='gifs', web_root='http://dummy.web.root/',
+            aws_secret_access_key='secret', dedup='link')
+        self.assertEqual(gifshare.daemon.store_identity(config), {
+            'bucket': 'gifs', 'web_root': 'http://dummy.web.root/'})
+
+    def test_paths_are_absolute(self):
+        identity = gifshare.daemon.store_identity(
+            make_config(storage='local', local_root='gifs'))
+        self.assertEqual(identity['local_root'], os.path.abspath('gifs'))
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.bucket = MagicMock()
+        self.daemon = gifshare.daemon.Daemon(config_stub, bucket=self.bucket)
+
+    def test_run(self):
+        self.bucket.get_url.return_value = 'http://dummy.web.root/test.png'
+        with self.daemon.redirected():
+            response = self.daemon.run(['expand', 'test.png'], {})
+        self.assertEqual(response, {
+            'status': 0,
+            'stdout': 'http://dummy.web.root/test.png\n',
+            'stderr': '',
+        })
+
+    def test_run_user_exception(self):
+        self.bucket.delete_file.side_effect = UserException('No such file')
+        with self.daemon.redirected():
+            response = self.daemon.run(['delete', 'missing.png'], {})
+        self.assertEqual(response['status'], 1)
+        self.assertEqual(response['stderr'], 'No such file\n')
+
+    def test_run_refuses_other_commands(self):
+        with self.daemon.redirected():
+            response = self.daemon.run(['show', 'test.png'], {})
+        self.assertEqual(response['status'], 1)
+        self.assertEqual(self.bucket.get_url.call_count, 0)
+
+    def test_run_refuses_other_stores(self):
+        for store in ({'bucket': 'other'}, None):
+            with self.daemon.redirected():
+                response = self.daemon.run(['expand', 'test.png'], store)
+            self.assertIn('refused', response)
+        self.assertEqual(self.bucket.get_url.call_count, 0)
+
+    def test_run_bad_arguments(self):
+        with self.daemon.redirected():
+            response = self.daemon.run(['expand'], {})
+        self.assertEqual(response['status'], 2)
+        self.assertIn('usage', response['stderr'])
+
+
+class TestLocalDaemon(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        config = ConfigParser()
+        config.add_section('default')
+        config.set('default', 'storage', 'local')
+        config.set('default', 'local_root', self.root)
+        config.set('default', 'index', 'off')
+        config.set('default', 'web_root', 'http://dummy.web.root/')
+        self.identity = gifshare.daemon.store_identity(config)
+        self.daemon = gifshare.daemon.Daemon(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_warm_up_and_run(self):
+        self.daemon.bucket.upload_contents('test.png', 'image/png', b'png')
+        self.daemon.warm_up()
+        with self.daemon.redirected():
+            response = self.daemon.run(['list'], self.identity)
+        self.assertEqual(response, {
+            'status': 0,
+            'stdout': 'http://dummy.web.root/test.png\n',
+            'stderr': '',
+        })
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'gifshare.sock')
+        self.bucket = MagicMock()
+        self.bucket.get_url.side_effect = 'http://dummy.web.root/{}'.format
+        self.daemon = gifshare.daemon.Daemon(config_stub, bucket=self.bucket)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_request_without_daemon(self):
+        self.assertIsNone(
+            gifshare.daemon.request(
+                self.path, ['expand', 'test.png'], config_stub))
+
+    def test_request_stale_socket(self):
+        open(self.path, 'w').close()
+        self.assertIsNone(
+            gifshare.daemon.request(
+                self.path, ['expand', 'test.png'], config_stub))
+
+    def test_round_trip(self):
+        server = gifshare.daemon.make_server(self.path, self.daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+            with self.daemon.redirected():
+                responses = [
+                    gifshare.daemon.request(
+                        self.path, ['expand', 'image{}.png'.format(i)],
+                        config_stub)
+                    for i in range(3)]
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(
+            [response['stdout'] for response in responses],
+            ['http://dummy.web.root/image{}.png\n'.format(i)
+             for i in range(3)])
+
+    def test_request_other_store(self):
+        server = gifshare.daemon.make_server(self.path, self.daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            response = gifshare.daemon.request(
+                self.path, ['expand', 'test.png'],
+                make_config(bucket='other'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertIsNone(response)
+        self.assertEqual(self.bucket.get_url.call_count, 0)
+
+    def test_request_stalled_daemon(self):
+        release = threading.Event()
+        self.bucket.get_url.side_effect = lambda name: release.wait(5)
+        server = gifshare.daemon.make_server(self.path, self.daemon)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with self.daemon.redirected(), \
+                    patch('gifshare.daemon.CLIENT_TIMEOUT', 0.1):
+                with self.assertRaises(DaemonError):
+                    gifshare.daemon.request(
+                        self.path, ['expand', 'test.png'], config_stub)
+        finally:
+            release.set()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(self.bucket.get_url.call_count, 1)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+import gifshare.download
+from gifshare.exceptions import (
+    DownloadFailed, ImageTooLarge, ResumeFailed, UnknownFileType)
+
+
+DATA = bytes(bytearray(range(256))) * 40
+
+
+class DummyServer(object):
+    """
+    Stands in for `requests.get`, serving DATA (or ranges of it), and
+    failing each response after `fail_after` bytes if it is set.
+    """
+
+    def __init__(self, ranges=True, fail_after=None, etag='"v1"',
+                 length=True, content_type='image/gif', encoding=None,
+                 range_skew=0):
+        self.ranges = ranges
+        self.encoding = encoding
+        self.range_skew = range_skew
+        self.fail_after = fail_after
+        self.etag = etag
+        self.length = length
+        self.content_type = content_type
+        self.requests = []
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def get(self, url, stream=False, headers=None):
+        headers = headers or {}
+        with self._lock:
+            self.requests.append(headers)
+            failing = self.fail_after is not None and len(self.requests) == 1
+        response = MagicMock(name='response')
+        self.responses.append(response)
+        response.headers = {'content-type': self.content_type}
+        if self.length:
+            response.headers['content-length'] = str(len(DATA))
+        if self.ranges:
+            response.headers['accept-ranges'] = 'bytes'
+        if self.etag:
+            response.headers['etag'] = self.etag
+        if self.encoding and \
+                headers.get('Accept-Encoding') != 'identity':
+            response.headers['content-encoding'] = self.encoding
+        body = DATA
+        response.status_code = 200
+        if 'Range' in headers and self.ranges:
+            if headers.get('If-Range', self.etag) == self.etag:
+                start, end = headers['Range'][len('bytes='):].split('-')
+                start = int(start) + self.range_skew
+                end = int(end) + 1 if end else len(DATA)
+                body = DATA[start:end]
+                response.status_code = 206
+                response.headers['content-range'] = 'bytes {}-{}/{}'.format(
+                    start, end - 1, len(DATA))
+
+        def iter_content(chunk_size):
+            for offset in range(0, len(body), 100):
+                if failing and offset >= self.fail_after:
+                    raise IOError("Connection reset")
+                yield body[offset:offset + 100]
+        response.iter_content.side_effect = iter_content
+        return response
+
+
+class TestDownload(unittest.TestCase):
+    def download(self, server, connections=1):
+        return gifshare.download.download_file(
+            'http://nonsense.url/', progress=False, connections=connections,
+            session=MagicMock(get=server.get))
+
+    def test_split_ranges(self):
+        with patch('gifshare.download.MIN_RANGE_SIZE', 1000):
+            self.assertEqual(gifshare.download.split_ranges(2500, 4), [
+                (0, 1250), (1250, 2500)])
+            self.assertEqual(
+                gifshare.download.split_ranges(500, 4), [(0, 500)])
+            self.assertEqual(gifshare.download.split_ranges(0, 4), [(0, 0)])
+
+    def test_range_validator(self):
+        response = MagicMock(headers={
+            'etag': 'W/"weak"', 'last-modified': 'yesterday'})
+        self.assertEqual(
+            gifshare.download.range_validator(response), 'yesterday')
+        response.headers['etag'] = '"strong"'
+        self.assertEqual(
+            gifshare.download.range_validator(response), '"strong"')
+
+    def test_resume(self):
+        server = DummyServer(fail_after=1000)
+        self.assertEqual(self.download(server), DATA)
+        self.assertEqual(server.requests[1], {
+            'Range': 'bytes=1000-{}'.format(len(DATA) - 1),
+            'Accept-Encoding': 'identity',
+            'If-Range': '"v1"',
+        })
+
+    def test_no_resume_without_ranges(self):
+        server = DummyServer(ranges=False, fail_after=1000)
+        with self.assertRaises(IOError):
+            self.download(server)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_changed_image_is_not_resumed(self):
+        server = DummyServer(fail_after=1000)
+        chunks = gifshare.download.iter_download(
+            'http://nonsense.url/', progress=False,
+            session=MagicMock(get=server.get))
+        next(chunks)
+        server.etag = '"v2"'
+        with self.assertRaises(ResumeFailed):
+            list(chunks)
+        # The whole image was sent again, so it isn't retried:
+        self.assertEqual(len(server.requests), 2)
+
+    def test_wrong_range_is_not_resumed(self):
+        server = DummyServer(fail_after=1000, range_skew=100)
+        with self.assertRaises(ResumeFailed):
+            self.download(server)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_compressed_download_is_not_resumed(self):
+        server = DummyServer(fail_after=1000, encoding='gzip')
+        with self.assertRaises(IOError):
+            self.download(server, connections=4)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_ranges_are_not_compressed(self):
+        server = DummyServer(fail_after=1000, encoding='gzip')
+        response = gifshare.download.request_range(
+            MagicMock(get=server.get), 'http://nonsense.url/', 100, 200)
+        self.assertEqual(server.requests[0]['Accept-Encoding'], 'identity')
+        self.assertNotIn('content-encoding', response.headers)
+
+    @patch('gifshare.download.MIN_RANGE_SIZE', 1000)
+    def test_parallel_ranges(self):
+        server = DummyServer()
+        self.assertEqual(self.download(server, connections=4), DATA)
+        ranges = sorted(headers['Range'] for headers in server.requests[1:])
+        self.assertEqual(ranges, [
+            'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239'])
+
+    @patch('gifshare.download.MIN_RANGE_SIZE', 1000)
+    def test_parallel_ranges_resume(self):
+        server = DummyServer(fail_after=500)
+        self.assertEqual(self.download(server, connections=2), DATA)
+
+    def test_unknown_length(self):
+        server = DummyServer(ranges=False, length=False)
+        self.assertEqual(self.download(server, connections=4), DATA)
+
+    def test_compressed_length_is_ignored(self):
+        server = DummyServer()
+        get = server.get
+
+        def gzipped(*args, **kwargs):
+            response = get(*args, **kwargs)
+            response.headers.update(
+                {'content-encoding': 'gzip', 'content-length': '10'})
+            return response
+        server.get = gzipped
+        self.assertEqual(self.download(server), DATA)
+
+    def test_text_is_rejected(self):
+        server = DummyServer(content_type='text/html; charset=utf-8')
+        with self.assertRaises(UnknownFileType):
+            self.download(server)
+        [response] = server.responses
+        self.assertFalse(response.iter_content.called)
+        response.close.assert_called_once_with()
+
+    def test_http_error(self):
+        server = DummyServer()
+        get = server.get
+
+        def not_found(*args, **kwargs):
+            response = get(*args, **kwargs)
+            response.status_code = 404
+            response.reason = 'Not Found'
+            return response
+        server.get = not_found
+        with self.assertRaises(DownloadFailed) as raised:
+            self.download(server)
+        self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(raised.exception.url, 'http://nonsense.url/')
+        server.responses[0].close.assert_called_once_with()
+
+    def test_max_size_from_length(self):
+        server = DummyServer()
+        with self.assertRaises(ImageTooLarge):
+            gifshare.download.download_file(
+                'http://nonsense.url/', progress=False, max_size=1000,
+                session=MagicMock(get=server.get))
+        self.assertFalse(server.responses[0].iter_content.called)
+
+    def test_max_size_while_streaming(self):
+        server = DummyServer(length=False)
+        chunks = gifshare.download.iter_download(
+            'http://nonsense.url/', progress=False, max_size=1000,
+            session=MagicMock(get=server.get))
+        with self.assertRaises(ImageTooLarge):
+            list(chunks)
+        server.responses[0].close.assert_called_once_with()
+
+    @patch('gifshare.download.MIN_RANGE_SIZE', 1000)
+    def test_abandoned_parallel_download(self):
+        server = DummyServer()
+        chunks = gifshare.download.iter_download(
+            'http://nonsense.url/', progress=False, connections=4,
+            session=MagicMock(get=server.get))
+        next(chunks)
+        chunks.close()
+        # The other ranges were never requested:
+        self.assertEqual(len(server.requests), 1)
+        server.responses[0].close.assert_called_once_with()
+
+
+class TestDownloadFile(unittest.TestCase):
+    @patch('gifshare.progress.is_interactive', return_value=True)
+    @patch('progressbar.ProgressBar')
+    @patch('gifshare.session.shared_session')
+    def test_download_file(self, session_mock, progress_bar_stub,
+                           interactive_stub):
+        requests_mock = session_mock.return_value.get
+        pbar_mock = progress_bar_stub.return_value
+
+        response_stub = MagicMock(status_code=200)
+        response_stub.headers = {
+            'content-length': 197
+        }
+
+        def iter_content_stub(chunk_size):
+            self.assertEqual(chunk_size, gifshare.download.MIN_CHUNK_SIZE)
+            for i in range(3):
+                yield b' ' * 64
+            yield b' ' * 5
+        response_stub.iter_content = iter_content_stub
+        requests_mock.return_value = response_stub
+        data = gifshare.download.download_file('http://nonsense.url/')
+        self.assertEqual(data, b' ' * 197)
+        requests_mock.assert_called_with(
+            'http://nonsense.url/', stream=True)
+        # Redraws are throttled, so only the first update is displayed:
+        pbar_mock.update.assert_called_once_with(64)
+        pbar_mock.finish.assert_called_once_with()
+
+    @patch('gifshare.progress.is_interactive', return_value=False)
+    @patch('progressbar.ProgressBar')
+    @patch('gifshare.session.shared_session')
+    def test_download_file_not_interactive(self, session_mock,
+                                           progress_bar_stub,
+                                           interactive_stub):
+        requests_mock = session_mock.return_value.get
+        response_stub = MagicMock(status_code=200)
+        response_stub.headers = {'content-length': 3}
+        response_stub.iter_content.return_value = [b'abc']
+        requests_mock.return_value = response_stub
+        data = gifshare.download.download_file('http://nonsense.url/')
+        self.assertEqual(data, b'abc')
+        progress_bar_stub.assert_not_called()
+
+    def test_chunk_size_for(self):
+        self.assertEqual(
+            gifshare.download.chunk_size_for(100),
+            gifshare.download.MIN_CHUNK_SIZE)
+        self.assertEqual(
+            gifshare.download.chunk_size_for(10 * 1024 * 1024), 104857)
+        self.assertEqual(
+            gifshare.download.chunk_size_for(10 ** 10),
+            gifshare.download.MAX_CHUNK_SIZE)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+import gifshare.index
+
+
+class DummyKey(object):
+    def __init__(self, name, size=100, etag='"etag"',
+                 last_modified='2014-11-07T00:00:00.000Z'):
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class TestKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'index.sqlite')
+        self.index = gifshare.index.KeyIndex(self.path, 'not.a.bucket', 60)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_new_index_is_stale(self):
+        self.assertTrue(self.index.is_stale())
+        self.assertIsNone(self.index.refreshed())
+        self.assertEqual(len(self.index), 0)
+
+    def test_refresh(self):
+        count = self.index.refresh(
+            [DummyKey('b.gif'), DummyKey('a.gif'), DummyKey('c.png')])
+        self.assertEqual(count, 3)
+        self.assertFalse(self.index.is_stale())
+        self.assertEqual(self.index.names(), ['a.gif', 'b.gif', 'c.png'])
+        self.assertIn('a.gif', self.index)
+        self.assertNotIn('d.gif', self.index)
+
+    def test_refresh_removes_missing_keys(self):
+        self.index.refresh([DummyKey('a.gif'), DummyKey('b.gif')])
+        self.index.refresh([DummyKey('b.gif', etag='"new"')])
+        self.assertEqual(self.index.names(), ['b.gif'])
+
+    def test_refresh_batches(self):
+        with patch('gifshare.index.BATCH_SIZE', 2):
+            self.index.refresh(
+                DummyKey('{:03}.gif'.format(i)) for i in range(5))
+        self.assertEqual(len(self.index), 5)
+
+    def test_ttl(self):
+        self.index.refresh([])
+        with patch('gifshare.index.time.time',
+                   return_value=time.time() + 120):
+            self.assertTrue(self.index.is_stale())
+
+    def test_add_and_remove(self):
+        self.index.refresh([DummyKey('a.gif')])
+        self.index.add('b.gif', 10, '"abc"')
+        self.assertEqual(self.index.names(), ['a.gif', 'b.gif'])
+        self.index.remove('a.gif')
+        self.assertEqual(self.index.names(), ['b.gif'])
+        self.index.add('c.gif')
+        self.index.add('d.gif')
+        self.index.remove('c.gif', 'd.gif')
+        self.assertEqual(self.index.names(), ['b.gif'])
+
+        # Keys added since the last refresh survive the next one if listed:
+        self.index.refresh([DummyKey('b.gif')])
+        self.assertEqual(self.index.names(), ['b.gif'])
+
+    def test_add_during_refresh(self):
+        self.index.refresh([DummyKey('a.gif')])
+
+        def listing():
+            yield DummyKey('a.gif')
+            # Uploaded after the listing passed its name:
+            self.index.add('b.gif')
+            yield DummyKey('c.gif')
+
+        self.index.refresh(listing())
+        self.assertEqual(self.index.names(), ['a.gif', 'b.gif', 'c.gif'])
+
+    def test_first_refresh_is_stale_until_complete(self):
+        def listing():
+            yield DummyKey('a.gif')
+            self.assertIsNone(self.index.refreshed())
+            self.assertTrue(self.index.is_stale())
+
+        self.index.refresh(listing())
+        self.assertFalse(self.index.is_stale())
+
+    def test_iter_names(self):
+        names = ['{:03d}.gif'.format(i) for i in range(25)]
+        self.index.refresh([DummyKey(name) for name in reversed(names)])
+        self.assertEqual(list(self.index.iter_names(batch_size=7)), names)
+        self.assertEqual(self.index.names(), names)
+
+    @patch('gifshare.index.BATCH_SIZE', 5)
+    def test_boundaries(self):
+        names = ['{:03d}.gif'.format(i) for i in range(40)]
+        self.index.refresh([DummyKey(name) for name in names])
+        self.assertEqual(
+            self.index.boundaries(4), ['010.gif', '020.gif', '030.gif'])
+        # Too few names to be worth splitting:
+        self.assertEqual(self.index.boundaries(10), [])
+        self.assertEqual(self.index.boundaries(1), [])
+
+    def test_grep(self):
+        self.index.refresh([
+            DummyKey('bunny-image.jpeg'),
+            DummyKey('kitten-image.jpeg'),
+            DummyKey('my-kittenz.jpeg'),
+        ])
+        self.assertEqual(
+            self.index.grep('kitten'),
+            ['kitten-image.jpeg', 'my-kittenz.jpeg'])
+
+    def test_buckets_are_separate(self):
+        self.index.refresh([DummyKey('a.gif')])
+        other = gifshare.index.KeyIndex(self.path, 'other.bucket')
+        try:
+            self.assertEqual(other.names(), [])
+            self.assertTrue(other.is_stale())
+        finally:
+            other.close()
+
+    def test_grep_modes(self):
+        self.index.refresh([
+            DummyKey('Kitten-Image.jpeg'),
+            DummyKey('kitten-image.png'),
+            DummyKey('my-kittenz.jpeg'),
+            DummyKey('ox.gif'),
+        ])
+        self.assertEqual(self.index.grep('Kitten'), ['Kitten-Image.jpeg'])
+        self.assertEqual(
+            self.index.grep('KITTEN', ignore_case=True),
+            ['Kitten-Image.jpeg', 'kitten-image.png', 'my-kittenz.jpeg'])
+        self.assertEqual(
+            self.index.grep(r'^kitten.*\.(png|gif)$', regex=True),
+            ['kitten-image.png'])
+        self.assertEqual(
+            self.index.grep(r'^kitten.*\.jpe?g$', ignore_case=True,
+                            regex=True),
+            ['Kitten-Image.jpeg'])
+        # Patterns too short for the trigram index still work:
+        self.assertEqual(self.index.grep('ox'), ['ox.gif'])
+        self.assertEqual(self.index.grep('o.', regex=True), ['ox.gif'])
+
+    def test_grep_without_trigram_index(self):
+        self.index.refresh([DummyKey('kitten.gif'), DummyKey('puppy.gif')])
+        self.index._trigrams = False
+        self.assertEqual(self.index.grep('kitten'), ['kitten.gif'])
+
+    def test_existing_keys_are_indexed(self):
+        self.index.refresh([DummyKey('kitten.gif'), DummyKey('puppy.gif')])
+        self.index._db.executescript(
+            'DROP TRIGGER keys_insert; DROP TRIGGER keys_delete; '
+            'DROP TRIGGER keys_update; DROP TABLE key_names;')
+        reopened = gifshare.index.KeyIndex(self.path, 'not.a.bucket')
+        try:
+            self.assertTrue(reopened._trigrams)
+            self.assertEqual(reopened.grep('kitten'), ['kitten.gif'])
+        finally:
+            reopened.close()
+
+    def test_trigrams_survive_vacuum(self):
+        self.index.refresh([DummyKey('{}.gif'.format(animal)) for animal in
+                            ('aardvark', 'kitten', 'puppy', 'zebra')])
+        self.index.remove('aardvark.gif')
+        self.index._db.execute('VACUUM')
+        self.assertEqual(self.index.grep('zebra'), ['zebra.gif'])
+        self.assertEqual(self.index.grep('kitten'), ['kitten.gif'])
+
+    def test_old_index_is_rebuilt(self):
+        self.index.close()
+        os.remove(self.path)
+        db = sqlite3.connect(self.path)
+        db.executescript("""
+            CREATE TABLE keys (
+                bucket TEXT NOT NULL, name TEXT NOT NULL, size INTEGER,
+                etag TEXT, modified TEXT,
+                generation INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, name));
+            CREATE TABLE refreshes (
+                bucket TEXT PRIMARY KEY, refreshed REAL NOT NULL,
+                generation INTEGER NOT NULL);
+            INSERT INTO keys (bucket, name) VALUES ('not.a.bucket', 'a.gif');
+            INSERT INTO refreshes VALUES ('not.a.bucket', 1e12, 1);
+        """)
+        db.close()
+        self.index = gifshare.index.KeyIndex(self.path, 'not.a.bucket', 60)
+        self.assertTrue(self.index.is_stale())
+        self.index.refresh([DummyKey('kitten.gif')])
+        self.assertEqual(self.index.grep('kitten'), ['kitten.gif'])
+
+    def test_trigrams_follow_changes(self):
+        self.index.refresh([DummyKey('kitten.gif'), DummyKey('puppy.gif')])
+        self.index.remove('kitten.gif')
+        self.index.add('kittens.png')
+        self.assertEqual(self.index.grep('kitten'), ['kittens.png'])
+        self.index.refresh([DummyKey('puppy.gif')])
+        self.assertEqual(self.index.grep('kitten'), [])
+        self.assertEqual(self.index.grep('pup'), ['puppy.gif'])
+
+    def test_invalid_regex(self):
+        with self.assertRaises(gifshare.exceptions.InvalidPattern):
+            self.index.grep('(', regex=True)
+
+    def test_find_etag(self):
+        self.index.refresh([
+            DummyKey('a.gif', etag='"abc"'),
+            DummyKey('b.gif', etag='"def-2"'),
+        ])
+        self.assertEqual(self.index.find_etag(['abc']), 'a.gif')
+        self.assertEqual(self.index.find_etag(['xyz', '"def-2"']), 'b.gif')
+        self.assertIsNone(self.index.find_etag(['xyz']))
+        self.assertIsNone(self.index.find_etag([]))
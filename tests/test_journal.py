@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import gifshare.journal
+
+from .util import image_path
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'uploads.json')
+        self.journal = gifshare.journal.UploadJournal(
+            self.path, 'not.a.bucket')
+        self.source = gifshare.journal.fingerprint(image_path('gif'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            self.source['size'], os.path.getsize(image_path('gif')))
+        self.assertTrue(os.path.isabs(self.source['path']))
+
+    def test_record_parts(self):
+        self.journal.start('a.gif', 'upload-1', self.source, 1024)
+        self.journal.record_part('a.gif', 'upload-1', 1, '"abc"')
+        # Parts of other uploads are ignored:
+        self.journal.record_part('a.gif', 'upload-0', 2, '"def"')
+
+        entry = gifshare.journal.UploadJournal(
+            self.path, 'not.a.bucket').get('a.gif')
+        self.assertEqual(entry['upload_id'], 'upload-1')
+        self.assertEqual(entry['part_size'], 1024)
+        self.assertEqual(entry['size'], self.source['size'])
+        self.assertEqual(entry['parts'], {'1': 'abc'})
+
+    def test_parts_are_appended(self):
+        self.journal.start('a.gif', 'upload-1', self.source, 1024)
+        for number in range(1, 4):
+            self.journal.record_part('a.gif', 'upload-1', number, '"etag"')
+        with open(self.path) as journal:
+            self.assertEqual(len(journal.readlines()), 4)
+
+        # Finishing an upload rewrites the journal with the others:
+        self.journal.start('b.gif', 'upload-2', self.source, 1024)
+        self.journal.finish('b.gif')
+        with open(self.path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+        self.assertEqual(
+            sorted(self.journal.get('a.gif')['parts']), ['1', '2', '3'])
+
+    def test_concurrent_journals(self):
+        # Separate UploadJournals share only the file lock, as separate
+        # processes would:
+        journals = [gifshare.journal.UploadJournal(self.path, 'not.a.bucket')
+                    for _ in range(4)]
+        journals[0].start('a.gif', 'upload-1', self.source, 1024)
+        journals[0].start('b.gif', 'upload-2', self.source, 1024)
+
+        def record(journal, first):
+            for number in range(first, 100, len(journals)):
+                journal.record_part('a.gif', 'upload-1', number, '"etag"')
+            journal.finish('b.gif')
+
+        threads = [threading.Thread(target=record, args=(journal, first))
+                   for first, journal in enumerate(journals)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.journal.get('a.gif')['parts']), 100)
+        self.assertIsNone(self.journal.get('b.gif'))
+
+    def test_finish(self):
+        self.journal.start('a.gif', 'upload-1', self.source, 1024)
+        self.journal.finish('a.gif', 'upload-0')
+        self.assertIsNotNone(self.journal.get('a.gif'))
+        self.journal.finish('a.gif')
+        self.assertIsNone(self.journal.get('a.gif'))
+
+    def test_uploads_are_per_bucket(self):
+        other = gifshare.journal.UploadJournal(self.path, 'other.bucket')
+        self.journal.start('a.gif', 'upload-1', self.source, 1024)
+        other.start('b.gif', 'upload-2', self.source, 1024)
+        self.assertEqual(list(self.journal.uploads()), ['a.gif'])
+        self.assertEqual(list(other.uploads()), ['b.gif'])
+
+    def test_unreadable_journal(self):
+        with open(self.path, 'w') as journal:
+            journal.write('not json')
+        self.assertEqual(self.journal.uploads(), {})
+
+    def test_torn_record(self):
+        self.journal.start('a.gif', 'upload-1', self.source, 1024)
+        self.journal.record_part('a.gif', 'upload-1', 1, '"abc"')
+        with open(self.path, 'a') as journal:
+            journal.write('{"op": "part", "key": "not.a.bucket/a.gif", "up')
+        self.assertEqual(self.journal.get('a.gif')['parts'], {'1': 'abc'})
+        self.journal.record_part('a.gif', 'upload-1', 2, '"def"')
+        self.assertEqual(self.journal.get('a.gif')['parts'],
+                         {'1': 'abc', '2': 'def'})
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from mock import patch
+
+import gifshare.listing
+from gifshare.listing import Partition
+
+
+class DummyKey(object):
+    def __init__(self, name):
+        self.name = name
+        self.size = 100
+
+
+class DummyPrefix(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class DummyBucket(object):
+    """
+    Lists `names` the way a boto Bucket does, honouring prefix, marker and
+    delimiter.
+    """
+
+    def __init__(self, names, fail_prefix=None):
+        self.names = sorted(names)
+        self.fail_prefix = fail_prefix
+        self.calls = []
+        self.threads = set()
+        self.listed = 0
+        self._lock = threading.Lock()
+
+    def list(self, prefix='', delimiter='', marker=''):
+        with self._lock:
+            self.calls.append((prefix, delimiter, marker))
+            if not delimiter:
+                self.threads.add(threading.current_thread())
+        if self.fail_prefix is not None and prefix == self.fail_prefix:
+            raise IOError("Listing failed")
+        prefixes = set()
+        for name in self.names:
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + 1]
+                if common not in prefixes:
+                    prefixes.add(common)
+                    yield DummyPrefix(common)
+            else:
+                with self._lock:
+                    self.listed += 1
+                yield DummyKey(name)
+
+
+NAMES = [
+    '0.gif', '9-lives.gif', 'Cat.gif', 'Zebra.png', 'apple.jpeg',
+    'kitten.gif', 'zzz.gif',
+]
+
+
+class TestListKeys(unittest.TestCase):
+    def names(self, keys):
+        return [key.name for key in keys]
+
+    def test_default_boundaries(self):
+        self.assertEqual(gifshare.listing.default_boundaries(1), [])
+        self.assertEqual(
+            gifshare.listing.default_boundaries(4), ['F', 'V', 'k'])
+
+    def test_range_partitions(self):
+        self.assertEqual(gifshare.listing.range_partitions(['m', 'c']), [
+            Partition('', None, 'c'),
+            Partition('', 'c', 'm'),
+            Partition('', 'm', None),
+        ])
+
+    def test_ordered(self):
+        bucket = DummyBucket(NAMES)
+        self.assertEqual(
+            self.names(gifshare.listing.list_keys(bucket, 4)), NAMES)
+        self.assertEqual(len(bucket.calls), 4)
+
+    def test_unordered(self):
+        bucket = DummyBucket(NAMES)
+        self.assertEqual(sorted(self.names(gifshare.listing.list_keys(
+            bucket, 3, boundaries=['C', 'k'], ordered=False))), NAMES)
+
+    def test_boundaries_are_exclusive_below(self):
+        bucket = DummyBucket(NAMES)
+        self.assertEqual(self.names(gifshare.listing.list_keys(
+            bucket, 2, boundaries=['Cat.gif', 'apple.jpeg'])), NAMES)
+
+    def test_serial(self):
+        bucket = DummyBucket(NAMES)
+        self.assertEqual(
+            self.names(gifshare.listing.list_keys(bucket, 1)), NAMES)
+        self.assertEqual(bucket.calls, [('', '', '')])
+
+    def test_delimiter(self):
+        names = ['a.gif', 'cats/1.gif', 'cats/2.gif', 'dogs/1.gif', 'z.gif']
+        bucket = DummyBucket(names)
+        self.assertEqual(self.names(gifshare.listing.list_keys(
+            bucket, 2, delimiter='/')), names)
+        self.assertEqual(sorted(bucket.calls), [
+            ('', '/', ''), ('cats/', '', ''), ('dogs/', '', '')])
+        self.assertEqual(sorted(self.names(gifshare.listing.list_keys(
+            bucket, 2, delimiter='/', ordered=False))), names)
+
+    @patch('gifshare.listing.PAGE_SIZE', 2)
+    def test_pages(self):
+        bucket = DummyBucket(NAMES)
+        pages = list(gifshare.listing.partition_pages(
+            bucket, Partition('', None, 'Zebra.png')))
+        self.assertEqual(
+            [self.names(page) for page in pages],
+            [['0.gif', '9-lives.gif'], ['Cat.gif', 'Zebra.png']])
+
+    def test_failure(self):
+        bucket = DummyBucket(['a.gif', 'cats/1.gif'], fail_prefix='cats/')
+        with self.assertRaises(IOError):
+            list(gifshare.listing.list_keys(bucket, 2, delimiter='/'))
+
+    def test_many_prefixes_share_workers(self):
+        names = ['{:03d}/cat.gif'.format(i) for i in range(200)]
+        bucket = DummyBucket(names)
+        self.assertEqual(self.names(gifshare.listing.list_keys(
+            bucket, 3, delimiter='/')), names)
+        self.assertLessEqual(len(bucket.threads), 3)
+
+    @patch('gifshare.listing.MAX_BUFFERED_PAGES', 1)
+    @patch('gifshare.listing.PAGE_SIZE', 1)
+    def test_buffering_is_bounded(self):
+        names = ['{}/{:03d}.gif'.format(prefix, i)
+                 for prefix in 'abcd' for i in range(50)]
+        bucket = DummyBucket(names)
+        keys = gifshare.listing.list_keys(bucket, 2, delimiter='/')
+        self.assertEqual(next(keys).name, 'a/000.gif')
+        time.sleep(0.2)
+        # Each worker holds a page, with one more waiting, at most:
+        self.assertLessEqual(bucket.listed, 2 * 3)
+        keys.close()
+        time.sleep(0.3)
+        self.assertFalse(any(thread.is_alive() for thread in bucket.threads))
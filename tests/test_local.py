@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from mock import patch
+from six.moves.configparser import ConfigParser
+
+from .util import image_path, load_image
+
+from gifshare.core import GifShare
+from gifshare.exceptions import FileAlreadyExists, MissingFile, UserException
+import gifshare.local
+from gifshare.storage import DeleteResult, open_storage
+
+
+def make_config(**options):
+    options.setdefault('index', 'off')
+    config = ConfigParser()
+    config.add_section('default')
+    for name, value in options.items():
+        config.set('default', name, value)
+    return config
+
+
+class TestLocalDirectory(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        self.config = make_config(
+            local_root=self.root, web_root='http://gifs.example/',
+            index=os.path.join(index_dir, 'index.sqlite'))
+        self.storage = gifshare.local.LocalDirectory(self.config)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as stored:
+            return stored.read()
+
+    def test_upload_stream(self):
+        url = self.storage.upload_stream(
+            'kitty.gif', 'image/gif', [b'GIF', b'89a'])
+        self.assertEqual(url, 'http://gifs.example/kitty.gif')
+        self.assertEqual(self.read('kitty.gif'), b'GIF89a')
+        self.assertEqual(os.listdir(self.root), ['kitty.gif'])
+        mode = os.stat(os.path.join(self.root, 'kitty.gif')).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o644)
+
+    def test_upload_existing(self):
+        self.storage.upload_contents('kitty.gif', 'image/gif', b'GIF89a')
+        with self.assertRaises(FileAlreadyExists):
+            self.storage.upload_contents('kitty.gif', 'image/gif', b'other')
+        self.assertEqual(self.read('kitty.gif'), b'GIF89a')
+        self.storage.upload_contents(
+            'kitty.gif', 'image/gif', b'other', force=True)
+        self.assertEqual(self.read('kitty.gif'), b'other')
+        self.assertEqual(os.listdir(self.root), ['kitty.gif'])
+
+    def test_upload_race(self):
+        self.storage.upload_contents('kitty.gif', 'image/gif', b'GIF89a')
+        # Another upload finishes between the check and the link:
+        with patch('os.path.exists', return_value=False):
+            with self.assertRaises(FileAlreadyExists):
+                self.storage.upload_contents('kitty.gif', 'image/gif', b'x')
+        self.assertEqual(self.read('kitty.gif'), b'GIF89a')
+        self.assertEqual(os.listdir(self.root), ['kitty.gif'])
+
+    def test_upload_without_links(self):
+        unsupported = OSError(errno.EPERM, 'Operation not permitted')
+        with patch('os.link', side_effect=unsupported):
+            self.storage.upload_contents('kitty.gif', 'image/gif', b'GIF89a')
+        self.assertEqual(self.read('kitty.gif'), b'GIF89a')
+        self.assertEqual(os.listdir(self.root), ['kitty.gif'])
+
+    def test_upload_file(self):
+        self.storage.upload_file(
+            'nested/kitty.png', 'image/png', image_path('png'))
+        self.assertEqual(self.read('nested/kitty.png'), load_image('png'))
+
+    def test_upload_file_without_sendfile(self):
+        unsupported = OSError(errno.EINVAL, 'Invalid argument')
+        with patch('os.sendfile', side_effect=unsupported, create=True):
+            self.storage.upload_file(
+                'kitty.png', 'image/png', image_path('png'))
+        self.assertEqual(self.read('kitty.png'), load_image('png'))
+
+    def test_invalid_names(self):
+        for name in ('../escape.gif', '', 'a/../..', 'a/../../escape.gif'):
+            with self.assertRaises(UserException):
+                self.storage.upload_contents(name, 'image/gif', b'GIF89a')
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_names(self):
+        for name in ('b.gif', 'a/c.gif', 'a.gif'):
+            self.storage.upload_contents(name, 'image/gif', b'GIF89a')
+        open(os.path.join(self.root, '.gifshare-abc.tmp'), 'w').close()
+        self.assertEqual(
+            list(self.storage.names()), ['a.gif', 'a/c.gif', 'b.gif'])
+        self.assertEqual(list(self.storage.list()), [
+            'http://gifs.example/a.gif', 'http://gifs.example/a/c.gif',
+            'http://gifs.example/b.gif'])
+        self.assertEqual(
+            list(self.storage.grep('a', regex=True)),
+            ['http://gifs.example/a.gif', 'http://gifs.example/a/c.gif'])
+
+    def test_get_url(self):
+        self.storage.upload_contents('kitty.gif', 'image/gif', b'GIF89a')
+        self.assertEqual(
+            self.storage.get_url('kitty.gif'), 'http://gifs.example/kitty.gif')
+        with self.assertRaises(MissingFile):
+            self.storage.get_url('puppy.gif')
+
+    def test_delete(self):
+        for name in ('a.gif', 'b.gif', 'c.gif'):
+            self.storage.upload_contents(name, 'image/gif', b'GIF89a')
+        self.storage.delete_file('a.gif')
+        self.assertEqual(
+            list(self.storage.delete_files(['b.gif', 'missing.gif'])),
+            [DeleteResult('b.gif', None), DeleteResult('missing.gif', None)])
+        self.assertEqual(list(self.storage.names()), ['c.gif'])
+
+    def test_find_duplicate_and_copy(self):
+        self.storage.upload_contents('a.gif', 'image/gif', b'GIF89a-a')
+        self.storage.upload_contents('b.gif', 'image/gif', b'GIF89a-b')
+        self.assertEqual(self.storage.find_duplicate([b'GIF89a', b'-b']),
+                         'b.gif')
+        self.assertIsNone(self.storage.find_duplicate([b'GIF89a-c']))
+        self.storage.copy_file('b.gif', 'c.gif', 'image/gif')
+        self.assertEqual(self.read('c.gif'), b'GIF89a-b')
+        with self.assertRaises(MissingFile):
+            self.storage.copy_file('missing.gif', 'd.gif', 'image/gif')
+
+    def test_find_duplicate_without_index(self):
+        storage = gifshare.local.LocalDirectory(make_config(
+            local_root=self.root, web_root='http://gifs.example/'))
+        self.assertIsNone(storage.index)
+        storage.upload_contents('a.gif', 'image/gif', b'GIF89a-a')
+        self.assertEqual(storage.find_duplicate([b'GIF89a-a']), 'a.gif')
+        self.assertIsNone(storage.find_duplicate([b'GIF89a-b']))
+
+    def test_find_duplicate_uses_index(self):
+        self.storage.upload_contents('a.gif', 'image/gif', b'GIF89a-a')
+        self.storage.upload_contents('b.gif', 'image/gif', b'GIF89a-b')
+        self.storage.refresh_index()
+        with patch('gifshare.local.file_md5',
+                   wraps=gifshare.local.file_md5) as file_md5:
+            self.assertEqual(
+                self.storage.find_duplicate([b'GIF89a-b']), 'b.gif')
+            self.assertIsNone(self.storage.find_duplicate([b'GIF89a-c']))
+        # Only the match is read, to check it:
+        self.assertEqual(file_md5.call_count, 1)
+
+        # Digests persist, and are only recalculated for changed files:
+        reopened = gifshare.local.LocalDirectory(self.config)
+        with open(os.path.join(self.root, 'a.gif'), 'wb') as changed:
+            changed.write(b'GIF89a-c')
+        with patch('gifshare.local.file_md5',
+                   wraps=gifshare.local.file_md5) as file_md5:
+            reopened.refresh_index()
+        file_md5.assert_called_once_with(os.path.join(self.root, 'a.gif'))
+        self.assertEqual(reopened.find_duplicate([b'GIF89a-c']), 'a.gif')
+
+    def test_find_duplicate_changed_since_refresh(self):
+        self.storage.upload_contents('a.gif', 'image/gif', b'GIF89a-a')
+        self.storage.upload_contents('b.gif', 'image/gif', b'GIF89a-b')
+        self.storage.refresh_index()
+        # Rewritten by another program before the index is stale:
+        with open(os.path.join(self.root, 'a.gif'), 'wb') as changed:
+            changed.write(b'GIF89a-b')
+        self.assertIsNone(self.storage.find_duplicate([b'GIF89a-a']))
+        self.assertEqual(self.storage.find_duplicate([b'GIF89a-b']), 'a.gif')
+
+    def test_upload_file_mapped(self):
+        data = load_image('png')
+        with patch('gifshare.local.copy_data') as copy_data:
+            self.storage.upload_file(
+                'kitty.png', 'image/png', '/not/read', data=data,
+                md5=hashlib.md5(data).digest())
+        self.assertFalse(copy_data.called)
+        self.assertEqual(self.read('kitty.png'), data)
+        self.assertEqual(self.storage.find_duplicate([data]), 'kitty.png')
+
+    def test_gifshare_dedup(self):
+        share = GifShare(self.storage, progress=False, dedup='link')
+        url = share.upload_file(image_path('gif'), 'first')
+        self.assertEqual(share.upload_file(image_path('gif'), 'second'), url)
+        self.assertEqual(list(self.storage.names()), ['first.gif'])
+
+    def test_cleanup_uploads(self):
+        old = os.path.join(self.root, '.gifshare-old.tmp')
+        new = os.path.join(self.root, '.gifshare-new.tmp')
+        for path in (old, new):
+            open(path, 'w').close()
+        an_hour_ago = time.time() - 3600
+        os.utime(old, (an_hour_ago, an_hour_ago))
+        self.assertEqual(
+            self.storage.cleanup_uploads(60), ['.gifshare-old.tmp'])
+        self.assertEqual(os.listdir(self.root), ['.gifshare-new.tmp'])
+
+    def test_default_web_root(self):
+        storage = gifshare.local.LocalDirectory(
+            make_config(local_root=self.root))
+        self.assertTrue(storage.url_for('kitty.gif').startswith('file:///'))
+        self.assertTrue(storage.url_for('kitty.gif').endswith('/kitty.gif'))
+
+
+class TestOpenStorage(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_local(self):
+        storage = open_storage(
+            make_config(storage='local', local_root=self.root))
+        self.assertIsInstance(storage, gifshare.local.LocalDirectory)
+
+    def test_s3_by_default(self):
+        config = make_config()
+        with patch('gifshare.s3.Bucket') as bucket:
+            self.assertIs(open_storage(config), bucket.return_value)
+        bucket.assert_called_once_with(config, progress=True)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            open_storage(make_config(storage='ftp'))
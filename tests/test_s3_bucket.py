@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import shutil
+import tempfile
 import unittest
 from nose.tools import assert_raises
 from mock import MagicMock, patch, call, ANY
 
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from six import BytesIO
 from six.moves.configparser import ConfigParser
 
 from .util import *
@@ -17,6 +23,8 @@ defaults = {
     'web_root': 'http://dummy.web.root/',
     'region': 'dummy-region',
     'bucket': 'not.a.bucket',
+    'index': 'off',
+    'upload_journal': 'off',
 }
 
 
@@ -24,13 +32,33 @@ def dummy_get(_, key):
     return defaults[key]
 
 
+def dummy_has_option(_, key):
+    return key in defaults
+
+
 config_stub = MagicMock(spec=ConfigParser)
 config_stub.get.side_effect = dummy_get
+config_stub.has_option.side_effect = dummy_has_option
+
+
+def make_config_stub(**options):
+    """
+    Return a config stub with `options` set in addition to the defaults.
+    """
+    values = dict(defaults, **options)
+    stub = MagicMock(spec=ConfigParser)
+    stub.get.side_effect = lambda _, key: values[key]
+    stub.has_option.side_effect = lambda _, key: key in values
+    return stub
 
 
 class DummyKey(object):
-    def __init__(self, name):
+    def __init__(self, name, size=100, etag='"etag"',
+                 last_modified='2014-11-07T00:00:00.000Z'):
         self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
 
 
 class TestBucket(unittest.TestCase):
@@ -50,6 +78,21 @@ class TestBucket(unittest.TestCase):
                 'dummy-access-id', 'dummy-secret-access-key')
             mock_get_bucket.assert_called_with('not.a.bucket')
 
+    def test_bucket_endpoint(self):
+        with patch('gifshare.s3.S3Connection',
+                   name='S3Connection') as MockS3Connection:
+            gifshare.s3.Bucket(make_config_stub(
+                endpoint_url='http://localhost:5000'))
+            _, kwargs = MockS3Connection.call_args
+            self.assertEqual(kwargs['host'], 'localhost')
+            self.assertEqual(kwargs['port'], 5000)
+            self.assertFalse(kwargs['is_secure'])
+
+    def test_bucket_bad_endpoint(self):
+        with patch('gifshare.s3.S3Connection', name='S3Connection'):
+            with self.assertRaises(ValueError):
+                gifshare.s3.Bucket(make_config_stub(endpoint_url='localhost'))
+
     def test_key_for(self):
         with patch('gifshare.s3.S3Connection',
                    name='S3Connection'):
@@ -83,7 +126,37 @@ class TestBucket(unittest.TestCase):
             MockS3Connection.assert_called_with(
                 'dummy-access-id', 'dummy-secret-access-key')
             mock_get_bucket.assert_called_with('not.a.bucket')
-            mock_bucket.list.assert_called_once_with()
+            # The keyspace is listed as concurrent partitions:
+            mock_bucket.list.assert_has_calls([
+                call(marker='', prefix=''),
+                call(marker='F', prefix=''),
+                call(marker='V', prefix=''),
+                call(marker='k', prefix=''),
+            ], any_order=True)
+            self.assertEqual(mock_bucket.list.call_count, 4)
+
+    def test_list_delimiter(self):
+        with patch('gifshare.s3.S3Connection',
+                   name='S3Connection') as MockS3Connection:
+            mock_bucket = MockS3Connection.return_value.get_bucket.return_value
+            prefix = MagicMock(spec=['name'])
+            prefix.name = 'cats/'
+            listings = {
+                None: [DummyKey('a.gif'), prefix, DummyKey('z.gif')],
+                'cats/': [DummyKey('cats/1.gif'), DummyKey('cats/2.gif')],
+            }
+            mock_bucket.list.side_effect = (
+                lambda prefix=None, delimiter=None, marker='':
+                listings[prefix])
+
+            self.bucket = gifshare.s3.Bucket(
+                make_config_stub(list_delimiter='/'))
+            self.assertEqual(list(self.bucket.list()), [
+                'http://dummy.web.root/a.gif',
+                'http://dummy.web.root/cats/1.gif',
+                'http://dummy.web.root/cats/2.gif',
+                'http://dummy.web.root/z.gif',
+            ])
 
     def test_upload_file(self):
         key_stub = MagicMock(name='Key')
@@ -92,10 +165,121 @@ class TestBucket(unittest.TestCase):
         self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
 
         url = self.bucket.upload_file('test_image.png', 'image/png', image_path('png'))
-        key_stub.set_contents_from_filename.assert_called_once_with(
-            os.path.abspath(image_path('png')),
-            cb=ANY
+        key_stub.set_contents_from_file.assert_called_once_with(
+            ANY,
+            headers={'If-None-Match': '*'},
+            cb=ANY,
+            md5=gifshare.s3.buffer_md5(load_image('png')),
+            size=len(load_image('png'))
         )
+        # The conditional PUT replaces the HEAD request:
+        key_stub.exists.assert_not_called()
+
+    @patch('gifshare.s3.map_file')
+    def test_upload_file_mapped(self, map_file):
+        key_stub = MagicMock(name='Key')
+        self.bucket = gifshare.s3.Bucket(config_stub)
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+        data = load_image('png')
+        digest = hashlib.md5(data).digest()
+
+        with patch('hashlib.md5') as md5:
+            self.bucket.upload_file(
+                'test_image.png', 'image/png', image_path('png'),
+                data=data, md5=digest)
+            md5.assert_not_called()
+        map_file.assert_not_called()
+        key_stub.set_contents_from_file.assert_called_once_with(
+            data, headers=ANY, cb=ANY, md5=gifshare.s3.buffer_md5(data),
+            size=len(data))
+
+    def test_upload_file_force(self):
+        key_stub = MagicMock(name='Key')
+        self.bucket = gifshare.s3.Bucket(config_stub)
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        self.bucket.upload_file(
+            'test_image.png', 'image/png', image_path('png'), force=True)
+        key_stub.set_contents_from_file.assert_called_once_with(
+            ANY, headers={}, cb=ANY, md5=ANY, size=ANY)
+        key_stub.exists.assert_not_called()
+
+    def test_upload_file_head_check(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = False
+        self.bucket = gifshare.s3.Bucket(
+            make_config_stub(existence_check='head'))
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        self.bucket.upload_file(
+            'test_image.png', 'image/png', image_path('png'))
+        key_stub.set_contents_from_file.assert_called_once_with(
+            ANY, headers={}, cb=ANY, md5=ANY, size=ANY)
+        self.assertEqual(key_stub.exists.call_count, 1)
+
+    def test_invalid_existence_check(self):
+        with self.assertRaises(ValueError):
+            gifshare.s3.Bucket(make_config_stub(existence_check='guess'))
+
+    @patch('gifshare.s3.MIN_PART_SIZE', 1024)
+    def test_upload_file_multipart(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.name = 'test_image.jpeg'
+        key_stub.content_type = 'image/jpeg'
+        key_stub.exists.return_value = False
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(make_config_stub(
+                multipart_threshold='4k',
+                multipart_chunksize='2k',
+                multipart_concurrency='3',
+            ), progress=False)
+            self.bucket.key_for = MagicMock(
+                name='key_for', return_value=key_stub)
+            multipart = self.bucket.bucket.initiate_multipart_upload.return_value
+            uploaded = {}
+
+            def upload_part(fp, number, md5=None, size=None):
+                uploaded[number] = fp.read()
+            multipart.upload_part_from_file.side_effect = upload_part
+
+            self.bucket.upload_file(
+                'test_image.jpeg', 'image/jpeg', image_path('jpeg'))
+
+            self.bucket.bucket.initiate_multipart_upload.assert_called_with(
+                'test_image.jpeg', headers={'Content-Type': 'image/jpeg'})
+            self.assertEqual(sorted(uploaded), [1, 2, 3, 4])
+            self.assertEqual(
+                b''.join(uploaded[n] for n in sorted(uploaded)),
+                load_image('jpeg'))
+            # Multipart uploads are checked before they start, as well as
+            # being completed conditionally:
+            self.assertEqual(key_stub.exists.call_count, 1)
+            self.bucket.bucket.complete_multipart_upload\
+                .assert_called_once_with(
+                    multipart.key_name, multipart.id,
+                    multipart.to_xml.return_value,
+                    headers={'If-None-Match': '*'})
+            self.assertFalse(key_stub.set_contents_from_file.called)
+
+    @patch('gifshare.s3.MIN_PART_SIZE', 1024)
+    def test_upload_file_multipart_failure(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = False
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(make_config_stub(
+                multipart_threshold='4k', multipart_chunksize='2k',
+            ), progress=False)
+            self.bucket.key_for = MagicMock(
+                name='key_for', return_value=key_stub)
+            multipart = self.bucket.bucket.initiate_multipart_upload.return_value
+            multipart.upload_part_from_file.side_effect = IOError
+
+            with self.assertRaises(IOError):
+                self.bucket.upload_file(
+                    'test_image.jpeg', 'image/jpeg', image_path('jpeg'))
+            multipart.cancel_upload.assert_called_once_with()
+            self.assertFalse(
+                self.bucket.bucket.complete_multipart_upload.called)
 
     def test_upload_contents(self):
         key_stub = MagicMock(name='Key')
@@ -105,40 +289,109 @@ class TestBucket(unittest.TestCase):
 
         image_data = load_image('png')
 
-        with patch('gifshare.core.download_file', return_value=image_data):
-            dest_url = self.bucket.upload_contents(
-                'thing.png',
-                'image/png',
-                image_data
-            )
-            key_stub.set_contents_from_string.assert_called_once_with(
-                image_data,
-                cb=ANY
-            )
-            self.assertEqual(dest_url, 'http://dummy.web.root/thing.png')
-
-    def test_upload_url_existing_file(self):
+        dest_url = self.bucket.upload_contents(
+            'thing.png',
+            'image/png',
+            image_data
+        )
+        key_stub.set_contents_from_string.assert_called_once_with(
+            image_data,
+            headers={'If-None-Match': '*'},
+            cb=ANY
+        )
+        self.assertEqual(dest_url, 'http://dummy.web.root/thing.png')
+
+    def test_upload_stream_small(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = False
+        self.bucket = gifshare.s3.Bucket(config_stub)
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        image_data = load_image('png')
+        dest_url = self.bucket.upload_stream(
+            'thing.png', 'image/png', iter([image_data[:100], image_data[100:]]))
+        key_stub.set_contents_from_string.assert_called_once_with(
+            image_data, headers={'If-None-Match': '*'}, cb=ANY)
+        self.assertEqual(dest_url, 'http://dummy.web.root/thing.png')
+
+    @patch('gifshare.s3.MIN_PART_SIZE', 1024)
+    def test_upload_stream_multipart(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.name = 'thing.jpeg'
+        key_stub.content_type = 'image/jpeg'
+        key_stub.exists.return_value = False
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(make_config_stub(
+                multipart_threshold='3k', multipart_chunksize='2k',
+            ), progress=False)
+            self.bucket.key_for = MagicMock(
+                name='key_for', return_value=key_stub)
+            multipart = self.bucket.bucket.initiate_multipart_upload.return_value
+            uploaded = {}
+
+            def upload_part(fp, number, md5=None, size=None):
+                uploaded[number] = fp.read()
+            multipart.upload_part_from_file.side_effect = upload_part
+
+            image_data = load_image('jpeg')
+            chunks = (image_data[i:i + 500]
+                      for i in range(0, len(image_data), 500))
+            self.bucket.upload_stream('thing.jpeg', 'image/jpeg', chunks)
+
+            self.assertEqual(sorted(uploaded), [1, 2, 3, 4])
+            self.assertEqual(len(uploaded[1]), 2048)
+            self.assertEqual(
+                b''.join(uploaded[n] for n in sorted(uploaded)), image_data)
+            self.bucket.bucket.complete_multipart_upload\
+                .assert_called_once_with(
+                    multipart.key_name, multipart.id,
+                    multipart.to_xml.return_value,
+                    headers={'If-None-Match': '*'})
+            self.assertFalse(key_stub.set_contents_from_string.called)
+
+    def test_upload_contents_existing_file(self):
         key_stub = MagicMock(name='thing.png')
         key_stub.exists.return_value = True
-        self.bucket = gifshare.s3.Bucket(config_stub)
+        self.bucket = gifshare.s3.Bucket(
+            make_config_stub(existence_check='head'))
         self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
 
         image_data = load_image('png')
 
-        with patch('gifshare.core.download_file', return_value=image_data):
-            with self.assertRaises(gifshare.exceptions.FileAlreadyExists):
-                self.bucket.upload_contents(
-                    'thing.png', 'image/png', image_data)
+        with self.assertRaises(gifshare.exceptions.FileAlreadyExists):
+            self.bucket.upload_contents('thing.png', 'image/png', image_data)
         self.assertFalse(key_stub.set_contents_from_string.called)
 
     def test_upload_existing_file(self):
         key_stub = MagicMock(name='Key')
         key_stub.exists.return_value = True
+        self.bucket = gifshare.s3.Bucket(
+            make_config_stub(existence_check='head'))
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        with assert_raises(gifshare.exceptions.FileAlreadyExists):
+            self.bucket.upload_file('test_image', 'image/png', image_path('png'))
+
+    def test_upload_existing_file_conditional(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.set_contents_from_file.side_effect = S3ResponseError(
+            412, 'Precondition Failed')
         self.bucket = gifshare.s3.Bucket(config_stub)
         self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
 
         with assert_raises(gifshare.exceptions.FileAlreadyExists):
             self.bucket.upload_file('test_image', 'image/png', image_path('png'))
+        key_stub.exists.assert_not_called()
+
+    def test_upload_error_conditional(self):
+        key_stub = MagicMock(name='Key')
+        key_stub.set_contents_from_string.side_effect = S3ResponseError(
+            403, 'Forbidden')
+        self.bucket = gifshare.s3.Bucket(config_stub)
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        with assert_raises(S3ResponseError):
+            self.bucket.upload_contents('thing.png', 'image/png', b'data')
 
     def test_get_url(self):
         key_stub = MagicMock(name='Key')
@@ -200,10 +453,337 @@ class TestBucket(unittest.TestCase):
                 'http://dummy.web.root/my-kittenz.jpeg',
             ])
 
+            results = list(self.bucket.grep('^KITTEN', True, True))
+            self.assertEqual(results, [
+                'http://dummy.web.root/kitten-image.jpeg',
+            ])
+
+    def test_names_matching(self):
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(config_stub)
+            self.bucket.bucket.list.return_value = [
+                DummyKey('bunny-image.jpeg'), DummyKey('kitten-image.jpeg')]
+            self.assertEqual(
+                list(self.bucket.names_matching('KITTEN', ignore_case=True)),
+                ['kitten-image.jpeg'])
+
+    def test_delete_files(self):
+        names = ['image{:04d}.gif'.format(i) for i in range(2500)]
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(config_stub)
+            delete_keys = self.bucket.bucket.delete_keys
+            error = MagicMock(
+                key='image1234.gif', code='AccessDenied', message='Denied')
+            delete_keys.side_effect = lambda batch, quiet: MagicMock(
+                errors=[error] if error.key in batch else [])
+
+            results = list(self.bucket.delete_files(names, concurrency=2))
+
+        batches = sorted(
+            (c[0][0] for c in delete_keys.call_args_list), key=len)
+        self.assertEqual([len(batch) for batch in batches], [500, 1000, 1000])
+        self.assertTrue(all(c[1] == {'quiet': True}
+                            for c in delete_keys.call_args_list))
+        self.assertEqual(
+            sorted(result.name for result in results), names)
+        self.assertEqual(
+            [result for result in results if result.error],
+            [gifshare.s3.DeleteResult(
+                'image1234.gif', 'AccessDenied: Denied')])
+
+    def test_delete_files_request_failure(self):
+        with patch('gifshare.s3.S3Connection'):
+            self.bucket = gifshare.s3.Bucket(config_stub)
+            self.bucket.bucket.delete_keys.side_effect = S3ResponseError(
+                403, 'Forbidden',
+                b'<Error><Code>AccessDenied</Code>'
+                b'<Message>Denied</Message></Error>')
+            results = list(self.bucket.delete_files(['a.gif', 'b.gif']))
+            self.bucket.bucket.delete_keys.side_effect = S3ResponseError(
+                503, 'Slow Down')
+            results.extend(self.bucket.delete_files(['c.gif']))
+        self.assertEqual(results, [
+            gifshare.s3.DeleteResult('a.gif', 'AccessDenied: Denied'),
+            gifshare.s3.DeleteResult('b.gif', 'AccessDenied: Denied'),
+            gifshare.s3.DeleteResult('c.gif', '503: Slow Down'),
+        ])
+
+
+class TestContentEtags(unittest.TestCase):
+    def test_single_part(self):
+        data = load_image('jpeg')
+        self.assertEqual(
+            gifshare.s3.content_etags([data], 1024, 10 ** 6),
+            [hashlib.md5(data).hexdigest()])
+
+    def test_multipart(self):
+        data = load_image('jpeg')
+        parts = [data[i:i + 1024] for i in range(0, len(data), 1024)]
+        expected = '{}-{}'.format(hashlib.md5(b''.join(
+            hashlib.md5(part).digest() for part in parts)).hexdigest(),
+            len(parts))
+        # Chunk boundaries don't need to line up with part boundaries:
+        chunks = [data[i:i + 700] for i in range(0, len(data), 700)]
+        self.assertEqual(
+            gifshare.s3.content_etags(chunks, 1024, 4096),
+            [hashlib.md5(data).hexdigest(), expected])
+
+
+class TestBufferMD5(unittest.TestCase):
+    def test_buffer_md5(self):
+        data = load_image('gif')
+        self.assertEqual(
+            gifshare.s3.buffer_md5(data),
+            tuple(value.decode('ascii') if isinstance(value, bytes) else value
+                  for value in Key().compute_md5(BytesIO(data))[:2]))
+
+
+class TestBucketIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        patcher = patch('gifshare.s3.S3Connection', name='S3Connection')
+        self.addCleanup(patcher.stop)
+        connection = patcher.start()
+        self.mock_bucket = connection.return_value.get_bucket.return_value
+        self.mock_bucket.list.return_value = [
+            DummyKey('bunny-image.jpeg'),
+            DummyKey('kitten-image.jpeg'),
+        ]
+        self.bucket = gifshare.s3.Bucket(make_config_stub(
+            index=os.path.join(self.tempdir, 'index.sqlite'),
+            list_concurrency='1'))
+
+    def tearDown(self):
+        self.bucket.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_list_uses_index(self):
+        urls = list(self.bucket.list())
+        self.assertEqual(urls, [
+            'http://dummy.web.root/bunny-image.jpeg',
+            'http://dummy.web.root/kitten-image.jpeg',
+        ])
+        self.assertEqual(list(self.bucket.grep('kitten')), [
+            'http://dummy.web.root/kitten-image.jpeg',
+        ])
+        # The second listing is answered from the index:
+        self.assertEqual(self.mock_bucket.list.call_count, 1)
+
+    def test_refresh_index(self):
+        list(self.bucket.list())
+        self.bucket.refresh_index()
+        self.assertEqual(self.mock_bucket.list.call_count, 2)
+
+    def test_known_keys_need_no_requests(self):
+        self.bucket.refresh_index()
+        key_stub = MagicMock(name='Key')
+        key_stub.name = 'bunny-image.jpeg'
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        self.assertEqual(
+            self.bucket.get_url('bunny-image.jpeg'),
+            'http://dummy.web.root/bunny-image.jpeg')
+        with self.assertRaises(gifshare.exceptions.FileAlreadyExists):
+            self.bucket.upload_contents(
+                'bunny-image.jpeg', 'image/jpeg', b'data')
+        self.bucket.delete_file('bunny-image.jpeg')
 
-@patch('gifshare.s3.progressbar.ProgressBar')
+        key_stub.exists.assert_not_called()
+        key_stub.delete.assert_called_once_with()
+        self.assertFalse(key_stub.set_contents_from_string.called)
+
+    def test_unknown_keys_are_checked(self):
+        self.bucket.refresh_index()
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = True
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        self.assertEqual(
+            self.bucket.get_url('puppy.gif'),
+            'http://dummy.web.root/puppy.gif')
+        self.assertEqual(key_stub.exists.call_count, 1)
+
+    def test_prepare_batch(self):
+        self.bucket.prepare_batch()
+        self.bucket.prepare_batch()
+        self.assertEqual(self.mock_bucket.list.call_count, 1)
+
+    def test_find_duplicate(self):
+        data = b'x' * 100
+        self.mock_bucket.list.return_value = [
+            DummyKey('bunny-image.jpeg'),
+            DummyKey('copy.png', etag='"{}"'.format(
+                hashlib.md5(data).hexdigest())),
+        ]
+        digests = {}
+        self.assertEqual(
+            self.bucket.find_duplicate([data], digests), 'copy.png')
+        self.assertEqual(digests, {'md5': hashlib.md5(data).digest()})
+        self.assertIsNone(self.bucket.find_duplicate([b'other']))
+
+    def test_copy_file(self):
+        self.bucket.refresh_index()
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = False
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+        self.mock_bucket.copy_key.return_value.etag = '"abc"'
+
+        url = self.bucket.copy_file(
+            'bunny-image.jpeg', 'bunny.jpeg', 'image/jpeg')
+        self.assertEqual(url, 'http://dummy.web.root/bunny.jpeg')
+        self.mock_bucket.copy_key.assert_called_with(
+            'bunny.jpeg', 'not.a.bucket', 'bunny-image.jpeg',
+            metadata={'Content-Type': 'image/jpeg'})
+        self.assertIn('bunny.jpeg', self.bucket.index)
+
+        key_stub.exists.return_value = True
+        with self.assertRaises(gifshare.exceptions.FileAlreadyExists):
+            self.bucket.copy_file(
+                'bunny-image.jpeg', 'bunny2.jpeg', 'image/jpeg')
+
+    def test_upload_and_delete_update_index(self):
+        self.bucket.refresh_index()
+        key_stub = MagicMock(name='Key')
+        key_stub.exists.return_value = False
+        key_stub.etag = '"abc"'
+        self.bucket.key_for = MagicMock(name='key_for', return_value=key_stub)
+
+        self.bucket.upload_contents('puppy.png', 'image/png', b'data')
+        self.assertIn('puppy.png', self.bucket.index)
+
+        key_stub.exists.return_value = True
+        self.bucket.delete_file('bunny-image.jpeg')
+        self.assertNotIn('bunny-image.jpeg', self.bucket.index)
+        self.assertEqual(list(self.bucket.list()), [
+            'http://dummy.web.root/kitten-image.jpeg',
+            'http://dummy.web.root/puppy.png',
+        ])
+        self.assertEqual(self.mock_bucket.list.call_count, 1)
+
+
+class DummyPart(object):
+    def __init__(self, number, etag):
+        self.part_number = number
+        self.etag = '"{}"'.format(etag)
+
+
+class TestBucketJournal(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = patch('gifshare.s3.MIN_PART_SIZE', 1024)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        patcher = patch('gifshare.s3.S3Connection', name='S3Connection')
+        self.addCleanup(patcher.stop)
+        connection = patcher.start()
+        self.mock_bucket = connection.return_value.get_bucket.return_value
+        self.multipart = self.mock_bucket.initiate_multipart_upload\
+            .return_value
+        self.multipart.id = 'upload-1'
+        self.bucket = gifshare.s3.Bucket(make_config_stub(
+            upload_journal=os.path.join(self.tempdir, 'uploads.json'),
+            multipart_threshold='4k', multipart_chunksize='1k',
+            multipart_concurrency='1',
+        ), progress=False)
+        self.key_stub = MagicMock(name='Key')
+        self.key_stub.name = 'test_image.jpeg'
+        self.key_stub.content_type = 'image/jpeg'
+        self.key_stub.exists.return_value = False
+        self.bucket.key_for = MagicMock(
+            name='key_for', return_value=self.key_stub)
+        self.data = load_image('jpeg')
+
+    def upload(self, resume=False):
+        return self.bucket.upload_file(
+            'test_image.jpeg', 'image/jpeg', image_path('jpeg'),
+            resume=resume)
+
+    def interrupt(self):
+        """
+        Start an upload which fails after two parts have been uploaded.
+        """
+        uploaded = {}
+
+        def upload_part(fp, number, md5=None, size=None):
+            if number > 2:
+                raise IOError("Connection lost")
+            uploaded[number] = fp.read()
+        self.multipart.upload_part_from_file.side_effect = upload_part
+        with self.assertRaises(IOError):
+            self.upload()
+        return uploaded
+
+    def test_interrupted_upload_is_journaled(self):
+        self.interrupt()
+        self.assertFalse(self.multipart.cancel_upload.called)
+        entry = self.bucket.journal.get('test_image.jpeg')
+        self.assertEqual(entry['upload_id'], 'upload-1')
+        self.assertEqual(entry['parts'], {
+            '1': hashlib.md5(self.data[:1024]).hexdigest(),
+            '2': hashlib.md5(self.data[1024:2048]).hexdigest(),
+        })
+
+    def test_resume(self):
+        uploaded = self.interrupt()
+        existing = MagicMock(name='MultiPartUpload')
+        existing.__iter__.return_value = [
+            DummyPart(number, hashlib.md5(data).hexdigest())
+            for number, data in uploaded.items()]
+
+        def upload_part(fp, number, md5=None, size=None):
+            uploaded[number] = fp.read()
+        existing.upload_part_from_file.side_effect = upload_part
+        with patch('gifshare.s3.MultiPartUpload', return_value=existing):
+            self.upload(resume=True)
+
+        self.assertEqual(existing.id, 'upload-1')
+        self.assertEqual(
+            self.mock_bucket.initiate_multipart_upload.call_count, 1)
+        sent = [args[0][1] for args in
+                existing.upload_part_from_file.call_args_list]
+        self.assertEqual(sent, list(range(3, len(uploaded) + 1)))
+        self.assertEqual(
+            b''.join(uploaded[n] for n in sorted(uploaded)), self.data)
+        self.assertIsNone(self.bucket.journal.get('test_image.jpeg'))
+
+    def test_resume_missing_upload(self):
+        self.interrupt()
+        existing = MagicMock(name='MultiPartUpload')
+        existing.__iter__.side_effect = S3ResponseError(404, 'Not Found')
+        self.multipart.upload_part_from_file.side_effect = None
+        with patch('gifshare.s3.MultiPartUpload', return_value=existing):
+            self.upload(resume=True)
+        # A new upload is started:
+        self.assertEqual(
+            self.mock_bucket.initiate_multipart_upload.call_count, 2)
+        self.assertIsNone(self.bucket.journal.get('test_image.jpeg'))
+
+    def test_new_upload_cancels_interrupted_upload(self):
+        self.interrupt()
+        self.multipart.upload_part_from_file.side_effect = None
+        self.upload()
+        self.mock_bucket.cancel_multipart_upload.assert_called_once_with(
+            'test_image.jpeg', 'upload-1')
+
+    def test_cleanup_uploads(self):
+        self.interrupt()
+        stale = MagicMock(key_name='test_image.jpeg', id='upload-1',
+                          initiated='2014-11-07T00:00:00.000Z')
+        recent = MagicMock(key_name='other.jpeg', id='upload-2',
+                           initiated=gifshare.index.now_iso())
+        self.mock_bucket.list_multipart_uploads.return_value = [stale, recent]
+
+        self.assertEqual(self.bucket.cleanup_uploads(), ['test_image.jpeg'])
+        stale.cancel_upload.assert_called_once_with()
+        self.assertFalse(recent.cancel_upload.called)
+        self.assertEqual(self.bucket.journal.uploads(), {})
+
+
+@patch('gifshare.progress.is_interactive', return_value=True)
+@patch('progressbar.ProgressBar')
 class TestUploadCallback(unittest.TestCase):
-    def test_upload_callback(self, progress_bar_mock):
+    def test_upload_callback(self, progress_bar_mock, interactive_stub):
         progress_bar_instance_mock = progress_bar_mock.return_value
 
         callback = gifshare.s3.upload_callback()
@@ -213,7 +793,7 @@ class TestUploadCallback(unittest.TestCase):
 
         progress_bar_instance_mock.start.assert_called_with()
 
-    def test_callback_update(self, progress_bar_mock):
+    def test_callback_update(self, progress_bar_mock, interactive_stub):
         progress_bar_instance_mock = progress_bar_mock.return_value
 
         callback = gifshare.s3.upload_callback()
@@ -221,7 +801,7 @@ class TestUploadCallback(unittest.TestCase):
         callback(50, 100)
         progress_bar_instance_mock.update.assert_called_with(50)
 
-    def test_callback_finish(self, progress_bar_mock):
+    def test_callback_finish(self, progress_bar_mock, interactive_stub):
         progress_bar_instance_mock = progress_bar_mock.return_value
         callback = gifshare.s3.upload_callback()
         callback(0, 100)
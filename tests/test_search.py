@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import gifshare.search
+from gifshare.exceptions import InvalidPattern
+
+
+class TestQueryPlanning(unittest.TestCase):
+    def test_required_literals(self):
+        self.assertEqual(
+            gifshare.search.required_literals(r'kitten.*\.gif'),
+            ['kitten', '.gif'])
+        self.assertEqual(
+            gifshare.search.required_literals(r'(?:dance)+-(party)?x'),
+            ['dance'])
+        self.assertEqual(
+            gifshare.search.required_literals(r'cat|dog'), [])
+
+    def test_query_literals(self):
+        self.assertEqual(gifshare.search.query_literals('abcd'), ['abcd'])
+        self.assertEqual(gifshare.search.query_literals('ab'), [])
+        self.assertEqual(
+            gifshare.search.query_literals('ab.d', regex=True), [])
+
+    def test_fts_query(self):
+        self.assertEqual(
+            gifshare.search.fts_query(['kitten', 'say "hi"']),
+            '"kitten" AND "say ""hi"""')
+
+    def test_matcher(self):
+        self.assertTrue(gifshare.search.matcher('kit')('kitten.gif'))
+        self.assertFalse(gifshare.search.matcher('KIT')('kitten.gif'))
+        self.assertTrue(
+            gifshare.search.matcher('KIT', ignore_case=True)('kitten.gif'))
+        self.assertTrue(
+            gifshare.search.matcher(r't+en\.', regex=True)('kitten.gif'))
+
+    def test_invalid_regex(self):
+        with self.assertRaises(InvalidPattern):
+            gifshare.search.matcher('[', regex=True)
+        with self.assertRaises(InvalidPattern):
+            gifshare.search.required_literals('[')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from mock import MagicMock, patch
+from six.moves import BaseHTTPServer
+from six.moves.configparser import ConfigParser
+
+import gifshare.session
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    failures = []
+
+    def do_GET(self):
+        if self.failures:
+            status = self.failures.pop(0)
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'GIF89a'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpSession(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/image.gif'.format(
+            self.server.server_address[1])
+        self.session = gifshare.session.HttpSession(backoff=0)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.assertEqual(self.session.get(self.url).content, b'GIF89a')
+        [stats] = self.session.stats()
+        self.assertEqual(stats.requests, 3)
+        self.assertEqual(stats.connections, 1)
+
+    def test_server_errors_are_retried(self):
+        Handler.failures[:] = [503, 502]
+        response = self.session.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Handler.failures, [])
+
+    def test_timeout(self):
+        with patch.object(self.session.session, 'get') as get:
+            self.session.get(self.url, stream=True)
+            get.assert_called_once_with(
+                self.url, stream=True, timeout=self.session.timeout)
+
+    def test_from_config(self):
+        config = MagicMock(spec=ConfigParser)
+        values = {'http_timeout': '5', 'http_retries': '1'}
+        config.has_option.side_effect = lambda _, key: key in values
+        config.get.side_effect = lambda _, key: values[key]
+        session = gifshare.session.HttpSession.from_config(config)
+        self.assertEqual(
+            session.timeout, (gifshare.session.DEFAULT_CONNECT_TIMEOUT, 5.0))
+        session.close()
+
+
+class TestSharedSession(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('gifshare.session._SHARED', [])
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_unused(self):
+        self.assertEqual(gifshare.session.connection_stats(), [])
+
+    def test_shared(self):
+        session = gifshare.session.shared_session()
+        self.assertIs(gifshare.session.shared_session(), session)
+        self.assertEqual(gifshare.session.connection_stats(), [])
+        session.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import sys
+import unittest
+
+from mock import MagicMock, patch
+
+from .util import *
+import gifshare.sniff
+
+
+def png_chunk(chunk_type, data=b''):
+    return struct.pack('>I4s', len(data), chunk_type) + data + b'\0' * 4
+
+
+PNG_HEAD = gifshare.sniff.PNG_SIGNATURE + png_chunk(b'IHDR', b'\0' * 13)
+
+
+class TestImageType(unittest.TestCase):
+    def test_fixtures(self):
+        for kind in ('gif', 'jpeg', 'png'):
+            self.assertEqual(
+                gifshare.sniff.image_type(load_image(kind)[:64]), kind)
+
+    def test_gif87a(self):
+        self.assertEqual(gifshare.sniff.image_type(b'GIF87a\x01\x00'), 'gif')
+
+    def test_apng(self):
+        head = PNG_HEAD + png_chunk(b'acTL', b'\0' * 8) + png_chunk(b'IDAT')
+        self.assertEqual(gifshare.sniff.image_type(head), 'apng')
+
+    def test_png_with_late_actl(self):
+        # An acTL chunk after the image data doesn't make an animation:
+        head = PNG_HEAD + png_chunk(b'IDAT') + png_chunk(b'acTL', b'\0' * 8)
+        self.assertEqual(gifshare.sniff.image_type(head), 'png')
+
+    def test_webp(self):
+        self.assertEqual(
+            gifshare.sniff.image_type(b'RIFF\x24\x00\x00\x00WEBPVP8 '),
+            'webp')
+
+    def test_avif(self):
+        self.assertEqual(
+            gifshare.sniff.image_type(
+                b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00avifmif1miaf'),
+            'avif')
+        self.assertEqual(
+            gifshare.sniff.image_type(
+                b'\x00\x00\x00\x18ftypmif1\x00\x00\x00\x00mif1avis'),
+            'avif')
+
+    def test_other_iso_media(self):
+        self.assertIsNone(gifshare.sniff.image_type(
+            b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2'))
+
+    def test_unknown(self):
+        self.assertIsNone(gifshare.sniff.image_type(load_image('ico')[:64]))
+        self.assertIsNone(gifshare.sniff.image_type(b''))
+        self.assertIsNone(gifshare.sniff.image_type(b'RIFF'))
+
+    def test_read_head(self):
+        self.assertEqual(
+            gifshare.sniff.read_head(image_path('gif')),
+            load_image('gif')[:gifshare.sniff.HEADER_SIZE])
+
+
+class TestMagicFallback(unittest.TestCase):
+    def test_without_magic(self):
+        with patch.dict(sys.modules, {'magic': None}):
+            self.assertIsNone(gifshare.sniff.magic_ext(b'data', True))
+
+    def test_magic_str(self):
+        magic_stub = MagicMock()
+        magic_stub.from_buffer.return_value = 'JPEG image data, JFIF'
+        with patch.dict(sys.modules, {'magic': magic_stub}):
+            self.assertEqual(
+                gifshare.sniff.magic_ext(b'data', True), 'jpeg')
+
+    def test_magic_bytes(self):
+        magic_stub = MagicMock()
+        magic_stub.from_file.return_value = b'RIFF (little-endian) data, Web/P'
+        with patch.dict(sys.modules, {'magic': magic_stub}):
+            self.assertEqual(gifshare.sniff.magic_ext('/a/path'), 'webp')
+        magic_stub.from_file.assert_called_with('/a/path')
+
+    def test_magic_unknown(self):
+        magic_stub = MagicMock()
+        magic_stub.from_buffer.return_value = 'MS Windows icon resource'
+        with patch.dict(sys.modules, {'magic': magic_stub}):
+            self.assertIsNone(gifshare.sniff.magic_ext(b'data', True))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+import unittest
+
+from boto.exception import S3ResponseError
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from mock import MagicMock
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.configparser import ConfigParser
+from six.moves.http_client import HTTPException
+
+import gifshare.throttle
+from gifshare.throttle import Throttle
+
+
+SLOW_DOWN = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>SlowDown</Code>'
+    b'<Message>Please reduce your request rate.</Message></Error>')
+INITIATED = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<InitiateMultipartUploadResult><Bucket>bucket</Bucket>'
+    b'<Key>image.gif</Key><UploadId>upload-id</UploadId>'
+    b'</InitiateMultipartUploadResult>')
+
+
+class FaultyS3(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A stand-in for S3 which answers every GET with the same body (and every
+    POST by starting a multipart upload), after
+    failing the requests listed in `faults` with a status (or by dropping
+    the connection if the status is `None`) and taking `delays` seconds to
+    answer them.
+    """
+    protocol_version = 'HTTP/1.1'
+    faults = []
+    delays = []
+    requests = 0
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def handle_request(self, body):
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            fault = cls.faults.pop(0) if cls.faults else 200
+            delay = cls.delays.pop(0) if cls.delays else 0
+        try:
+            time.sleep(delay)
+            if fault is None:
+                self.close_connection = True
+                return
+            if fault != 200:
+                body = SLOW_DOWN
+            self.send_response(fault)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def do_GET(self):
+        self.handle_request(b'GIF89a')
+
+    def do_HEAD(self):
+        self.handle_request(b'')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.handle_request(INITIATED)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestThrottle(unittest.TestCase):
+    def test_limit_grows_with_successes(self):
+        throttle = Throttle(limit=2, maximum=4)
+        for _ in range(100):
+            throttle.release(throttle.acquire())
+        self.assertEqual(throttle.limit, 4)
+
+    def test_limit_halves_once_per_epoch(self):
+        throttle = Throttle(limit=16)
+        tokens = [throttle.acquire() for _ in range(4)]
+        for token in tokens:
+            throttle.release(token, throttled=True)
+        self.assertEqual(throttle.limit, 8)
+        throttle.release(throttle.acquire(), throttled=True)
+        self.assertEqual(throttle.limit, 4)
+
+    def test_limit_has_a_minimum(self):
+        throttle = Throttle(limit=2)
+        for _ in range(5):
+            throttle.release(throttle.acquire(), throttled=True)
+        self.assertEqual(throttle.limit, 1)
+
+    def test_acquire_without_blocking(self):
+        throttle = Throttle(limit=1)
+        token = throttle.acquire()
+        self.assertIsNone(throttle.acquire(blocking=False))
+        throttle.release(token)
+        self.assertIsNotNone(throttle.acquire(blocking=False))
+
+    def test_backoff_is_jittered_and_capped(self):
+        throttle = Throttle(base_delay=1, max_delay=5, rng=random.Random(1))
+        delays = [throttle.backoff(attempt) for attempt in range(10)]
+        self.assertTrue(all(0 <= delay <= 5 for delay in delays))
+        self.assertNotEqual(len(set(delays)), 1)
+
+    def test_from_config(self):
+        config = MagicMock(spec=ConfigParser)
+        values = {'request_concurrency': '4', 'hedge_after': '0.5'}
+        config.has_option.side_effect = lambda _, key: key in values
+        config.get.side_effect = lambda _, key: values[key]
+        throttle = Throttle.from_config(config)
+        self.assertEqual(throttle.maximum, 4)
+        self.assertEqual(throttle.limit, 4)
+        self.assertEqual(throttle.hedge_after, 0.5)
+        self.assertEqual(throttle.retries, gifshare.throttle.DEFAULT_RETRIES)
+
+
+class TestThrottledConnection(unittest.TestCase):
+    def setUp(self):
+        FaultyS3.faults = []
+        FaultyS3.delays = []
+        FaultyS3.requests = FaultyS3.max_in_flight = 0
+        self.server = Server(('127.0.0.1', 0), FaultyS3)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connect(self, throttle):
+        connection = S3Connection(
+            'key-id', 'secret', host='127.0.0.1',
+            port=self.server.server_address[1], is_secure=False,
+            calling_format=OrdinaryCallingFormat())
+        throttle.wrap(connection)
+        return connection.get_bucket('bucket', validate=False)
+
+    def test_slow_down_is_retried(self):
+        throttle = Throttle(limit=8, sleep=lambda delay: None)
+        FaultyS3.faults = [503, 503]
+        key = self.connect(throttle).new_key('image.gif')
+        self.assertEqual(key.get_contents_as_string(), b'GIF89a')
+        self.assertEqual(FaultyS3.requests, 3)
+        self.assertEqual(throttle.retried, 2)
+        self.assertLess(throttle.limit, 8)
+
+    def test_dropped_connection_is_retried(self):
+        throttle = Throttle(sleep=lambda delay: None)
+        FaultyS3.faults = [None]
+        key = self.connect(throttle).new_key('image.gif')
+        self.assertEqual(key.get_contents_as_string(), b'GIF89a')
+        self.assertEqual(throttle.retried, 1)
+
+    def test_dropped_post_is_not_retried(self):
+        throttle = Throttle(sleep=lambda delay: None)
+        FaultyS3.faults = [None]
+        bucket = self.connect(throttle)
+        with self.assertRaises((IOError, HTTPException)):
+            bucket.initiate_multipart_upload('image.gif')
+        self.assertEqual(FaultyS3.requests, 1)
+        self.assertEqual(throttle.retried, 0)
+
+    def test_slow_down_post_is_retried(self):
+        throttle = Throttle(sleep=lambda delay: None)
+        FaultyS3.faults = [503]
+        upload = self.connect(throttle).initiate_multipart_upload('image.gif')
+        self.assertEqual(upload.id, 'upload-id')
+        self.assertEqual(FaultyS3.requests, 2)
+
+    def test_retries_are_limited(self):
+        throttle = Throttle(retries=2, sleep=lambda delay: None)
+        FaultyS3.faults = [503] * 5
+        key = self.connect(throttle).new_key('image.gif')
+        with self.assertRaises(S3ResponseError) as context:
+            key.get_contents_as_string()
+        self.assertEqual(context.exception.status, 503)
+        self.assertEqual(context.exception.error_code, 'SlowDown')
+        self.assertEqual(FaultyS3.requests, 3)
+
+    def test_client_errors_are_not_retried(self):
+        throttle = Throttle(limit=8, sleep=lambda delay: None)
+        FaultyS3.faults = [404]
+        self.assertIsNone(self.connect(throttle).get_key('missing.gif'))
+        self.assertEqual(FaultyS3.requests, 1)
+        self.assertEqual(throttle.limit, 8)
+
+    def test_concurrency_is_limited(self):
+        throttle = Throttle(limit=3, maximum=3)
+        FaultyS3.delays = [0.05] * 12
+        bucket = self.connect(throttle)
+        threads = [threading.Thread(target=bucket.get_key, args=('a.gif',))
+                   for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FaultyS3.requests, 12)
+        self.assertLessEqual(FaultyS3.max_in_flight, 3)
+
+    def test_slow_requests_are_hedged(self):
+        throttle = Throttle(hedge_after=0.05)
+        FaultyS3.delays = [2]
+        key = self.connect(throttle).new_key('image.gif')
+        start = time.time()
+        self.assertEqual(key.get_contents_as_string(), b'GIF89a')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(throttle.hedged, 1)
+        throttle.close()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from gifshare import timing
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        self.spans = []
+        timing.add_hook(self.spans.append)
+
+    def tearDown(self):
+        timing.remove_hook(self.spans.append)
+
+    def test_nested_spans(self):
+        with timing.span('upload'):
+            with timing.span('s3.put'):
+                timing.record(requests=1, size=100)
+            timing.record(requests=1)
+        put, upload = self.spans
+        self.assertEqual((put.name, put.parent), ('s3.put', 'upload'))
+        self.assertEqual((put.requests, put.bytes), (1, 100))
+        self.assertEqual((upload.name, upload.parent), ('upload', None))
+        self.assertEqual((upload.requests, upload.bytes), (2, 100))
+        self.assertGreaterEqual(upload.seconds, put.seconds)
+
+    def test_span_within_another_thread(self):
+        with timing.span('upload'):
+            within = timing.current()
+
+            def work():
+                with timing.span('s3.upload_part', within):
+                    timing.record(requests=1, size=10)
+
+            workers = [threading.Thread(target=work) for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        upload = self.spans[-1]
+        self.assertEqual(upload.name, 'upload')
+        self.assertEqual((upload.requests, upload.bytes), (3, 30))
+        self.assertEqual(
+            set(span.parent for span in self.spans[:-1]), set(['upload']))
+
+    def test_timed_iter(self):
+        with timing.span('upload_url'):
+            chunks = list(timing.timed_iter('download', [b'GIF', b'89a']))
+        self.assertEqual(chunks, [b'GIF', b'89a'])
+        download, upload = self.spans
+        self.assertEqual((download.name, download.bytes), ('download', 6))
+        self.assertEqual(download.parent, 'upload_url')
+        self.assertEqual(upload.bytes, 6)
+
+    def test_timed_iter_closed(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b'GIF'
+                yield b'89a'
+            finally:
+                closed.append(True)
+
+        timed = timing.timed_iter('download', chunks())
+        next(timed)
+        timed.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(self.spans[0].bytes, 3)
+
+    def test_recorder(self):
+        recorder = timing.Recorder()
+        for seconds in (0.5, 1.5):
+            recorder(timing.Span('s3.put', None, 0, seconds, 1, 10))
+        self.assertEqual(recorder.summary(), {'s3.put': {
+            'count': 2, 'seconds': 2.0, 'max_seconds': 1.5, 'requests': 2,
+            'bytes': 20}})
+        self.assertIn('s3.put', recorder.report())
+
+
+class TestWithoutHooks(unittest.TestCase):
+    def test_nothing_is_timed(self):
+        chunks = [b'GIF89a']
+        self.assertIs(timing.timed_iter('download', chunks), chunks)
+        with timing.span('upload'):
+            timing.record(requests=1)
+            self.assertEqual(timing.current(), ())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock
+
+from gifshare.core import UploadResult
+from gifshare.exceptions import UnknownFileType
+import gifshare.watch
+
+
+class FakeWatcher(object):
+    def __init__(self):
+        self.changes = set()
+        self.closed = False
+
+    def wait(self, timeout):
+        changes, self.changes = self.changes, set()
+        return changes
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def write(path, data=b'GIF89a'):
+    with open(path, 'wb') as image:
+        image.write(data)
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_candidate(self):
+        self.assertTrue(gifshare.watch.is_candidate('cat.gif'))
+        self.assertFalse(gifshare.watch.is_candidate('.cat.gif'))
+        self.assertFalse(gifshare.watch.is_candidate('cat.gif.part'))
+        self.assertFalse(gifshare.watch.is_candidate('cat.gif~'))
+
+    def test_inotify(self):
+        try:
+            watcher = gifshare.watch.InotifyWatcher(self.directory)
+        except OSError:
+            self.skipTest("inotify isn't available")
+        path = os.path.join(self.directory, 'cat.gif')
+        write(path)
+        write(os.path.join(self.directory, '.hidden'))
+        self.assertEqual(watcher.wait(5), set([path]))
+        self.assertEqual(watcher.wait(0), set())
+        watcher.close()
+
+    def test_polling(self):
+        watcher = gifshare.watch.PollingWatcher(self.directory, interval=0)
+        path = os.path.join(self.directory, 'cat.gif')
+        write(path)
+        self.assertEqual(watcher.wait(0), set([path]))
+        self.assertEqual(watcher.wait(0), set())
+
+
+class TestFolderWatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state_path = os.path.join(self.directory, '.state.json')
+        self.gifshare = MagicMock(name='GifShare')
+        self.gifshare.upload_many.side_effect = lambda sources, **kw: [
+            UploadResult(source, 'http://dummy.web.root/' +
+                         os.path.basename(source), None)
+            for source in sources]
+        self.clock = FakeClock()
+        self.watcher = FakeWatcher()
+
+    def make_watch(self):
+        return gifshare.watch.FolderWatch(
+            self.gifshare, self.directory,
+            gifshare.watch.WatchState(self.state_path), settle=2,
+            watcher=self.watcher, clock=self.clock)
+
+    def uploaded(self):
+        return [os.path.basename(source)
+                for args in self.gifshare.upload_many.call_args_list
+                for source in args[0][0]]
+
+    def test_files_are_uploaded_once_settled(self):
+        watch = self.make_watch()
+        path = os.path.join(self.directory, 'cat.gif')
+        write(path)
+        self.watcher.changes.add(path)
+        self.assertEqual(list(watch.step(0)), [])
+
+        self.clock.now += 3
+        [result] = list(watch.step(0))
+        self.assertEqual(result.url, 'http://dummy.web.root/cat.gif')
+
+    def test_changing_files_are_not_uploaded(self):
+        watch = self.make_watch()
+        path = os.path.join(self.directory, 'cat.gif')
+        write(path)
+        self.watcher.changes.add(path)
+        list(watch.step(0))
+        # Written to without an event:
+        write(path, b'GIF89a' * 10)
+        self.clock.now += 3
+        self.assertEqual(list(watch.step(0)), [])
+        self.clock.now += 3
+        self.assertEqual(len(list(watch.step(0))), 1)
+
+    def test_batches(self):
+        watch = self.make_watch()
+        for name in ['a.gif', 'b.gif', '.hidden.gif']:
+            write(os.path.join(self.directory, name))
+        watch.scan()
+        self.clock.now += 3
+        list(watch.step(0))
+        self.assertEqual(self.gifshare.upload_many.call_count, 1)
+        self.assertEqual(sorted(self.uploaded()), ['a.gif', 'b.gif'])
+
+    def test_restart_skips_handled_files(self):
+        write(os.path.join(self.directory, 'a.gif'))
+        watch = self.make_watch()
+        watch.scan()
+        self.clock.now += 3
+        list(watch.step(0))
+
+        write(os.path.join(self.directory, 'b.gif'))
+        watch = self.make_watch()
+        watch.scan()
+        self.clock.now += 3
+        list(watch.step(0))
+        self.assertEqual(self.uploaded(), ['a.gif', 'b.gif'])
+
+    def test_failures(self):
+        errors = {
+            'bad.txt': UnknownFileType('Unknown file type'),
+            'flaky.gif': IOError('Connection reset'),
+        }
+        self.gifshare.upload_many.side_effect = lambda sources, **kw: [
+            UploadResult(source, None, errors[os.path.basename(source)])
+            for source in sources]
+        for name in errors:
+            write(os.path.join(self.directory, name))
+        watch = self.make_watch()
+        watch.scan()
+        self.clock.now += 3
+        self.assertEqual(len(list(watch.step(0))), 2)
+
+        # Only the transient failure is retried after a restart:
+        watch = self.make_watch()
+        watch.scan()
+        self.clock.now += 3
+        list(watch.step(0))
+        self.assertEqual(self.uploaded()[2:], ['flaky.gif'])
+
+    def test_transient_failures_are_retried(self):
+        outcomes = [IOError('Connection reset')] * 2 + [None]
+        self.gifshare.upload_many.side_effect = lambda sources, **kw: [
+            UploadResult(source, None, outcomes.pop(0)) for source in sources]
+        write(os.path.join(self.directory, 'flaky.gif'))
+        watch = self.make_watch()
+        watch.scan()
+        self.clock.now += 3
+        self.assertEqual(len(list(watch.step(0))), 1)
+
+        # Retried after a delay, which doubles after each failure:
+        for delay in (gifshare.watch.RETRY_DELAY,
+                      gifshare.watch.RETRY_DELAY * 2):
+            self.clock.now += delay - 1
+            self.assertEqual(list(watch.step(0)), [])
+            self.clock.now += 1
+            self.assertEqual(len(list(watch.step(0))), 1)
+        self.assertEqual(self.uploaded(), ['flaky.gif'] * 3)
+
+        # Once uploaded, it isn't retried again:
+        self.clock.now += gifshare.watch.MAX_RETRY_DELAY
+        self.assertEqual(list(watch.step(0)), [])
+        self.assertEqual(self.gifshare.upload_many.call_count, 3)
+
+    def test_not_a_directory(self):
+        with self.assertRaises(gifshare.exceptions.UserException):
+            gifshare.watch.FolderWatch(
+                self.gifshare, self.state_path, None, watcher=self.watcher)